@@ -1,42 +1,56 @@
 __version__ = "1.3.0"
 
 import argparse
+import binascii
+import bisect
 import cgi
 import collections
+import copy
 import datetime
+import email.utils
 import errno
+import fcntl
 import hashlib
 import io
 import json
 import logging
+import math
+import mmap
 import multiprocessing
 import os
+import random
 import re
+import resource
+import shutil
 import signal
 import socket
+import struct
 import sys
+import tempfile
+import threading
 import time
 import traceback
-import urllib
 
 # Python2/3 module disambiguation
 if sys.version[0] == '3':
+    import asyncio
+    import concurrent.futures
     import configparser
+    import http.client as httplib
     import http.server as http_server
+    import queue
     import urllib.request as urllib2
     import urllib.parse as urlparse
-    import pickle
+    from urllib.parse import unquote
 else:
+    asyncio = None
     import ConfigParser as configparser
+    import httplib
     import BaseHTTPServer as http_server
+    import Queue as queue
     import urllib2
     import urlparse
-
-    # Load pickle for cache serialization
-    try:
-        import cPickle as pickle
-    except ImportError:
-        import pickle
+    from urllib import unquote
 
 # Gracefully exit if PIL is missing
 try:
@@ -46,13 +60,112 @@ except:
         "for instructions on how to install PIL.")
     sys.exit(1)
 
+# NumPy is optional, but makes border detection much cheaper
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Workaround for truncated images
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# Whether our PIL can resize just a region of an image, which our command
+# planner needs to fold crops into resizes
+try:
+    Image.new("L", (2, 2)).resize((1, 1), Image.NEAREST, (0, 0, 1, 1))
+    RESIZE_BOX = True
+except TypeError:
+    RESIZE_BOX = False
+
+# Whether our PIL can reduce an image by an integer factor before resampling
+# it, for two-stage resizes
+try:
+    Image.new("L", (4, 4)).resize((1, 1), Image.NEAREST, reducing_gap=2.0)
+    RESIZE_GAP = True
+except TypeError:
+    RESIZE_GAP = False
+
+# Pillow renamed its antialiasing filter to LANCZOS, and has since dropped
+# the old name
+ANTIALIAS = Image.LANCZOS if hasattr(Image, "LANCZOS") else Image.ANTIALIAS
+
+# Limits how many of an async mode worker's threads work on pixels at once,
+# while the rest are free to wait on I/O (None outside of async mode)
+cpu_slots = None
+
+# The uWSGI signal number used to trigger disk cache sweeps
+DISK_SWEEP_SIGNAL = 17
+
+# The size of the chunks that we write our output images out in
+OUT_CHUNK_SIZE = 262144
+
+# The size of the chunks that we read proxied images in, and how much of
+# each one we try to find its header in
+PROXY_CHUNK_SIZE = 65536
+PROXY_HEADER_BYTES = 1048576
+
+# The maximum number of redirects we follow when proxying an image
+PROXY_MAX_REDIRECTS = 5
+
+# The largest request header we accept in async mode, and how long (in
+# seconds) we keep idle keep-alive connections open if req_timeout isn't set
+ASYNC_MAX_HEAD = 65536
+ASYNC_IDLE_TIMEOUT = 60
+
+# How much larger than our resize target (per resampling filter) we decode
+# JPEGs at when shrinking them.  libjpeg's reduced-size decoding is little
+# better than a box filter, so we leave the wider filters enough source
+# pixels to do their job, which also leaves room for them to smooth over
+# blocking artifacts
+DRAFT_MARGINS = {
+    "nearest":   1.0,
+    "bilinear":  1.5,
+    "bicubic":   2.0,
+    "antialias": 2.0,
+}
+
+# The quarter turns (counter-clockwise) and flips (left-to-right, applied
+# before turning) that make up each transpose option, used by our command
+# planner to merge runs of transposes
+TRANSPOSE_OPS = {
+    "flipvert":  (0, 1),
+    "fliphorz":  (2, 1),
+    "rotate90":  (1, 0),
+    "rotate180": (2, 0),
+    "rotate270": (3, 0),
+}
+
+# Default image operations run by the benchmark
+BENCH_OPS = [
+    "resize=200x150",
+    "resize=800x600,fill&crop",
+    "crop=border&resize=pct:50",
+    "resize=640x640&pad=700x700,bg:000",
+    "transpose=rotate90&resize=300x300",
+    "resize=400x300&save=fmt:png",
+]
+
+# Image extensions included in a benchmark corpus
+BENCH_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+
+# The image modes that we detect borders in with NumPy, and the number of
+# lines (rows or columns) that we scan for the border's edge at a time
+BORDER_SCAN_MODES = ("L", "LA", "P", "RGB", "RGBA", "CMYK", "YCbCr")
+BORDER_SCAN_LINES = 32
+
 # The dirpy image class.  Defines the various operations that can be performed
 # on images loaded by dirpy
 class DirpyImage: ############################################################
 
+    # Header of our binary cache record: magic, version, format name length,
+    # meta data length, image length, source ID length, source validator
+    # length and the time that the source was last validated.  The header
+    # is followed by the format name, the JSON-encoded meta data, the source
+    # ID and validator and finally the raw image bytes
+    record_header = struct.Struct("!4sBxHIIHHd")
+    record_magic = b"DRPY"
+    record_version = 2
+
     def __init__(self, http_root):
         self.logger         = logging.getLogger("dirpy")
         self.local_file     = None
@@ -73,15 +186,33 @@ class DirpyImage: ############################################################
         self.save_opts      = {}
         self.trans          = None
         self.modified       = False
+        self.decoded        = False
+        self.src_key        = None
+        self.src_entry      = None
+        self.im_shared      = None
+        self.src_id         = None
+        self.src_validator  = None
+        self.validated      = 0
+        self.render_meta    = None
         self.http_root      = http_root
         self.meta_data      = collections.defaultdict(dict)
         self.http_code      = 200
         self.http_msg       = "OK"
+        self.content_type   = None
+        self.etag           = None
+        self.last_modified  = None
+        self.retry_after    = None
+        self.lazy           = False
+        self.lazy_mode      = None
+        self.conditional    = None
+        self.admit_cmds     = None
+        self.reserved       = None
 
         self.init_time      = time.time()
 
-    # Run a command, provided that it is value
-    def run(self, cmd, opts):
+    # Run a command, provided that it is value.  Steps planned by plan_cmds
+    # may pass extra arguments along to the command
+    def run(self, cmd, opts, *args):
         if cmd.startswith("_"):
             raise DirpyUserError("Internal method not run()-able: %s" % cmd)
         try:
@@ -89,7 +220,7 @@ class DirpyImage: ############################################################
         except AttributeError:
             raise DirpyUserError("Unknown command: %s" % cmd)
 
-        method(opts)
+        method(opts, *args)
         
 
     # Load an image file, either from disk or a local HTTP(S) server
@@ -130,11 +261,16 @@ class DirpyImage: ############################################################
                 self.file_path = proxy + rel_file
                 self.logger.debug("Loading image %s: %s" % 
                     (self.file_path, str(opts)))
-                proxy_req = urllib2.Request(self.file_path,
-                    headers={"User-Agent": "Dirpy/" + __version__})
-                proxy_res = urllib2.urlopen(proxy_req)
-                file_obj = io.BytesIO(proxy_res.read())
-                self.in_size = len(file_obj.getvalue())
+                self.src_id = "proxy:" + self.file_path
+                self.validated = time.time()
+
+                # Proxied sources are reused for decode_cache_ttl, after
+                # which they are only reused if the origin still has the
+                # same version (by ETag or Last-Modified) of them
+                self.src_key = "proxy:" + self.file_path
+                file_obj = self._cached_source()
+                if file_obj is None:
+                    file_obj = self._fetch_proxy()
 
             # Otherwise read it locally
             else:
@@ -142,9 +278,30 @@ class DirpyImage: ############################################################
                 self.logger.debug("Loading image %s: %s" % 
                     (self.file_path, str(opts)))
                 file_obj = open(self.file_path, "rb")
-                self.in_size = os.fstat(file_obj.fileno()).st_size
+                file_stat = os.fstat(file_obj.fileno())
+                self.in_size = file_stat.st_size
+
+                # Local sources are validated by their mtime and size
+                self.src_id = "file:" + self.file_path
+                self.src_validator = file_validator(file_stat)
+                self.validated = time.time()
+
+                # Local sources are keyed by their mtime and size, so they
+                # remain valid until the file itself changes
+                if decode_cache:
+                    self.src_key = "file:%s:%s:%s" % (self.file_path,
+                        file_stat.st_mtime, file_stat.st_size)
+                    cached_obj = self._cached_source()
+                    if cached_obj is None:
+                        file_obj = io.BytesIO(file_obj.read())
+                        self._cache_source(file_obj.getvalue(), None)
+                    else:
+                        file_obj.close()
+                        file_obj = cached_obj
 
             self.logger.debug("Serving file: %s" % self.file_path)
+        except DirpyError:
+            raise
         except Exception as e:
             err_code = e.code if hasattr(e, "code") else 500
             raise DirpyFatalError("Error reading file: %s" % e, err_code)
@@ -176,15 +333,36 @@ class DirpyImage: ############################################################
         except Exception as e:
             raise DirpyUserError("Error opening image: %s" % e, 400)
 
+        self._admit()
+
 
-    # Resize an image
-    def resize(self, opts): ##################################################
+    # Resize an image.  Our command planner may fold a (dimension or
+    # coordinate-based) crop run just before or after us into the resize, in
+    # which case we resample only the region of the image that the crop
+    # keeps, in a single pass.  A crop run before us is applied to our
+    # (possibly reduced-size) decode first, so that our filter only sees the
+    # pixels that the crop keeps, just like it would without the folding.
+    # The planner may also fold in a quarter turn run before the resize (and
+    # any crop), turning our options to match: we turn the image after we
+    # shrink it, so that fewer pixels are turned, or as requested otherwise
+    def resize(self, opts, crop_opts=None, crop_first=False, turn=None): #####
 
         self.logger.debug(
             "Resizing image %s: %s" % (self.file_path, str(opts)))
 
         # Measure time spent resizing
         resize_start = time.time()
+        prior_dims = list(self.req_dims)
+
+        # Work out the region of our image that we resample, which a crop
+        # run before us narrows down to the crop box
+        src_x, src_y = self.out_x, self.out_y
+        box = [0, 0, src_x, src_y]
+        if crop_opts is not None and crop_first:
+            crop_box = self._crop_box(crop_opts)
+            if crop_box is not None:
+                box = [ int(round(n)) for n in crop_box ]
+                self.out_x, self.out_y = box[2] - box[0], box[3] - box[1]
 
         # Fetch our percentage resize value (if any)
         try:
@@ -236,7 +414,24 @@ class DirpyImage: ############################################################
             filter_type = Image.BICUBIC
         else:
             filter_name = "antialias";
-            filter_type = Image.ANTIALIAS
+            filter_type = ANTIALIAS
+
+        # Set the gap (as a multiple of our new dimensions) to leave when we
+        # first reduce a large image by an integer factor, before resampling
+        # what's left of it with our filter.  Larger gaps are slower but
+        # closer to a plain resize, and a gap of 0 disables the reduction
+        try:
+            if opts.get("reduce") is True:
+                reduce_gap = 2.0
+            elif "reduce" in opts:
+                reduce_gap = float(opts["reduce"])
+            else:
+                reduce_gap = cfg.reduce_gap
+            if not valid_reduce_gap(reduce_gap):
+                raise ValueError
+        except ValueError:
+            raise DirpyUserError("Reduce gap must be 0 or at least 1: %s" %
+                opts["reduce"])
 
         # Calculate height and width resize rations based on original image
         # dimensions, user-requested dimensions, and aspect ratio options
@@ -283,24 +478,79 @@ class DirpyImage: ############################################################
             "Resize: out_x=%s out_y=%s new_x=%s new_y=%s ratio=%s" %
             (self.out_x, self.out_y, new_x, new_y, resize_ratio))
 
-        # Now do the actual resize
+        # Leave our image at its current size if we aren't allowed to (or
+        # don't need to) resize it
+        upscale = not shrink and resize_ratio > 1
+        downscale = not grow and resize_ratio < 1
+        if not (upscale or downscale):
+            new_x, new_y = self.out_x, self.out_y
+
+        # Only turn shrunken images: resampling turned pixels doesn't give
+        # quite the same result as turning resampled ones, which is only
+        # worth it when it saves work
+        if turn and not downscale:
+            self.out_x, self.out_y = src_x, src_y
+            self.req_dims = prior_dims
+            if crop_opts is not None:
+                self.crop(crop_opts)
+            self.transpose({turn: True})
+            self.resize(turn_dims(opts))
+            return
+
+        # Narrow the region we resample down to the crop box of a crop run
+        # after us, mapped back onto our unresized image
+        if crop_opts is not None and not crop_first:
+            self.out_x, self.out_y = new_x, new_y
+            crop_box = self._crop_box(crop_opts)
+            if crop_box is not None:
+                crop_box = [ int(round(n)) for n in crop_box ]
+                scale_x = float(box[2] - box[0]) / new_x
+                scale_y = float(box[3] - box[1]) / new_y
+                box = [ box[0] + crop_box[0] * scale_x,
+                    box[1] + crop_box[1] * scale_y,
+                    box[0] + crop_box[2] * scale_x,
+                    box[1] + crop_box[3] * scale_y ]
+                new_x = crop_box[2] - crop_box[0]
+                new_y = crop_box[3] - crop_box[1]
+
+        # In lazy mode, we only keep track of our new dimensions
+        if self.lazy:
+            self.out_x, self.out_y = new_x, new_y
+            if turn:
+                self.transpose({turn: True})
+            return
+
+        # Now do the actual resize.  When shrinking, our draft size is the
+        # size that the whole image needs to be for our region to still
+        # cover our new dimensions, with our filter's margin to spare
         try:
-            if not shrink and resize_ratio > 1:
-                self.im_in = self.im_in.resize((new_x, new_y), filter_type)
-                self.modified = True
-            elif not grow and resize_ratio < 1:
-                self.im_in.draft(None,(new_x,new_y))
-                self.im_in = self.im_in.resize((new_x, new_y), filter_type)
+            if upscale:
+                self._decode()
+                self._resample(new_x, new_y, filter_type, box, src_x, src_y,
+                    clip=crop_first)
+            elif downscale:
+                margin = DRAFT_MARGINS[filter_name]
+                self._decode((
+                    min(src_x, int(math.ceil(
+                        margin * src_x * new_x / (box[2] - box[0])))),
+                    min(src_y, int(math.ceil(
+                        margin * src_y * new_y / (box[3] - box[1]))))))
+                self._resample(new_x, new_y, filter_type, box, src_x, src_y,
+                    reduce_gap, crop_first)
+            elif box != [0, 0, src_x, src_y]:
+                self._decode()
+                self.im_in = self.im_in.crop(box)
+                self.im_in.load()
                 self.modified = True
             self.out_x, self.out_y = self.im_in.size
         except Exception as e:
             raise DirpyFatalError("Error resizing: %s" % e)
 
         # Record resize time
-        if "time_resize" in self.meta_data:
-            self.meta_data["ms"]["time_resize"] += time.time() - resize_start
-        else:
-            self.meta_data["ms"]["time_resize"] = time.time() - resize_start
+        self._add_time("time_resize", resize_start)
+
+        if turn:
+            self.transpose({turn: True})
 
 
     # Crop an image
@@ -309,31 +559,73 @@ class DirpyImage: ############################################################
         self.logger.debug("Cropping image %s: %s" 
             % (self.file_path, str(opts)))
 
+        # Measure time spent cropping
+        crop_start = time.time()
+
+        # Find our crop box, if we need to crop at all
+        new_dims = self._crop_box(opts)
+        if new_dims is None:
+            return
+
+        self.logger.debug("Crop: out_x=%s out_y=%s crop_box=%s, grav=%s" %
+            (self.out_x, self.out_y, str(new_dims), self.gravity))
+
+        # In lazy mode, we only keep track of our new dimensions
+        if self.lazy:
+            new_dims = [ int(round(n)) for n in new_dims ]
+            self.out_x = new_dims[2] - new_dims[0]
+            self.out_y = new_dims[3] - new_dims[1]
+            return
+
+        # Now crop the image
+        try:
+            self._decode()
+            self.im_in = self.im_in.crop(new_dims)
+            self.im_in.load()
+            self.out_x, self.out_y = self.im_in.size
+            self.modified = True
+        except Exception as e:
+            raise DirpyFatalError("Error cropping: %s" % e)
+
+        # Record crop time
+        self._add_time("time_crop", crop_start)
+
+
+    # Work out the box to crop our image to, or None if cropping it wouldn't
+    # change it.  Only border crops look at our image's pixels
+    def _crop_box(self, opts): ###############################################
+
         # Make sure that we have an appropriate dimension set
         self._get_req_dims(opts)
 
         # Handle automatic border cropping
         if "border" in opts:
 
-            # Allow fuziness modification
+            # Allow fuziness modification, either for all of the image's
+            # channels at once, or for each channel (colon-delimited)
             if opts["border"] is True:
-                fuzz = 100
+                fuzz = [100]
             else:
                 try:
-                    fuzz = int(opts["border"])
-                    if not 0 < fuzz < 255:
+                    fuzz = [ int(f) for f in opts["border"].split(":") ]
+                    if [ f for f in fuzz if not 0 < f < 255 ]:
                         raise Exception
                 except:
                     raise DirpyUserError(
                         "Crop fuzz must be an integer between 0 and 255: %s"
                         % opts["border"])
 
-            # Do an image channel difference, and then get the bounding box
-            # to determine where the border is
-            bg = Image.new(self.im_in.mode, self.im_in.size, 
-                self.im_in.getpixel((0,0)))
-            diff = ImageChops.difference(self.im_in, bg)
-            new_dims = list(ImageChops.add(diff, diff, 2.0, -fuzz).getbbox())
+            self._decode()
+            if len(fuzz) not in (1, len(self.im_in.getbands())):
+                raise DirpyUserError(
+                    "Crop fuzz needs one value, or one per channel (%s): %s"
+                    % (self.im_in.mode, opts["border"]))
+
+            # Find the bounding box of everything that isn't border, and
+            # don't bother cropping if the whole image is border
+            new_dims = self._border_box(fuzz)
+            if new_dims is None:
+                return None
 
             # Make border cropping symmetric, if requested
             if "symmetric" in opts:
@@ -364,7 +656,7 @@ class DirpyImage: ############################################################
             # requested crop size
             if (self.req_dims[1] == self.out_y 
                     and self.req_dims[0] == self.out_x):
-                return
+                return None
 
             new_dims = self._get_new_dims(opts)
 
@@ -399,17 +691,7 @@ class DirpyImage: ############################################################
         else:
             raise DirpyUserError("Crop requires dimensions or coordinates")
 
-        self.logger.debug("Crop: out_x=%s out_y=%s crop_box=%s, grav=%s" %
-            (self.out_x, self.out_y, str(new_dims), self.gravity))
-
-        # Now crop the image
-        try:
-            self.im_in = self.im_in.crop(new_dims)
-            self.im_in.load()
-            self.out_x, self.out_y = self.im_in.size
-            self.modified = True
-        except Exception as e:
-            raise DirpyFatalError("Error cropping: %s" % e)
+        return new_dims
 
 
     # Pad an image
@@ -418,6 +700,9 @@ class DirpyImage: ############################################################
         self.logger.debug("Padding image %s: %s" 
             % (self.file_path, str(opts)))
 
+        # Measure time spent padding
+        pad_start = time.time()
+
         # Make sure that we have an appropriate dimension set
         self._get_req_dims(opts)
         if self.num_dims != 2:
@@ -463,9 +748,16 @@ class DirpyImage: ############################################################
         # Get our interior dimension locations
         new_dims = self._get_new_dims(opts)
 
+        # In lazy mode, we only keep track of our new dimensions (and mode)
+        if self.lazy:
+            self.out_x, self.out_y = self.req_dims
+            self.lazy_mode = pad_mode
+            return
+
         # Create the padded image and insert our old image into it and
         # then overwrite our existing input image with the paddded one
         try:
+            self._decode()
             im_pad = Image.new(pad_mode, self.req_dims, pad_color)
             im_pad.paste(self.im_in, new_dims)
 
@@ -483,6 +775,9 @@ class DirpyImage: ############################################################
             raise DirpyFatalError(
                 "Error padding image %s: %s" % (self.file_path,e))
 
+        # Record pad time
+        self._add_time("time_pad", pad_start)
+
 
     # Transpose an image
     def transpose(self, opts): ###############################################
@@ -490,6 +785,8 @@ class DirpyImage: ############################################################
         self.logger.debug("Transposing image %s: %s" 
             % (self.file_path, str(opts)))
 
+        # Measure time spent transposing
+        transpose_start = time.time()
 
         # Parse possible arguments
         num_args = 0
@@ -513,8 +810,15 @@ class DirpyImage: ############################################################
             raise DirpyUserError(
                 "Transpose requires exactly one option: %s" % str(opts))
 
+        # In lazy mode, we only keep track of our new dimensions
+        if self.lazy:
+            if method in (Image.ROTATE_90, Image.ROTATE_270):
+                self.out_x, self.out_y = self.out_y, self.out_x
+            return
+
         # Now rotate
         try:
+            self._decode()
             self.im_in = self.im_in.transpose(method)
             self.out_x, self.out_y = self.im_in.size
             self.modified = True
@@ -522,6 +826,9 @@ class DirpyImage: ############################################################
             raise DirpyFatalError(
                 "Error transposing image %s: %s" % (self.file_path,e))
 
+        # Record transpose time
+        self._add_time("time_transpose", transpose_start)
+
 
     # Write an image to a BytesIO output buffer
     def save(self, opts): ####################################################
@@ -576,7 +883,7 @@ class DirpyImage: ############################################################
 
             # Make sure we got a valid quality percentage
             if not 0 < qual_val < 101:
-                raise Exception("Invalid quality")
+                raise DirpyUserError("Quality must be between 1 and 100")
 
             # Dont recompress input images that are less than this size
             if self.out_x * self.out_y < cfg.min_recompress_pixels:
@@ -588,6 +895,51 @@ class DirpyImage: ############################################################
         else:
             qual_val = None
 
+        # Make sure that we can write our output format at all
+        Image.init()
+        if self.out_fmt.upper() not in Image.SAVE:
+            raise DirpyUserError("Unsupported output format: %s" %
+                self.out_fmt)
+
+        # Our output arguments.  We have to to use a kwargs pointer, as
+        # the save function will sometimes interpret the presence of
+        # an argument (regardless of its value) to mean a true value
+
+        # Pillow sizes its JPEG encoder buffer for optimized and
+        # progressive images itself (a legacy PIL bug used to need a
+        # larger ImageFile.MAXBLOCK), so we leave that global alone
+        self.save_opts["format"] = self.out_fmt
+        if optimize:
+            self.save_opts["optimize"] = True
+        if progressive:
+            self.save_opts["progressive"] = True
+        if qual_val is not None:
+            self.save_opts["quality"] = qual_val
+
+        # In lazy mode, we only report what we would have saved.  Our size
+        # isn't known, unless we weren't going to show the image anyway.
+        # Saving a single pixel in our output mode makes sure that requests
+        # that would fail to save still fail, even though we're lazy
+        if self.lazy:
+            mode = self.lazy_mode or self.im_in.mode
+            if self.out_fmt == "jpeg" and mode == "P":
+                mode = "RGB"
+            try:
+                Image.new(mode, (1, 1)).save(io.BytesIO(), **self.save_opts)
+            except Exception as e:
+                raise DirpyFatalError("Failed to save image: %s" % e)
+
+            self.out_size = 0 if noshow else None
+            self.meta_data["g"]["out_width"]     = self.out_x
+            self.meta_data["g"]["out_height"]    = self.out_y
+            self.meta_data["ms"]["time_save"]    = time.time() - save_start
+            self.meta_data["c"]["out_fmt_" + self.out_fmt] = 1
+            self.meta_data["c"]["lazy"] = 1
+            return
+
+        # Make sure that we have our pixels on hand
+        self._decode()
+
         # Handle pallette-style transparency
         if self.out_fmt in ("gif"):
             if self.trans is not None:
@@ -604,35 +956,29 @@ class DirpyImage: ############################################################
         if self.out_fmt == "jpeg" and self.im_in.mode == "P":
             self.im_in = self.im_in.convert("RGB")
 
+        # Our image may be a decode that is shared with other threads through
+        # the decode cache (or with our batch's other variants), and saving
+        # an image modifies it, so save our own copy instead.  Keeping JPEG
+        # settings needs a freshly opened JPEG, which a batch's variants
+        # (rendered one at a time) can share if the source isn't cached
+        keep = self.in_fmt == self.out_fmt == "jpeg" and not self.modified
+        if self.im_in is self.im_shared:
+            if keep and self.src_entry:
+                self.im_in = Image.open(io.BytesIO(self.src_entry.data))
+            elif not keep:
+                self.im_in = self.im_in.copy()
+
         # Maintain the encoder subsampling to prevent jpeg->jpeg size bloat
         # (although this only works on un-modified images)
-        if self.in_fmt == self.out_fmt == "jpeg" and not self.modified:
+        if keep:
             self.im_in.format = "JPEG"
-            qual_val = "keep"
+            self.save_opts["quality"] = "keep"
             self.logger.debug("Preventing JPEG recompression.")
 
         # Now write the converted image to a buffer
         try:
-            # Our output arguments.  We have to to use a kwargs pointer, as
-            # the save function will sometimes interpret the presence of
-            # an argument (regardless of its value) to mean a true value
-
-            # Bump up the ImageFile.MAXBLOCK size when writing optimized or
-            # progressive images to avoid a legacy PIL bug
-            self.save_opts["format"] = self.out_fmt
-            if progressive or optimize:
-                ImageFile.MAXBLOCK =  max(
-                    self.in_x * self.in_y, 
-                    self.out_x * self.out_y, 2097152)
-                self.logger.debug("MAXBLOCK set to: %s" % ImageFile.MAXBLOCK)
-            if optimize: 
-                self.save_opts["optimize"] = True
-            if progressive: 
-                self.save_opts["progressive"] = True
             if icc_prof is not None: 
                 self.save_opts["icc_profile"] = icc_prof
-            if qual_val is not None:
-                self.save_opts["quality"] = qual_val
 
             # Save our image to the bytesIO buffer, with all of our
             # various user-defined or default config options
@@ -675,7 +1021,7 @@ class DirpyImage: ############################################################
                 # Now write the BytesIO buffer to disk
                 try:
                     self.logger.debug("Saving to disk at '%s'" % todisk_path)
-                    with open(todisk_path, 'w') as out_file:
+                    with open(todisk_path, 'wb') as out_file:
                         self.out_buf.seek(0,os.SEEK_SET)
                         out_file.write(self.out_buf.read())
                 except Exception as e:
@@ -689,6 +1035,12 @@ class DirpyImage: ############################################################
             self.out_size = self.out_buf.tell()
             self.out_buf.seek(0)
 
+            # Put together some image metadata in JSON format
+            self.meta_data["g"]["out_width"]     = self.out_x
+            self.meta_data["g"]["out_height"]    = self.out_y
+            self.meta_data["g"]["out_bytes"]     = self.out_size
+            self.meta_data["ms"]["time_save"]    = time.time() - save_start
+
             # If the user has requested "noshow", we don't want to return the
             # image back to them (presumably because we have saved it to disk
             # and that is all they care about, so we don't have to waste
@@ -696,12 +1048,7 @@ class DirpyImage: ############################################################
             if noshow:
                 logger.debug("Not showing %s, as requested" % self.file_path)
                 self.out_buf = io.BytesIO()
-
-            # Put together some image metadata in JSON format
-            self.meta_data["g"]["out_width"]     = self.out_x
-            self.meta_data["g"]["out_height"]    = self.out_y
-            self.meta_data["g"]["out_bytes"]     = self.out_size
-            self.meta_data["ms"]["time_save"]    = time.time() - save_start
+                self.out_size = 0
 
             self.meta_data["c"]["out_fmt_" + self.out_fmt] = 1
 
@@ -714,6 +1061,380 @@ class DirpyImage: ############################################################
                 (self.file_path, e))
 
 
+    # Admit ourselves for running admit_cmds (see admit()), once we know
+    # the dimensions of our source image
+    def _admit(self):
+        if self.admit_cmds is not None:
+            cmds, self.admit_cmds = self.admit_cmds, None
+            self.reserved = admit(self, cmds)
+
+    # Add the time elapsed since start to a (possibly repeated) operation's
+    # timing measurement
+    def _add_time(self, name, start):
+        self.meta_data["ms"][name] = (
+            self.meta_data["ms"].get(name, 0) + time.time() - start)
+
+    # Stream our proxied source image into a buffer, giving up as soon as it
+    # grows past proxy_max_bytes.  While it downloads, we also try to parse
+    # its header, so that images with too many pixels are rejected without
+    # having to download them in full.  If the decode cache holds an expired
+    # copy of the source, we ask the origin whether it has changed, and keep
+    # using our copy (and its decodes) if not
+    def _fetch_proxy(self):
+        fetch_start = time.time()
+        stale = decode_cache.get(self.src_key) if decode_cache else None
+        headers = {}
+        if stale and stale.validator:
+            headers = validator_headers(stale.validator)
+        proxy_res, conn, origin = self._proxy_request(self.file_path,
+            headers)
+
+        if proxy_res.status == 304 and stale:
+            proxy_res.read()
+            if proxy_res.will_close:
+                conn.close()
+            else:
+                proxy_pool.put(origin[0], origin[1], conn)
+            stale.expires = time.time() + cfg.decode_cache_ttl
+            decode_cache.put(self.src_key, stale, stale.nbytes)
+            self.meta_data["c"]["source_cache_revalidated"] = 1
+            self.meta_data["ms"]["time_proxy_fetch"] = (
+                time.time() - fetch_start)
+            return self._use_source(stale)
+
+        try:
+            max_bytes = cfg.proxy_max_bytes
+            too_big = DirpyUserError("Proxied image exceeds %s bytes" %
+                max_bytes, 413)
+
+            # Remember how to check whether the source has changed later on
+            self.src_validator = proxy_validator(proxy_res)
+
+            # Don't even start downloading if the origin tells us it's too big
+            length = proxy_res.getheader("Content-Length")
+            if max_bytes and length and length.isdigit() and \
+                    int(length) > max_bytes:
+                raise too_big
+
+            file_obj = io.BytesIO()
+            header_done = not (cfg.max_pixels or self.admit_cmds)
+            probe_at = PROXY_CHUNK_SIZE
+            while True:
+                chunk = proxy_res.read(PROXY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_obj.write(chunk)
+                if max_bytes and file_obj.tell() > max_bytes:
+                    raise too_big
+
+                # Image headers are almost always near the start of a file;
+                # past that, leave it to our usual check in load().  We only
+                # try parsing each time the download doubles in size, so the
+                # copies that takes add up to no more than twice the header
+                if not header_done and file_obj.tell() >= probe_at:
+                    probe_at *= 2
+                    header_done = file_obj.tell() > PROXY_HEADER_BYTES
+                    try:
+                        im_head = Image.open(io.BytesIO(file_obj.getvalue()))
+                    except Exception as e:
+                        # Pillow refuses to even open the worst offenders
+                        if isinstance(e, getattr(Image,
+                                "DecompressionBombError", ())):
+                            raise DirpyUserError(
+                                "Error opening image: %s" % e, 400)
+                        continue
+                    header_done = True
+                    self.in_x, self.in_y = im_head.size
+                    self.in_fmt = im_head.format.lower()
+                    if cfg.max_pixels and \
+                            self.in_x * self.in_y > cfg.max_pixels:
+                        raise DirpyUserError("Error opening image: "
+                            "Image exceeds maximum pixel limit", 400)
+
+                    # Don't download heavy images while we're too busy to
+                    # render them anyway
+                    self._admit()
+        except:
+            conn.close()
+            raise
+
+        # We read the whole response, so the connection can be reused
+        if proxy_res.will_close:
+            conn.close()
+        else:
+            proxy_pool.put(origin[0], origin[1], conn)
+
+        self.in_size = file_obj.tell()
+        file_obj.seek(0)
+        self.meta_data["ms"]["time_proxy_fetch"] = time.time() - fetch_start
+        self._cache_source(file_obj.getvalue(),
+            time.time() + cfg.decode_cache_ttl)
+        return file_obj
+
+    # Send a GET request for a proxied URL over a pooled connection,
+    # following any redirects.  Returns the (successful, or not modified)
+    # response, along with its connection and the origin (scheme and host)
+    # it belongs to
+    def _proxy_request(self, url, headers=None):
+        headers = dict(headers or {}, **{"User-Agent": "Dirpy/" + __version__})
+        for i in range(PROXY_MAX_REDIRECTS + 1):
+            parsed = urlparse.urlsplit(url)
+            origin = (parsed.scheme.lower(), parsed.netloc)
+            if origin[0] not in ("http", "https"):
+                raise DirpyUserError("Unsupported proxy URL: %s" % url, 400)
+            path = parsed.path or "/"
+            if parsed.query:
+                path += "?" + parsed.query
+
+            # A reused connection may have been closed by the origin while
+            # it sat in our pool, so retry those once on a fresh connection
+            conn, reused = proxy_pool.get(*origin)
+            try:
+                conn.request("GET", path, headers=headers)
+                proxy_res = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                conn, reused = proxy_pool.get(origin[0], origin[1], True)
+                conn.request("GET", path, headers=headers)
+                proxy_res = conn.getresponse()
+
+            counter = "proxy_pool_hit" if reused else "proxy_pool_miss"
+            self.meta_data["c"][counter] = (
+                self.meta_data["c"].get(counter, 0) + 1)
+
+            if proxy_res.status in (200, 304):
+                return proxy_res, conn, origin
+
+            location = proxy_res.getheader("Location")
+            conn.close()
+            if proxy_res.status not in (301, 302, 303, 307, 308) or \
+                    not location:
+                raise DirpyFatalError("Error reading file: HTTP %s %s" %
+                    (proxy_res.status, proxy_res.reason), proxy_res.status)
+            url = urlparse.urljoin(url, location)
+
+        raise DirpyFatalError("Error reading file: too many redirects", 502)
+
+    # Check whether our (cached) result's source image has changed since it
+    # was rendered: local files by their mtime and size, and proxied files
+    # with a conditional GET.  Proxied files without an ETag or Last-Modified
+    # header can't be checked, so they are always considered to be changed,
+    # as are those that the origin refuses with a 4xx error (just as deleted
+    # local files are)
+    def source_changed(self):
+        src_type, location = self.src_id.split(":", 1)
+        if src_type == "file":
+            try:
+                file_stat = os.stat(location)
+            except OSError:
+                return True
+            return self.src_validator != file_validator(file_stat)
+
+        if not self.src_validator:
+            return True
+        try:
+            proxy_res, conn, origin = self._proxy_request(location,
+                validator_headers(self.src_validator))
+        except DirpyError as e:
+            if not 400 <= e.err_code < 500:
+                raise
+            proxy_res = None
+
+        # Don't bother downloading the changed image; we'll fetch it again
+        # when we re-render (making sure not to use our stale decoded copy)
+        if proxy_res is None or proxy_res.status != 304:
+            if proxy_res is not None:
+                conn.close()
+            if decode_cache:
+                decode_cache.discard(self.src_id)
+            return True
+
+        proxy_res.read()
+        if proxy_res.will_close:
+            conn.close()
+        else:
+            proxy_pool.put(origin[0], origin[1], conn)
+        return False
+
+    # Look up our source image (by src_key) in the decode cache, returning a
+    # file object for its encoded data on a hit, or None otherwise
+    def _cached_source(self):
+        if not decode_cache:
+            return None
+
+        entry = decode_cache.get(self.src_key)
+        if not entry or (entry.expires and entry.expires < time.time()):
+            return None
+
+        return self._use_source(entry)
+
+    # Use a decode cache entry as our source image, returning a file object
+    # for its encoded data
+    def _use_source(self, entry):
+        self.src_validator = entry.validator
+
+        self.logger.debug("Using cached source: %s" % self.src_key)
+        self.src_entry = entry
+        self.in_size = len(entry.data)
+        self.meta_data["c"]["source_cache_hit"] = 1
+
+        return io.BytesIO(entry.data)
+
+    # Add our freshly read source image data to the decode cache
+    def _cache_source(self, data, expires):
+        if not decode_cache:
+            return
+
+        self.src_entry = DirpySource(data, expires, self.src_validator)
+        decode_cache.put(self.src_key, self.src_entry, self.src_entry.nbytes)
+        self.meta_data["c"]["source_cache_miss"] = 1
+
+    # Decode our source image ahead of the first operation that needs its
+    # pixels, using a reduced-size JPEG decode if we only need draft_size.
+    # If the source is in our decode cache, reuse the smallest decode of it
+    # that is at least draft_size (or full size), or add our own otherwise
+    def _decode(self, draft_size=None):
+        if self.decoded:
+            return
+        self.decoded = True
+
+        if not self.src_entry:
+            if draft_size:
+                self.im_in.draft(None, draft_size)
+            return
+
+        im_cached = self.src_entry.find(draft_size or (self.in_x, self.in_y))
+        if im_cached is not None:
+            self.logger.debug("Using cached decode: %s" %
+                str(im_cached.size))
+            self.im_in = self.im_shared = im_cached
+            self.meta_data["c"]["decode_cache_hit"] = 1
+            return
+
+        if draft_size:
+            self.im_in.draft(None, draft_size)
+        self.im_in.load()
+        self.meta_data["c"]["decode_cache_miss"] = 1
+
+        # Share our decode through the decode cache, if it fits
+        if self.src_entry.add(self.im_in, decode_cache.max_bytes):
+            self.im_shared = self.im_in
+            decode_cache.put(self.src_key, self.src_entry,
+                self.src_entry.nbytes)
+
+    # Resample the given box of our image (in the src_x by src_y dimensions
+    # that we had before any reduced-size decode) to new_x by new_y, scaling
+    # the box to match the size that our image was actually decoded at.  If
+    # given a reduce gap, the box is first reduced by the largest integer
+    # factor that leaves it at least reduce_gap times our new dimensions.
+    # If clip is set, the image is first cropped down to the box (as a crop
+    # run before a resize would), so that our filter never reads the pixels
+    # outside of it
+    def _resample(self, new_x, new_y, filter_type, box, src_x, src_y,
+            reduce_gap=0, clip=False):
+        kwargs = {}
+        if reduce_gap and RESIZE_GAP:
+            kwargs["reducing_gap"] = reduce_gap
+
+        if box == [0, 0, src_x, src_y]:
+            self.im_in = self.im_in.resize((new_x, new_y), filter_type,
+                **kwargs)
+        else:
+            scale_x = float(self.im_in.size[0]) / src_x
+            scale_y = float(self.im_in.size[1]) / src_y
+            box = [ box[0] * scale_x, box[1] * scale_y,
+                box[2] * scale_x, box[3] * scale_y ]
+
+            # A box that doesn't fall on whole pixels (of a reduced-size
+            # decode) keeps its fractional part inside the cropped image
+            if clip:
+                outer = [ int(math.floor(box[0])), int(math.floor(box[1])),
+                    int(math.ceil(box[2])), int(math.ceil(box[3])) ]
+                self.im_in = self.im_in.crop(outer)
+                box = [ box[0] - outer[0], box[1] - outer[1],
+                    box[2] - outer[0], box[3] - outer[1] ]
+
+            self.im_in = self.im_in.resize((new_x, new_y), filter_type,
+                tuple(box), **kwargs)
+        self.modified = True
+
+    # Find the bounding box of the part of our image that differs from its
+    # top-left pixel by more than the given fuzz (one value for all channels,
+    # or one per channel), or None if the whole image is border.  With NumPy,
+    # we scan strips of lines from each edge inwards, stopping at the first
+    # line of content, so we only ever look at the border itself (and the
+    # content lines just inside of it)
+    def _border_box(self, fuzz):
+        im = self.im_in
+        if numpy is None or im.mode not in BORDER_SCAN_MODES:
+            return self._border_box_diff(fuzz)
+
+        # Content is anything outside of the border color, plus or minus
+        # our fuzz (all of our scanned modes have 8 bit channels)
+        width, height = im.size
+        bg = numpy.array(im.getpixel((0, 0)), dtype=numpy.int16)
+        floor = numpy.clip(bg - fuzz, 0, 255).astype(numpy.uint8)
+        ceil = numpy.clip(bg + fuzz, 0, 255).astype(numpy.uint8)
+
+        # Return the offset of the first (or last) line of content between
+        # start and end, where box gives the box of the lines between lo and
+        # hi, and axis the axis that the lines run along (0 for columns)
+        def scan(start, end, box, axis, last=False):
+            edges = list(range(start, end, BORDER_SCAN_LINES))
+            for lo in (reversed(edges) if last else edges):
+                hi = min(lo + BORDER_SCAN_LINES, end)
+                strip = numpy.asarray(im.crop(box(lo, hi)))
+                content = (strip < floor) | (strip > ceil)
+                if axis:
+                    lines = content.reshape(len(content), -1).any(axis=1)
+                else:
+                    lines = content.any(axis=0)
+                    if lines.ndim == 2:
+                        lines = lines.any(axis=1)
+                found = numpy.flatnonzero(lines)
+                if len(found):
+                    return lo + int(found[-1] + 1 if last else found[0])
+            return None
+
+        rows = lambda lo, hi: (0, lo, width, hi)
+        top = scan(0, height, rows, 1)
+        if top is None:
+            return None
+        bottom = scan(top, height, rows, 1, True)
+        cols = lambda lo, hi: (lo, top, hi, bottom)
+        left = scan(0, width, cols, 0)
+        right = scan(left, width, cols, 0, True)
+
+        return [left, top, right, bottom]
+
+    # Find our image's border (as for _border_box) without NumPy, by doing
+    # an image channel difference against a background of the border color
+    # and getting the bounding box of the result
+    def _border_box_diff(self, fuzz):
+        bg = Image.new(self.im_in.mode, self.im_in.size, 
+            self.im_in.getpixel((0,0)))
+        diff = ImageChops.difference(self.im_in, bg)
+
+        if len(fuzz) == 1:
+            diff = ImageChops.add(diff, diff, 2.0, -fuzz[0])
+        else:
+            mask = None
+            for band, band_fuzz in zip(diff.split(), fuzz):
+                band = band.point(lambda v, f=band_fuzz: 255 if v > f else 0)
+                mask = band if mask is None else ImageChops.lighter(mask, band)
+            diff = mask
+
+        # Newer PILs only look at the alpha channel of images with one by
+        # default, but a border can be any color
+        try:
+            bbox = diff.getbbox(alpha_only=False)
+        except TypeError:
+            bbox = diff.getbbox()
+
+        return list(bbox) if bbox else None
+
     # Iterate through our options keys and see if any of them match the NxN 
     # pattern for image dimensions.  Dropping one of the two image dimensions 
     # is permitted (i.e. '640x480',' '640x' & 'x480' are valid dimensions).
@@ -773,14 +1494,14 @@ class DirpyImage: ############################################################
         elif "e" in self.gravity:
             new_dims[0] = abs(self.out_x - req_x)
         else:
-            new_dims[0]  = abs(self.out_x - req_x)/2
+            new_dims[0]  = abs(self.out_x - req_x)//2
 
         if "n" in self.gravity:
             new_dims[1] = 0
         elif "s" in self.gravity:
             new_dims[1] = abs(self.out_y - req_y)
         else:
-            new_dims[1]  = abs(self.out_y - req_y)/2
+            new_dims[1]  = abs(self.out_y - req_y)//2
 
         new_dims[2] = new_dims[0] + min(req_x, self.out_x)
         new_dims[3] = new_dims[1] + min(req_y, self.out_y)
@@ -792,61 +1513,106 @@ class DirpyImage: ############################################################
     # operations have been completed (although there is nothing stopping
     # you from calling it earlier).  We also send data to statsd here,
     # if applicable, since this seems like the best place to do it
-    def yield_meta_data(self):
+    def yield_meta_data(self, record=True):
         self.meta_data["ms"]["time_total"] = time.time() - self.init_time
 
+        # Add our timings to our metrics histograms, if enabled.  Only
+        # image requests (as opposed to status requests, etc) count
+        if record and stage_metrics and self.meta_data["c"].get("total"):
+            stage_metrics.record(
+                {k.replace("time_", "").replace("_time", ""): v
+                    for k, v in self.meta_data["ms"].items()})
+
         # Convert all timings from fractional seconds to integer milliseconds
         self.meta_data["ms"] = { 
             k: int(v*1000) for k, v in self.meta_data["ms"].items() 
         }
 
-        # Send to statsd if our statsd server has been configured
-        if cfg.statsd_server is not None:
-            udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            addr = (cfg.statsd_server, cfg.statsd_port)
-            # Generate a list of our metrics with their statsd prefixes
-            # attached.  Convert our fractional-second timing measurements
-            # to milliseconds while we are at it
-            pfx = cfg.statsd_prefix
-            metrics = [ "%s.%s:%s|%s\n" % (
-                    pfx, name.replace('_', '.', 1), val, met_type)
-                for met_type, metrics in self.meta_data.items()
-                for name, val in metrics.items()
-            ]
-
-            while metrics:
-                buf = metrics.pop()
-                while metrics and len(buf) + len(metrics[-1]) < 512:
-                    buf += metrics.pop()
+        # Hand off to our statsd client, if our statsd server has been
+        # configured
+        if record and statsd_client:
+            statsd_client.add(self.meta_data)
 
-                try:
-                    udp_sock.sendto(buf.rstrip().encode('utf-8'), addr)
-                except Exception as e:
-                    logger.debug("Failed to send to statsd: %s", e)
-                    
         return json.dumps( 
             {x: y for i, j in self.meta_data.items() for x, y in j.items()}
         )
 
-    # Serialize a specific subset of object values
+    # Serialize a specific subset of object values into a single binary
+    # cache record
     def serialize(self):
-        serialized = {
-            "meta_data":    pickle.dumps(self.meta_data),
-            "out_fmt":      self.out_fmt,
-            "out_size":     self.out_size,
-            "out_buf":      self.out_buf.read()
-        }
-        self.out_buf.seek(0)
-
-        return serialized
-
-    # Deserialize a specific subset of object values
-    def deserialize(self, redis_data):
-        self.meta_data = pickle.loads(redis_data["meta_data"])
-        self.out_fmt = redis_data["out_fmt"]
-        self.out_size = redis_data["out_size"]
-        self.out_buf.write(redis_data["out_buf"])
-        self.out_buf.seek(0)
+        fmt_str = self.out_fmt.encode("utf-8")
+        meta_str = json.dumps(self.meta_data).encode("utf-8")
+        src_str = (self.src_id or "").encode("utf-8")
+        validator_str = (self.src_validator or "").encode("utf-8")
+        out_data = self.out_buf.getvalue()
+
+        return b"".join([
+            self.record_header.pack(self.record_magic, self.record_version,
+                len(fmt_str), len(meta_str), len(out_data), len(src_str),
+                len(validator_str), self.validated),
+            fmt_str, meta_str, src_str, validator_str, out_data])
+
+    # Deserialize a specific subset of object values from a serialize()
+    # cache record.  The image data is served straight out of the record
+    # buffer, rather than being copied into a new BytesIO object
+    def deserialize(self, record):
+        record = memoryview(record)
+        (magic, version, fmt_len, meta_len, out_size, src_len,
+            validator_len, validated) = self.record_header.unpack_from(record)
+        if magic != self.record_magic or version != self.record_version:
+            raise ValueError("Unknown cache record format")
+
+        fmt_start = self.record_header.size
+        meta_start = fmt_start + fmt_len
+        src_start = meta_start + meta_len
+        validator_start = src_start + src_len
+        out_start = validator_start + validator_len
+
+        self.out_fmt = str(
+            record[fmt_start:meta_start].tobytes().decode("utf-8"))
+        self.meta_data = collections.defaultdict(dict, json.loads(
+            record[meta_start:src_start].tobytes().decode("utf-8")))
+        self.src_id = (record[src_start:validator_start].tobytes().decode(
+            "utf-8") or None)
+        self.src_validator = (record[validator_start:out_start].tobytes(
+            ).decode("utf-8") or None)
+        self.validated = validated
+        self.out_size = out_size
+        self.out_buf = DirpyBufferReader(
+            record[out_start:out_start + out_size])
+
+    # Snapshot the same subset of object values as serialize(), but without
+    # encoding anything, for use by the in-process result cache
+    def snapshot(self):
+        return (copy.deepcopy(self.meta_data), self.out_fmt, self.out_size,
+            self.src_id, self.src_validator, self.validated,
+            self.out_buf.getvalue())
+
+    # Restore object values from a snapshot() tuple
+    def restore(self, snapshot):
+        (meta_data, self.out_fmt, self.out_size, self.src_id,
+            self.src_validator, self.validated, out_data) = snapshot
+        self.meta_data = copy.deepcopy(meta_data)
+        self.out_buf = DirpyBufferReader(out_data)
+
+    # Return a copy of this object that further commands can be run against
+    # without affecting the original, i.e. to render several variants of
+    # the same loaded image.  Image objects are shared, since our commands
+    # never modify them in place (and save() works on a copy of any shared
+    # image, be it from the decode cache or from the object we branched from)
+    def branch(self):
+        branch_obj = copy.copy(self)
+        branch_obj.im_shared    = self.im_in
+        branch_obj.req_dims     = list(self.req_dims)
+        branch_obj.save_opts    = dict(self.save_opts)
+        branch_obj.meta_data    = copy.deepcopy(self.meta_data)
+        branch_obj.out_buf      = io.BytesIO()
+
+        return branch_obj
+
+    # Return the MIME type of our output
+    def get_content_type(self):
+        return self.content_type or "image/%s" % self.out_fmt
 
     # Our HTTP-specific result
     def result(self, http_code, http_msg=None):
@@ -856,6 +1622,80 @@ class DirpyImage: ############################################################
         return self
 
 
+# A source image held in the decode cache: its encoded data, along with any
+# decoded copies of it (some of which may be reduced-size draft decodes).
+# Entries are shared by all of our threads, so their decodes are guarded by
+# a lock
+class DirpySource: ###########################################################
+
+    def __init__(self, data, expires, validator=None):
+        self.data       = data
+        self.expires    = expires
+        self.validator  = validator
+        self.decodes    = {}
+        self.nbytes     = len(data)
+        self.lock       = threading.Lock()
+
+    # Add a (fully loaded) decoded image, unless it would take us over
+    # max_bytes.  Returns whether the image was added
+    def add(self, im, max_bytes):
+        im_bytes = im.size[0] * im.size[1] * len(im.getbands())
+        with self.lock:
+            if im.size in self.decodes or self.nbytes + im_bytes > max_bytes:
+                return False
+            self.decodes[im.size] = im
+            self.nbytes += im_bytes
+
+        return True
+
+    # Return the smallest decoded image at least as large as size, if any
+    def find(self, size):
+        found = None
+        with self.lock:
+            for dims, im in self.decodes.items():
+                if dims[0] >= size[0] and dims[1] >= size[1]:
+                    if (found is None or dims[0] * dims[1] <
+                            found.size[0] * found.size[1]):
+                        found = im
+
+        return found
+
+
+# A minimal read-only file object over an existing buffer (such as a cache
+# record), so that cached images can be served without first copying them
+# into a fresh BytesIO object
+class DirpyBufferReader: #####################################################
+
+    def __init__(self, buf):
+        self.view = memoryview(buf)
+        self.pos  = 0
+
+    def read(self, size=-1):
+        end = len(self.view)
+        if size is not None and size >= 0:
+            end = min(self.pos + size, end)
+        chunk = self.view[self.pos:end].tobytes()
+        self.pos = end
+        return chunk
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += len(self.view)
+        self.pos = max(0, min(pos, len(self.view)))
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def getvalue(self):
+        return self.view.tobytes()
+
+    def getbuffer(self):
+        return self.view
+
+
 # HTTP Result code w/ matching string
 class HttpResult(): ##########################################################
     codes = {
@@ -869,6 +1709,9 @@ class HttpResult(): ##########################################################
         403: "Forbidden",
         404: "Not Found",
         405: "Method Not Allowed",
+        411: "Length Required",
+        413: "Payload Too Large",
+        431: "Request Header Fields Too Large",
         500: "Internal Server Error",
         501: "Not Implemented",
         502: "Bad Gateway",
@@ -903,6 +1746,1004 @@ class DirpyUserError(DirpyError): ############################################
     pass
 
 
+# Dirpy Overload Error class, for requests that we shed
+class DirpyOverloadError(DirpyError): ########################################
+    pass
+
+
+# A bounded LRU cache with a byte-size limit.  Used to keep hot results
+# inside each worker process, in front of our (remote) redis cache
+class DirpyLruCache: #########################################################
+
+    def __init__(self, max_bytes):
+        self.max_bytes  = max_bytes
+        self.cur_bytes  = 0
+        self.entries    = collections.OrderedDict()
+        self.lock       = threading.Lock()
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+
+    # Fetch an entry (or None), marking it as the most recently used
+    def get(self, key):
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    # Insert an entry, evicting the least recently used entries until it
+    # fits inside our byte limit.  Returns the number of entries evicted
+    def put(self, key, value, size):
+        evicted = 0
+
+        # Don't let a single oversized entry flush the entire cache (and
+        # don't keep an older version of it either, as the caller may have
+        # grown the value that we're holding)
+        if size > self.max_bytes:
+            self.discard(key)
+            return evicted
+
+        with self.lock:
+            if key in self.entries:
+                self.cur_bytes -= self.entries.pop(key)[1]
+
+            while self.entries and self.cur_bytes + size > self.max_bytes:
+                self.cur_bytes -= self.entries.popitem(last=False)[1][1]
+                evicted += 1
+
+            self.entries[key] = (value, size)
+            self.cur_bytes += size
+            self.evictions += evicted
+
+        return evicted
+
+    # Remove an entry, if we have it
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.cur_bytes -= self.entries.pop(key)[1]
+
+
+# A result cache shared by all worker processes on a host via a memory
+# mapped file.  The file is split into a fixed table of equally sized slots,
+# each holding a single cache record.  A key can live in any of a small set
+# of slots (its probe set), with CLOCK-style eviction inside that set.
+# Reads are lock-free: each slot carries a sequence number which is odd
+# while a write is in progress, and readers discard anything that was
+# modified underneath them.  Writers lock the slot's byte range instead.
+# The slot table follows a small file header recording the version and
+# geometry of the table, so that we never trust slots written by another
+# version (or configuration) of the cache
+class DirpyShmCache: #########################################################
+
+    # File header: magic, version, number of slots and slot size
+    file_header = struct.Struct("=4sB3xII")
+    file_magic  = b"DSHM"
+    file_version = 1
+
+    # Slot header: sequence number, CLOCK reference bit, key digest & length
+    slot_header = struct.Struct("=QB3x20sI")
+    num_probes  = 8
+
+    def __init__(self, path, num_slots, slot_bytes, reset=False):
+        self.num_slots  = num_slots
+        self.slot_bytes = (max(slot_bytes, self.slot_header.size) + 7) & ~7
+        self.max_record = self.slot_bytes - self.slot_header.size
+        self.lock       = threading.Lock()
+
+        size = self.file_header.size + self.num_slots * self.slot_bytes
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+
+        # Start out empty if asked to (i.e. when our server starts up), or
+        # if the file was left behind by a different version of the cache
+        header = self.file_header.pack(self.file_magic, self.file_version,
+            self.num_slots, self.slot_bytes)
+        if reset or self.mm[:self.file_header.size] != header:
+            self.clear(header)
+
+    # Empty every slot and write our file header.  We hold a lock on the
+    # whole file while we do, so that sibling processes skip their writes
+    def clear(self, header):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            for i in range(self.num_slots):
+                off = self.file_header.size + i * self.slot_bytes
+                seq = struct.unpack_from("=Q", self.mm, off)[0]
+                self.slot_header.pack_into(self.mm, off, (seq | 1) + 1, 0,
+                    b"", 0)
+            self.mm[:self.file_header.size] = header
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    # Return the slot offsets that a given key digest may be stored in
+    def _probe(self, digest):
+        start = struct.unpack_from("!I", digest)[0]
+        return [ self.file_header.size +
+            (start + i) % self.num_slots * self.slot_bytes
+            for i in range(min(self.num_probes, self.num_slots)) ]
+
+    # Fetch a record (or None) without taking any locks
+    def get(self, key):
+        digest = binascii.unhexlify(key)
+        hdr_size = self.slot_header.size
+
+        for off in self._probe(digest):
+            seq, ref, slot_key, length = self.slot_header.unpack_from(
+                self.mm, off)
+            if seq & 1 or slot_key != digest:
+                continue
+
+            record = self.mm[off + hdr_size:off + hdr_size + length]
+
+            # Throw the read away if a writer got to this slot in the
+            # meantime
+            if struct.unpack_from("=Q", self.mm, off)[0] != seq:
+                return None
+
+            if not ref:
+                struct.pack_into("=B", self.mm, off + 8, 1)
+
+            return record
+
+        return None
+
+    # Store a record, evicting another record from the key's probe set if
+    # needed.  Returns True if the record was written
+    def put(self, key, record):
+        if len(record) > self.max_record:
+            return False
+
+        digest = binascii.unhexlify(key)
+        hdr_size = self.slot_header.size
+
+        with self.lock:
+
+            # Reuse the slot already holding this key or an empty slot if
+            # we have one, otherwise give each slot a second chance by
+            # clearing its reference bit before picking it as the victim
+            victim = None
+            slots = self._probe(digest)
+            for off in slots:
+                seq, ref, slot_key, length = self.slot_header.unpack_from(
+                    self.mm, off)
+                if slot_key == digest or not length:
+                    victim = off
+                    break
+            if victim is None:
+                for off in slots + slots:
+                    if self.mm[off + 8:off + 9] == b"\x00":
+                        victim = off
+                        break
+                    struct.pack_into("=B", self.mm, off + 8, 0)
+
+            # Lock the slot against writers in sibling processes; if
+            # someone else is already writing to it, just skip this write
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB,
+                    self.slot_bytes, victim)
+            except (IOError, OSError):
+                return False
+
+            try:
+                seq = struct.unpack_from("=Q", self.mm, victim)[0] | 1
+                struct.pack_into("=Q", self.mm, victim, seq)
+                self.mm[victim + hdr_size:
+                    victim + hdr_size + len(record)] = record
+                self.slot_header.pack_into(self.mm, victim, seq, 1, digest,
+                    len(record))
+                struct.pack_into("=Q", self.mm, victim, seq + 1)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_bytes, victim)
+
+        return True
+
+
+# A result cache stored on local disk, with each serialized record stored
+# in its own file under a root directory (optionally fanned out into
+# sub-directories based on the cache key).  Records are written to a
+# temporary file and renamed into place, so readers never see a partial
+# file.  The cache is kept under its size limit by periodically calling
+# sweep(), which removes the least recently used files (i.e. those with the
+# oldest mtimes, which we bump on read).  A running total of the bytes used
+# is kept in a small file shared by all processes, so that sweep() only has
+# to walk the cache when it is over its limit (or the total is due a recount)
+class DirpyDiskCache: ########################################################
+
+    touch_interval   = 60     # Minimum seconds between mtime bumps
+    tmp_max_age      = 3600   # Age after which orphaned temp files go
+    sweep_low_water  = 0.9    # Sweep down to this fraction of max_bytes
+    recount_interval = 3600   # Seconds between full recounts of bytes used
+
+    # The running total: bytes used, and the time of the last full recount
+    usage_struct = struct.Struct("=qd")
+
+    def __init__(self, root, max_bytes, fanout):
+        self.root       = os.path.abspath(root)
+        self.max_bytes  = max_bytes
+        self.fanout     = fanout
+        self.lock       = threading.Lock()
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        self.usage_fd = os.open(os.path.join(self.root, ".usage"),
+            os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.usage_fd).st_size < self.usage_struct.size:
+            os.ftruncate(self.usage_fd, self.usage_struct.size)
+        self.usage_mm = mmap.mmap(self.usage_fd, self.usage_struct.size)
+
+    # Return the on-disk path for a cache key
+    def _path(self, key):
+        shards = [ key[i*2:i*2+2] for i in range(self.fanout) ]
+        return os.path.join(self.root, *(shards + [key]))
+
+    # Fetch a record (or None)
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                record = fh.read()
+                mtime = os.fstat(fh.fileno()).st_mtime
+        except (IOError, OSError):
+            return None
+
+        # Mark this file as recently used (but don't do so on every read)
+        if time.time() - mtime > self.touch_interval:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+        return record
+
+    # Atomically store a record
+    def put(self, key, record):
+        path = self._path(key)
+        tmp_path = "%s.%s.%s.tmp" % (path, os.getpid(),
+            threading.current_thread().ident)
+
+        try:
+            try:
+                out_file = open(tmp_path, "wb")
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if not (e.errno == errno.EEXIST
+                            and os.path.isdir(os.path.dirname(path))):
+                        raise
+                out_file = open(tmp_path, "wb")
+
+            with out_file:
+                out_file.write(record)
+
+            # Account for any record we are replacing
+            try:
+                old_size = os.stat(path).st_size
+            except OSError:
+                old_size = 0
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self._update_usage(len(record) - old_size)
+
+        return True
+
+    # Return the running total of bytes used, along with the time that it
+    # was last recounted
+    def usage(self):
+        with self.lock:
+            fcntl.lockf(self.usage_fd, fcntl.LOCK_SH)
+            try:
+                return self.usage_struct.unpack_from(self.usage_mm)
+            finally:
+                fcntl.lockf(self.usage_fd, fcntl.LOCK_UN)
+
+    # Add to the running total of bytes used, or replace it with a recount
+    # (and the time that it was taken)
+    def _update_usage(self, delta, recount_time=None):
+        with self.lock:
+            fcntl.lockf(self.usage_fd, fcntl.LOCK_EX)
+            try:
+                used, counted = self.usage_struct.unpack_from(self.usage_mm)
+                if recount_time is not None:
+                    counted = recount_time
+                self.usage_struct.pack_into(self.usage_mm, 0,
+                    max(used + delta, 0), counted)
+            finally:
+                fcntl.lockf(self.usage_fd, fcntl.LOCK_UN)
+
+    # Remove least recently used files until we are under our size limit.
+    # The cache is only walked if our running total says that it is over
+    # its limit, or it is time to recount it.  Only one process sweeps a
+    # given cache root at a time
+    def sweep(self):
+        lock_fd = os.open(os.path.join(self.root, ".sweep.lock"),
+            os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return 0
+
+            now = time.time()
+            start_bytes, counted = self.usage()
+            if (start_bytes <= self.max_bytes and
+                    now - counted < self.recount_interval):
+                return 0
+
+            files = []
+            total_bytes = 0
+            for dir_path, dir_names, file_names in os.walk(self.root):
+                for file_name in file_names:
+                    if file_name.startswith("."):
+                        continue
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+
+                    # Clean up temp files orphaned by crashed writers
+                    if file_name.endswith(".tmp"):
+                        if now - st.st_mtime > self.tmp_max_age:
+                            self._unlink(path)
+                        continue
+
+                    files.append((st.st_mtime, st.st_size, path))
+                    total_bytes += st.st_size
+
+            removed = 0
+            if total_bytes > self.max_bytes:
+                files.sort()
+                low_water = self.max_bytes * self.sweep_low_water
+                for mtime, size, path in files:
+                    if total_bytes <= low_water:
+                        break
+                    if self._unlink(path):
+                        total_bytes -= size
+                        removed += 1
+
+            # Replace our running total with what we counted, keeping
+            # anything that was written while we were counting
+            self._update_usage(total_bytes - start_bytes, now)
+
+            logger.debug("Disk cache sweep removed %s file(s); %s bytes used"
+                % (removed, total_bytes))
+            return removed
+
+        finally:
+            os.close(lock_fd)
+
+    # Remove a file, ignoring any errors
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+            return True
+        except OSError:
+            return False
+
+
+# Coalesces concurrent renders of the same cache key ("single flight"), so
+# that only one request renders a given result while identical requests
+# wait for it to show up in the cache.  Requests inside a single process
+# wait on a thread lock of their own key, while requests in sibling worker
+# processes wait on either a byte-range lock in a shared lock file (at an
+# offset taken from the key) or a redis lock.  If the request rendering a
+# result fails, it records its error, and the requests that were waiting
+# on it fail with that error straight away instead of each rendering the
+# result in turn
+class DirpyFlightLock: #######################################################
+
+    poll_time   = 0.01
+
+    # Failures are recorded in a table at the start of the lock file, with
+    # each slot holding a key digest, the time of the failure, its HTTP code
+    # and Retry-After value and the length of the error message that follows
+    fail_slots  = 4096
+    fail_bytes  = 256
+    fail_header = struct.Struct("=20sdHHH")
+
+    # Only delete a redis lock if we still own it
+    redis_release = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end")
+
+    def __init__(self, mode, lock_file, timeout_ms):
+        self.mode       = mode
+        self.timeout    = timeout_ms / 1000.0
+        self.lock       = threading.Lock()
+        self.keys       = {}
+        self.fd         = None
+
+        if self.mode == "file":
+            size = self.fail_slots * self.fail_bytes
+            self.fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+            self.mm = mmap.mmap(self.fd, size)
+
+    # Acquire the lock for a key, waiting at most our timeout for anyone
+    # already holding it.  The returned flight object records whether we
+    # had to wait (in which case the caller should check the cache, and
+    # then failure(), again) and must be passed back to release()
+    def acquire(self, key):
+        flight = DirpyFlight(key,
+            self.fail_slots * self.fail_bytes + int(key[:15], 16))
+        deadline = flight.start + self.timeout
+
+        # Lock out other threads in our own process first.  Each key's
+        # thread lock lives for as long as anyone is using it
+        with self.lock:
+            flight.entry = self.keys.setdefault(key, [threading.Lock(), 0])
+            flight.entry[1] += 1
+        while not flight.entry[0].acquire(False):
+            flight.waited = True
+            if time.time() > deadline:
+                return flight
+            time.sleep(self.poll_time)
+        flight.local = True
+
+        # Then lock out our sibling processes
+        while not self._try_acquire(flight):
+            flight.waited = True
+            if time.time() > deadline:
+                return flight
+            time.sleep(self.poll_time)
+        flight.shared = True
+
+        return flight
+
+    # Release whichever locks we managed to acquire for a flight
+    def release(self, flight):
+        if flight.shared:
+            try:
+                if self.mode == "file":
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, flight.offset)
+                elif self.mode == "redis":
+                    redis_client.eval(self.redis_release, 1,
+                        flight.key + ":flight", flight.token)
+            except Exception as e:
+                logger.debug("Failed to release flight lock: %s" % e)
+            flight.shared = False
+
+        if flight.local:
+            flight.entry[0].release()
+            flight.local = False
+
+        if flight.entry:
+            with self.lock:
+                flight.entry[1] -= 1
+                if not flight.entry[1]:
+                    del self.keys[flight.key]
+            flight.entry = None
+
+    # Record that a flight's render failed with the given HTTP code, message
+    # and Retry-After value, for the requests that are waiting on it
+    def fail(self, flight, http_code, http_msg, retry_after):
+        msg = (http_msg or "").encode("utf-8")[
+            :self.fail_bytes - self.fail_header.size]
+        try:
+            if self.mode == "file":
+                off = self._fail_slot(flight.key)
+                with self.lock:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX, self.fail_bytes, off)
+                    try:
+                        self.fail_header.pack_into(self.mm, off,
+                            binascii.unhexlify(flight.key), time.time(),
+                            http_code, retry_after or 0, len(msg))
+                        msg_off = off + self.fail_header.size
+                        self.mm[msg_off:msg_off + len(msg)] = msg
+                    finally:
+                        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.fail_bytes,
+                            off)
+            elif self.mode == "redis":
+                redis_client.set(flight.key + ":failed", json.dumps(
+                    [time.time(), http_code, retry_after or 0,
+                    msg.decode("utf-8", "ignore")]),
+                    px=int(self.timeout * 1000))
+        except Exception as e:
+            logger.debug("Failed to record flight failure: %s" % e)
+
+    # Return the HTTP code, message and Retry-After value of a render of our
+    # flight's key that failed while we were waiting for it, if there was one
+    def failure(self, flight):
+        try:
+            if self.mode == "file":
+                off = self._fail_slot(flight.key)
+                with self.lock:
+                    fcntl.lockf(self.fd, fcntl.LOCK_SH, self.fail_bytes, off)
+                    try:
+                        (digest, fail_time, http_code, retry_after,
+                            msg_len) = self.fail_header.unpack_from(
+                            self.mm, off)
+                        msg_off = off + self.fail_header.size
+                        msg = self.mm[msg_off:msg_off + msg_len]
+                    finally:
+                        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.fail_bytes,
+                            off)
+                if digest != binascii.unhexlify(flight.key):
+                    return None
+                msg = msg.decode("utf-8", "ignore")
+            elif self.mode == "redis":
+                failed = redis_client.get(flight.key + ":failed")
+                if not failed:
+                    return None
+                fail_time, http_code, retry_after, msg = json.loads(
+                    failed.decode("utf-8"))
+        except Exception as e:
+            logger.debug("Failed to read flight failure: %s" % e)
+            return None
+
+        if fail_time < flight.start:
+            return None
+
+        return http_code, msg, retry_after or None
+
+    # Return the offset of the failure table slot for a key
+    def _fail_slot(self, key):
+        return int(key[:8], 16) % self.fail_slots * self.fail_bytes
+
+    # Try to take the cross-process lock for a flight without blocking
+    def _try_acquire(self, flight):
+        try:
+            if self.mode == "file":
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1,
+                    flight.offset)
+                return True
+            elif self.mode == "redis":
+                return bool(redis_client.set(flight.key + ":flight",
+                    flight.token, nx=True, px=int(self.timeout * 1000)))
+        except (IOError, OSError):
+            return False
+        except Exception as e:
+            # If redis is unavailable, don't hold up the request
+            logger.debug("Failed to acquire flight lock: %s" % e)
+            return True
+
+        return True
+
+
+# The state of a single DirpyFlightLock acquisition
+class DirpyFlight: ###########################################################
+    def __init__(self, key, offset):
+        self.key    = key
+        self.offset = offset
+        self.token  = "%s:%s:%s" % (socket.gethostname(), os.getpid(),
+            threading.current_thread().ident)
+        self.start  = time.time()
+        self.entry  = None
+        self.waited = False
+        self.local  = False
+        self.shared = False
+
+
+# Per-stage request timing histograms, shared between our worker processes.
+# Each worker claims its own region of an anonymous shared memory map (which
+# must be created before forking), so that it can update its histograms
+# without any cross-process locking; regions are summed when read
+class DirpyMetrics: ##########################################################
+
+    # The stages we keep histograms of, and the upper bounds (in seconds) of
+    # our histogram buckets: four per doubling, from 0.5ms up to ~65 seconds
+    stages = ("load", "proxy_fetch", "resize", "crop", "pad", "transpose",
+        "save", "cache_read", "cache_write", "coalesce", "total")
+    bounds = tuple(0.0005 * 2 ** (i / 4.0) for i in range(69))
+
+    pid_fmt = struct.Struct("=Q")
+    count_fmt = struct.Struct("=Q")
+    sum_fmt = struct.Struct("=d")
+
+    def __init__(self, num_regions):
+        # Each stage holds a count, a sum and a counter for each bucket
+        # (plus one for measurements that overflow our last bucket)
+        self.stage_bytes    = 16 + 8 * (len(self.bounds) + 1)
+        self.region_bytes   = 8 + self.stage_bytes * len(self.stages)
+        self.num_regions    = num_regions
+        self.mm             = mmap.mmap(-1, self.region_bytes * num_regions)
+        self.claim_lock     = multiprocessing.Lock()
+        self.lock           = threading.Lock()
+        self.region         = None
+        self.pid            = None
+
+    # Add a request's timings (in seconds, keyed by stage) to our histograms
+    def record(self, timings):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._claim()
+            if self.region is None:
+                return
+
+            for i, stage in enumerate(self.stages):
+                if stage not in timings:
+                    continue
+                val = timings[stage]
+                off = self.region + 8 + i * self.stage_bytes
+                bucket = off + 16 + 8 * bisect.bisect_left(self.bounds, val)
+
+                self.count_fmt.pack_into(self.mm, off,
+                    self.count_fmt.unpack_from(self.mm, off)[0] + 1)
+                self.sum_fmt.pack_into(self.mm, off + 8,
+                    self.sum_fmt.unpack_from(self.mm, off + 8)[0] + val)
+                self.count_fmt.pack_into(self.mm, bucket,
+                    self.count_fmt.unpack_from(self.mm, bucket)[0] + 1)
+
+    # Claim a region for this process: either an unused one, or one left
+    # behind by a dead worker (whose counts we carry on from, so that our
+    # exported counters never go backwards)
+    def _claim(self):
+        self.pid = os.getpid()
+        self.region = None
+
+        with self.claim_lock:
+            for i in range(self.num_regions):
+                off = i * self.region_bytes
+                owner = self.pid_fmt.unpack_from(self.mm, off)[0]
+                if owner and owner != self.pid:
+                    try:
+                        os.kill(owner, 0)
+                        continue
+                    except OSError as e:
+                        if e.errno != errno.ESRCH:
+                            continue
+                self.pid_fmt.pack_into(self.mm, off, self.pid)
+                self.region = off
+                return
+
+        logger.warning("No free metrics regions left; not recording metrics")
+
+    # Sum our histograms across all regions, and render them in the
+    # Prometheus text exposition format
+    def render(self):
+        lines = [
+            "# HELP dirpy_stage_seconds Time spent in each stage of a request",
+            "# TYPE dirpy_stage_seconds histogram",
+        ]
+        num_buckets = len(self.bounds) + 1
+        for i, stage in enumerate(self.stages):
+            count, total, buckets = 0, 0.0, [0] * num_buckets
+            for region in range(self.num_regions):
+                off = region * self.region_bytes + 8 + i * self.stage_bytes
+                count += self.count_fmt.unpack_from(self.mm, off)[0]
+                total += self.sum_fmt.unpack_from(self.mm, off + 8)[0]
+                for j in range(num_buckets):
+                    buckets[j] += self.count_fmt.unpack_from(
+                        self.mm, off + 16 + 8 * j)[0]
+
+            cumulative = 0
+            for bound, bucket in zip(self.bounds, buckets):
+                cumulative += bucket
+                lines.append('dirpy_stage_seconds_bucket{stage="%s",le="%g"} '
+                    '%s' % (stage, bound, cumulative))
+            lines.append('dirpy_stage_seconds_bucket{stage="%s",le="+Inf"} %s'
+                % (stage, count))
+            lines.append('dirpy_stage_seconds_sum{stage="%s"} %r' %
+                (stage, total))
+            lines.append('dirpy_stage_seconds_count{stage="%s"} %s' %
+                (stage, count))
+
+        return "\n".join(lines) + "\n"
+
+
+# Host-wide admission control, based on a budget for the estimated cost (in
+# pixels processed) of the requests in flight, and on a limited number of
+# lanes for heavy (i.e. expensive) requests.  Like DirpyMetrics, each worker
+# claims its own slot of an anonymous shared memory map (which must be
+# created before forking) holding the cost and number of heavy requests it
+# has in flight, and the slots are summed when admitting a request
+class DirpyAdmission: ########################################################
+
+    slot_fmt = struct.Struct("=Qqq")
+
+    # How often (in seconds) requests waiting for a heavy lane check for
+    # lanes held by workers that have died
+    reap_interval = 1.0
+
+    def __init__(self, num_slots, budget):
+        self.num_slots      = num_slots
+        self.budget         = budget
+        self.mm             = mmap.mmap(-1, self.slot_fmt.size * num_slots)
+        self.claim_lock     = multiprocessing.Lock()
+        self.lane_freed     = multiprocessing.Condition(self.claim_lock)
+        self.lock           = threading.Lock()
+        self.slot           = None
+        self.pid            = None
+
+    # Return the total cost and number of heavy requests in flight on this
+    # host
+    def in_flight(self):
+        size = self.slot_fmt.size
+        slots = [ self.slot_fmt.unpack_from(self.mm, i * size)
+            for i in range(self.num_slots) ]
+        return sum(slot[1] for slot in slots), sum(slot[2] for slot in slots)
+
+    # Return whether we're already at (or over) our budget, not counting
+    # the requests of any workers that have died
+    def full(self):
+        if not self.budget or self.in_flight()[0] < self.budget:
+            return False
+        with self.claim_lock:
+            return not self._reap() or self.in_flight()[0] >= self.budget
+
+    # Try to reserve a request's cost, returning whether it was admitted.
+    # Requests are always admitted if nothing else is in flight, so that
+    # requests costing more than our whole budget still run (on their own)
+    def acquire(self, cost):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._claim()
+            with self.claim_lock:
+                if not self._fits(cost) and not (self._reap() and
+                        self._fits(cost)):
+                    return False
+                self._add(cost, 0)
+
+        return True
+
+    # Return whether a request's cost fits in our budget
+    def _fits(self, cost):
+        in_flight = self.in_flight()[0]
+        return not (self.budget and in_flight and
+            in_flight + cost > self.budget)
+
+    # Take one of our max_heavy heavy request lanes, waiting up to timeout
+    # seconds for one to be given back (by any worker) if they're all busy.
+    # Returns whether we got one
+    def acquire_lane(self, max_heavy, timeout):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._claim()
+
+        deadline = time.time() + timeout
+        with self.lane_freed:
+            while (self.in_flight()[1] >= max_heavy and
+                    not (self._reap() and self.in_flight()[1] < max_heavy)):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.lane_freed.wait(min(remaining, self.reap_interval))
+            self._add(0, 1)
+
+        return True
+
+    # Give back a cost reserved by acquire(), along with a heavy request
+    # lane taken by acquire_lane() (waking up the requests waiting for one)
+    def release(self, cost, heavy=False):
+        with self.lane_freed:
+            self._add(-cost, -1 if heavy else 0)
+            if heavy:
+                self.lane_freed.notify_all()
+
+    def _add(self, cost, heavy):
+        if self.slot is None:
+            return
+        pid, val, num_heavy = self.slot_fmt.unpack_from(self.mm, self.slot)
+        self.slot_fmt.pack_into(self.mm, self.slot, pid, val + cost,
+            num_heavy + heavy)
+
+    # Clear out the slots of any dead workers (whose requests are no longer
+    # in flight), returning whether there were any.  Call with claim_lock
+    # held
+    def _reap(self):
+        reaped = False
+        for i in range(self.num_slots):
+            off = i * self.slot_fmt.size
+            owner = self.slot_fmt.unpack_from(self.mm, off)[0]
+            if owner and owner != os.getpid() and not self._alive(owner):
+                self.slot_fmt.pack_into(self.mm, off, 0, 0, 0)
+                reaped = True
+
+        return reaped
+
+    # Return whether a worker process is still running
+    def _alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+
+        return True
+
+    # Claim a slot for this process, clearing out the slots of any dead
+    # workers as we go
+    def _claim(self):
+        self.pid = os.getpid()
+        self.slot = None
+
+        with self.claim_lock:
+            for i in range(self.num_slots):
+                off = i * self.slot_fmt.size
+                owner = self.slot_fmt.unpack_from(self.mm, off)[0]
+                if owner and owner != self.pid and self._alive(owner):
+                    continue
+                if self.slot is None:
+                    self.slot_fmt.pack_into(self.mm, off, self.pid, 0, 0)
+                    self.slot = off
+                else:
+                    self.slot_fmt.pack_into(self.mm, off, 0, 0, 0)
+
+        if self.slot is None:
+            logger.warning("No free admission slots left; not tracking our "
+                "requests")
+
+
+# A statsd client that aggregates metrics in memory, and flushes them from a
+# background thread over a single long-lived socket.  Counters are summed,
+# gauges keep their last value and timings are sampled: at most max_samples
+# of each timing are sent per flush (picked uniformly at random), along with
+# their sample rate so that statsd can still count them all.  Everything is
+# packed into as few packets (of at most max_packet bytes) as possible.  Each
+# worker process starts its own flush thread on first use
+class DirpyStatsd: ###########################################################
+
+    def __init__(self, host, port, prefix, flush_ms, max_packet,
+            max_samples):
+        self.addr        = (host, port)
+        self.prefix      = prefix
+        self.flush_ms    = flush_ms
+        self.max_packet  = max_packet
+        self.max_samples = max_samples
+        self.lock        = threading.Lock()
+        self.pid         = None
+        self.sock        = None
+        self._reset()
+
+    def _reset(self):
+        self.counters    = collections.defaultdict(int)
+        self.gauges      = {}
+        self.timers      = collections.defaultdict(lambda: [0, []])
+
+    # Add a request's meta data (counters, gauges and integer millisecond
+    # timings) to our pending metrics
+    def add(self, meta_data):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._start()
+
+            for name, val in meta_data["c"].items():
+                self.counters[name] += val
+            self.gauges.update(meta_data["g"])
+            # Keep a uniform random sample of each timing (reservoir
+            # sampling), along with a count of all of them
+            for name, val in meta_data["ms"].items():
+                timer = self.timers[name]
+                timer[0] += 1
+                if len(timer[1]) < self.max_samples:
+                    timer[1].append(val)
+                else:
+                    pos = random.randrange(timer[0])
+                    if pos < self.max_samples:
+                        timer[1][pos] = val
+
+    # Start our flush thread.  Anything left over from our parent process
+    # was (or will be) flushed by it
+    def _start(self):
+        self.pid = os.getpid()
+        self.sock = None
+        self._reset()
+
+        flusher = threading.Thread(target=self._run)
+        flusher.daemon = True
+        flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_ms / 1000.0)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.debug("Failed to send to statsd: %s", e)
+
+    # Send all of our pending metrics
+    def flush(self):
+        with self.lock:
+            counters, gauges, timers = self.counters, self.gauges, self.timers
+            self._reset()
+
+        lines = []
+        for met_type, metrics in (("c", counters), ("g", gauges)):
+            for name, val in metrics.items():
+                lines.append(self._line(name, val, met_type))
+        for name, (count, vals) in timers.items():
+            rate = float(len(vals)) / count
+            for val in vals:
+                lines.append(self._line(name, val, "ms", rate))
+        if not lines:
+            return
+
+        # Connecting our UDP socket resolves our statsd host just once
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.connect(self.addr)
+
+        packet, size = [], 0
+        for line in lines:
+            if packet and size + len(line) + 1 > self.max_packet:
+                self.sock.send(b"\n".join(packet))
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        self.sock.send(b"\n".join(packet))
+
+    def _line(self, name, val, met_type, rate=1):
+        line = "%s.%s:%s|%s" % (self.prefix, name.replace("_", ".", 1), val,
+            met_type)
+        if rate < 1:
+            line += "|@%.4g" % rate
+        return line.encode("utf-8")
+
+
+# A per-worker pool of keep-alive HTTP(S) connections to our proxy origins,
+# keyed by scheme and host.  Connections are only reused while they have
+# been idle for less than idle_timeout seconds
+class DirpyConnPool: #########################################################
+
+    def __init__(self, max_idle, idle_timeout, connect_timeout, read_timeout):
+        self.max_idle           = max_idle
+        self.idle_timeout       = idle_timeout
+        self.connect_timeout    = connect_timeout
+        self.read_timeout       = read_timeout
+        self.lock               = threading.Lock()
+        self.pid                = None
+        self.idle               = {}
+
+    # Fetch a connection to the given origin, returning it along with
+    # whether or not it is a reused one.  Connections are made directly to
+    # the origin (http_proxy and friends aren't used).  If fresh is set, we
+    # always open a new connection
+    def get(self, scheme, host, fresh=False):
+        now = time.time()
+        with self.lock:
+            # Never share sockets with our parent process
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.idle = {}
+
+            idle = [] if fresh else self.idle.get((scheme, host), [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+
+        return conn, False
+
+    # Return a connection (whose last response has been read in full) to
+    # the pool, or close it if the pool for its origin is already full
+    def put(self, scheme, host, conn):
+        with self.lock:
+            if self.pid == os.getpid():
+                idle = self.idle.setdefault((scheme, host), [])
+                if len(idle) < self.max_idle:
+                    idle.append((conn, time.time()))
+                    return
+
+        conn.close()
+
+
 # Our HTTP Request handler class
 class HttpHandler(http_server.BaseHTTPRequestHandler): #######################
 
@@ -950,10 +2791,17 @@ class HttpTimeoutServer(http_server.HTTPServer): ############################
     # Extend the HTTPServer constructor, so we can grab our timeout at init
     def __init__(self, server, handler, timeout=None):
         self.timeout = timeout
+        self.requests = None
+        self.requests_pid = None
         http_server.HTTPServer.__init__(self, server, handler)
 
-        # Set up our caching connection here, for lack of a better place
-        redis_setup()
+        # Set up our caching layers and metrics here, for lack of a better
+        # place.  Both need to be shared with our (not yet forked) workers
+        cache_setup(True)
+        metrics_setup(cfg.num_workers * 2)
+        admission_setup(cfg.num_workers * 2)
+        statsd_setup()
+        proxy_pool_setup()
 
     # Bind our server and set our socket timeout before we accept connects
     def server_bind(self):
@@ -965,6 +2813,36 @@ class HttpTimeoutServer(http_server.HTTPServer): ############################
         except Exception as e:
             fatal("Failed to bind server: %s" % e)
 
+    # Hand accepted connections off to our pool of worker_threads threads
+    # (started on our first request in each worker process), if we have
+    # one.  Our queue only holds a single connection, so that we stop
+    # accepting connections (and leave them to our sibling processes) while
+    # all of our threads are busy
+    def process_request(self, request, client_address):
+        if cfg.worker_threads <= 1:
+            return http_server.HTTPServer.process_request(self, request,
+                client_address)
+
+        if self.requests_pid != os.getpid():
+            self.requests_pid = os.getpid()
+            self.requests = queue.Queue(1)
+            for i in range(cfg.worker_threads):
+                thread = threading.Thread(target=self._serve_thread)
+                thread.daemon = True
+                thread.start()
+
+        self.requests.put((request, client_address))
+
+    def _serve_thread(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
 
 # Store POST data in a BytesIO object instead of a temp file
 class BytesIoStorage(cgi.FieldStorage):
@@ -980,7 +2858,214 @@ class PostData:
             raise Excepton
         self.file_data = self.form['file']
         self.file_name = self.form['file'].filename
-            
+
+
+# A stand-in for our HttpHandler, so that http_worker can serve requests read
+# by our asyncio server.  The response is collected in memory (as chunks
+# referencing our output buffers) and written out by the event loop once
+# http_worker returns
+class AsyncRequest: ##########################################################
+
+    def __init__(self, command, path, version, headers, body):
+        self.command        = command
+        self.path           = path
+        self.headers        = headers
+        self.rfile          = io.BytesIO(body)
+        self.wfile          = self
+        self.status         = None
+        self.head           = []
+        self.chunks         = []
+        self.headers_done   = False
+        self.keep_alive     = (version == "HTTP/1.1" and
+            headers.get("Connection", "").lower() != "close")
+
+    def send_response(self, code, message=None):
+        self.status = HttpResult(code).resultTxt
+        self.head = [ ("Server", "Dirpy/" + __version__),
+            ("Date", email.utils.formatdate(usegmt=True)) ]
+
+    def send_header(self, name, val):
+        if not self.headers_done:
+            self.head.append((name, str(val)))
+
+    def end_headers(self):
+        self.headers_done = True
+
+    def send_error(self, code, message=None):
+        body = (message or HttpResult(code).resultTxt).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.chunks.append(body)
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    # Return our response's status line and headers.  Responses that can
+    # have a body but have no Content-Length end our keep-alive connection
+    def response_head(self):
+        if self.status is None:
+            self.send_error(500)
+        names = [ name.lower() for name, val in self.head ]
+        if "content-length" not in names and self.command != "HEAD" and \
+                not self.status.startswith(("204", "304")):
+            self.keep_alive = False
+
+        lines = [ "HTTP/1.1 " + self.status ]
+        lines += [ "%s: %s" % header for header in self.head ]
+        lines.append("Connection: " +
+            ("keep-alive" if self.keep_alive else "close"))
+
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+# An asyncio protocol serving HTTP/1.1 (with keep-alive) to a single client.
+# Requests are read by the event loop, and then handed off to a bounded
+# thread pool which runs http_worker (and thus all of the image work, which
+# Pillow mostly runs without holding the GIL) for them.  Slow clients only
+# ever hold up the event loop's buffers, rather than a whole worker
+class DirpyAsyncProtocol: ####################################################
+
+    def __init__(self, loop, executor):
+        self.loop       = loop
+        self.executor   = executor
+        self.transport  = None
+        self.buf        = bytearray()
+        self.busy       = False
+        self.eof        = False
+        self.timer      = None
+        self.writable   = True
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._set_timer()
+
+    def data_received(self, data):
+        self.buf += data
+        if not self.busy:
+            self._next_request()
+
+    # Let any request that's in flight finish before we close
+    def eof_received(self):
+        self.eof = True
+        return self.busy
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._clear_timer()
+
+    # Stop reading requests while the client is slow to read our responses
+    # (or while we're working on one of its requests)
+    def pause_writing(self):
+        self.writable = False
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.writable = True
+        if not self.busy:
+            self.transport.resume_reading()
+
+    # Parse the next complete request in our buffer (if we have one yet)
+    # and hand it off to our thread pool.  We never buffer more than one
+    # request's header and body (up to max_post_bytes), plus whatever the
+    # client sends ahead while we're working on it
+    def _next_request(self):
+        end = self.buf.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.buf) > ASYNC_MAX_HEAD:
+                self._reject(431)
+            return
+
+        try:
+            line, head = bytes(self.buf[:end + 4]).split(b"\r\n", 1)
+            command, path, version = line.decode("latin-1").split()
+            headers = httplib.parse_headers(io.BytesIO(head))
+            length = body_length(headers)
+        except DirpyError as e:
+            return self._reject(e.err_code)
+        except Exception:
+            return self._reject(400)
+
+        start = end + 4
+        if len(self.buf) < start + length:
+            return
+        body = bytes(self.buf[start:start + length])
+        del self.buf[:start + length]
+
+        self.busy = True
+        self.transport.pause_reading()
+        self._clear_timer()
+        req = AsyncRequest(command, path, version, headers, body)
+        future = self.loop.run_in_executor(self.executor, async_worker, req)
+        future.add_done_callback(self._send_response)
+
+    # Write out a response once our thread pool is done with its request
+    def _send_response(self, future):
+        if self.transport is None:
+            return
+
+        try:
+            req = future.result()
+        except Exception:
+            logger.warning(traceback.format_exc())
+            return self.transport.close()
+
+        self.transport.write(req.response_head())
+        for chunk in req.chunks:
+            self.transport.write(chunk)
+        self.busy = False
+
+        if self.eof or not req.keep_alive:
+            return self.transport.close()
+
+        self._set_timer()
+        if self.writable:
+            self.transport.resume_reading()
+        if self.buf:
+            self._next_request()
+
+    def _reject(self, code):
+        self.transport.write(("HTTP/1.1 %s\r\nContent-Length: 0\r\n"
+            "Connection: close\r\n\r\n" %
+            HttpResult(code).resultTxt).encode("latin-1"))
+        self.transport.close()
+
+    # Close idle connections once they reach our timeout
+    def _set_timer(self):
+        self.timer = self.loop.call_later(
+            cfg.req_timeout or ASYNC_IDLE_TIMEOUT, self._timeout)
+
+    def _clear_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def _timeout(self):
+        self.timer = None
+        if self.transport and not self.busy:
+            self.transport.close()
+
+
+# Return the length of a request's body from its headers, raising a user
+# error (with the status code to answer with) if it isn't valid or is larger
+# than max_post_bytes.  We don't read chunked (or otherwise encoded) bodies
+def body_length(headers): ####################################################
+    if headers.get("Transfer-Encoding"):
+        raise DirpyUserError("Length required", 411)
+
+    get_all = getattr(headers, "get_all", None) or headers.getheaders
+    lengths = set(l.strip() for l in get_all("Content-Length") or ["0"])
+    if len(lengths) != 1 or not list(lengths)[0].isdigit():
+        raise DirpyUserError("Invalid Content-Length", 400)
+
+    length = int(lengths.pop())
+    if length > cfg.max_post_bytes:
+        raise DirpyUserError("Request body too large", 413)
+
+    return length
+
 
 # The dirpy_worker wrapper function called when running in standalone mode
 def http_worker(req, method="GET"): ##########################################
@@ -990,6 +3075,11 @@ def http_worker(req, method="GET"): ##########################################
 
     # Read post data, if need be
     if method == "POST":
+        try:
+            body_length(req.headers)
+        except DirpyError as e:
+            req.close_connection = True
+            return req.send_error(e.err_code, str(e))
         try:
             form = BytesIoStorage(
                 fp=req.rfile,
@@ -1003,12 +3093,33 @@ def http_worker(req, method="GET"): ##########################################
         req_post_data = None
 
     # Call the dirpy worker
-    result = dirpy_worker(req_uri_obj, req_post_data)
+    result = dirpy_worker(req_uri_obj, req_post_data, req.headers, method)
 
     # Handle 204/no-content responses
     if result.http_code == 204:
         req.send_response(204)
         req.send_header("Dirpy-Data", result.yield_meta_data())
+        req.end_headers()
+        return
+    # Tell the client that its copy is still good
+    elif result.http_code == 304:
+        req.send_response(304)
+        req.send_header("Dirpy-Data", result.yield_meta_data())
+        for name, val in cache_headers(result):
+            req.send_header(name, val)
+        req.end_headers()
+        return
+    # Tell the client that we're too busy, and when to try again
+    elif result.retry_after:
+        body = result.http_msg.encode("utf-8")
+        req.send_response(result.http_code)
+        req.send_header("Retry-After", str(result.retry_after))
+        req.send_header("Dirpy-Data", result.yield_meta_data())
+        req.send_header("Content-Type", "text/html")
+        req.send_header("Content-Length", str(len(body)))
+        req.end_headers()
+        if method != "HEAD":
+            req.wfile.write(body)
         return
     # Throw an error if required
     elif result.http_msg is not None:
@@ -1016,11 +3127,15 @@ def http_worker(req, method="GET"): ##########################################
         req.send_header("Dirpy-Data", result.yield_meta_data())
         return
 
-    # Now fire off a response to our client
+    # Now fire off a response to our client.  Lazy results don't know their
+    # size, as they were never encoded
     req.send_response(200)
     req.send_header("Dirpy-Data", result.yield_meta_data())
-    req.send_header("Content-Type", "image/%s" % result.out_fmt)
-    req.send_header("Content-Length", str(result.out_size))
+    req.send_header("Content-Type", result.get_content_type())
+    if result.out_size is not None:
+        req.send_header("Content-Length", str(result.out_size))
+    for name, val in cache_headers(result):
+        req.send_header(name, val)
     req.end_headers()
 
     # Don't send actual data if this is a HEAD request
@@ -1028,19 +3143,26 @@ def http_worker(req, method="GET"): ##########################################
         return
 
     # Guard against a broken TCP connection raising an exception
-    # by wrapping the output buffer read/write loop in a try block
+    # by wrapping the output buffer write loop in a try block
     try:
-        while True:
-            buf = result.out_buf.read(4096)
-            if not buf:
-                break
-            req.wfile.write(buf)
+        for chunk in output_chunks(result.out_buf):
+            req.wfile.write(chunk)
     except:
         pass
 
     return
 
 
+# Serve a request read by our asyncio server; run in its thread pool
+def async_worker(req): #######################################################
+    if req.command in ("GET", "HEAD", "POST"):
+        http_worker(req, method=req.command)
+    else:
+        req.send_error(501, "Unsupported method (%r)" % req.command)
+
+    return req
+
+
 # The dirpy_worker wrapper function called when running in uwsgi mode
 def application(env, resp): ##################################################
 
@@ -1052,7 +3174,8 @@ def application(env, resp): ##################################################
         return "Failure reading request data: %s" % e
 
     # Handle POST data, if any
-    if "REQUEST_METHOD" in env and env["REQUEST_METHOD"].upper() == "POST":
+    method = env.get("REQUEST_METHOD", "GET").upper()
+    if method == "POST":
         try:        
             form = BytesIoStorage(fp=env['wsgi.input'], environ=env)
             req_post_data = form['file'].file
@@ -1063,7 +3186,11 @@ def application(env, resp): ##################################################
         req_post_data = None
             
     # Call the dirpy worker
-    result = dirpy_worker(req_uri_obj, req_post_data)
+    req_headers = {
+        "If-None-Match": env.get("HTTP_IF_NONE_MATCH"),
+        "If-Modified-Since": env.get("HTTP_IF_MODIFIED_SINCE"),
+    }
+    result = dirpy_worker(req_uri_obj, req_post_data, req_headers, method)
     http_res = HttpResult(result.http_code)
 
     # Handle 204/no-content responses
@@ -1074,30 +3201,79 @@ def application(env, resp): ##################################################
         ])
         return ""
 
+    # Tell the client that its copy is still good
+    elif result.http_code == 304:
+        resp(http_res.resultTxt, [
+            ("Dirpy-Data", result.yield_meta_data()) ] + cache_headers(result))
+        return ""
+
     # Handle any errors
     elif result.http_msg is not None:
-        resp(http_res.resultTxt, [
+        headers = [
             ("Dirpy-Data", result.yield_meta_data()),
             ("Content-Type","text/html")
-        ])
+        ]
+        if result.retry_after:
+            headers.append(("Retry-After", str(result.retry_after)))
+        resp(http_res.resultTxt, headers)
         return result.http_msg
 
-    # Now fire off a response to our client
+    # Now fire off a response to our client.  Lazy results don't know their
+    # size, as they were never encoded
     logger.debug("out_size: %s" % result.out_size)
-    resp("200 OK", [
+    headers = [
         ("Dirpy-Data", str(result.yield_meta_data())),
-        ("Content-Type", "image/%s" % str(result.out_fmt)),
-        ("Content-Length", str(result.out_size)) ]
-    )
+        ("Content-Type", str(result.get_content_type())) ]
+    if result.out_size is not None:
+        headers.append(("Content-Length", str(result.out_size)))
+    resp("200 OK", headers + cache_headers(result))
 
+    # Let the server stream our output buffer however it sees fit, falling
+    # back to handing it over in chunks
     if result.out_buf is not None:
-        return result.out_buf.read()
+        if "wsgi.file_wrapper" in env:
+            return env["wsgi.file_wrapper"](result.out_buf, OUT_CHUNK_SIZE)
+        return iter(lambda: result.out_buf.read(OUT_CHUNK_SIZE), b"")
 
     return ""
-    
 
-# Our dirpy function.  This is where all the heavy lifting is done
-def dirpy_worker(req_uri_obj, req_post_data): ################################
+
+# Return the HTTP caching headers (ETag, Last-Modified and Cache-Control)
+# for a result.  Only image results with a known source version get them
+def cache_headers(result): ###################################################
+    if not result.etag:
+        return []
+
+    headers = [("ETag", result.etag)]
+    if result.last_modified:
+        headers.append(("Last-Modified",
+            email.utils.formatdate(result.last_modified, usegmt=True)))
+    if cfg.cache_control:
+        headers.append(("Cache-Control", cfg.cache_control))
+
+    return headers
+
+
+# Yield the unread part of an output buffer in chunks of at most chunk_size
+# bytes.  Under Python 3 these are zero-copy memoryview slices of the buffer.
+# Python 2 file objects stringify memoryviews, so there we read copies
+def output_chunks(out_buf, chunk_size=OUT_CHUNK_SIZE): #######################
+    if sys.version[0] != '3':
+        for chunk in iter(lambda: out_buf.read(chunk_size), b""):
+            yield chunk
+        return
+
+    view = out_buf.getbuffer()
+    for pos in range(out_buf.tell(), len(view), chunk_size):
+        yield view[pos:pos + chunk_size]
+
+
+# Our dirpy function.  This is where all the heavy lifting is done.  The
+# client's If-None-Match and If-Modified-Since request headers (if any) let
+# us answer with a 304 if the client already has the current result, and
+# its request method lets us answer HEAD requests lazily
+def dirpy_worker(req_uri_obj, req_post_data, headers=None, method="GET"): ####
+
 
     # Extract relative file path and full query path from request URI object
     file_path = req_uri_obj.path
@@ -1118,82 +3294,784 @@ def dirpy_worker(req_uri_obj, req_post_data): ################################
     logger.debug("Got request: %s" % cmds)
 
     # Check for a status request, ignore everything else if we get one
-    if any(cmd[0] == "status" for cmd in cmds):
+    status = [opts for cmd, opts in cmds if cmd == "status"]
+    if status:
+        if stage_metrics and "metrics" in status[0]:
+            return metrics_result(dirpy_obj)
         return dirpy_obj.result(204)
 
-    # If our cache client exists, try to fetch from it first
-    # Don't use cache on POST requests, though
-    if redis_client and not req_post_data:
-        cache_key = hashlib.sha1(cfg.redis_prefix + query_path).hexdigest()
-        logger.debug("Looking for cache key %s" % cache_key)
+    # Hand multi-variant requests off to the batch worker
+    if any(cmd[0] == "variant" for cmd in cmds):
+        return dirpy_batch(req_uri_obj, req_post_data)
+
+    # Answer conditional requests for unchanged local source images before
+    # we load (or even fetch a cached result for) them
+    cache_key = get_cache_key(query_path)
+    headers = headers or {}
+    cond = (headers.get("If-None-Match"), headers.get("If-Modified-Since"))
+
+    # A wildcard If-None-Match only matches a result that we know exists,
+    # i.e. one that we have rendered or found in our cache.  Before then,
+    # we only check the version of our source
+    exact = cond if (cond[0] or "").strip() != "*" else (None, None)
+    if any(exact) and not req_post_data:
+        local_file = local_source(args["load"], file_path)
         try:
-            cache_start = time.time()
-            result = redis_client.hgetall(cache_key)
-            if result:
-                logger.debug("Serving request via redis")
-                dirpy_obj.deserialize(result)
-                dirpy_obj.meta_data["c"]["cache_hit"] = 1
+            if local_file:
+                dirpy_obj.src_validator = file_validator(os.stat(local_file))
+                if not_modified(dirpy_obj, cache_key, *exact):
+                    return dirpy_obj.result(304)
+        except OSError:
+            pass
 
-                # Remove timing parameters to prevent cache
-                # hits from skewing timing graphs
-                dirpy_obj.meta_data.pop("ms", None)
+    # If we have any caching layers, try to fetch from them first.
+    # Don't use cache on POST requests, though
+    use_cache = ((local_cache or shm_cache or disk_cache or redis_client)
+        and not req_post_data)
+    lazy = lazy_request(method, args, cmds)
+    flight = None
+    if use_cache:
+        if cache_fetch(cache_key, dirpy_obj):
+            if cache_revalidate(cache_key, dirpy_obj):
+                if not_modified(dirpy_obj, cache_key, *cond):
+                    return dirpy_obj.result(304)
+                return dirpy_obj.result(200, None)
 
-                # Now set the time taken to serve a cached request
-                dirpy_obj.meta_data["ms"]["time_cache_read"] = (time.time()
-                    - cache_start)
+            # Our source has changed, so start over with a clean slate
+            dirpy_obj = DirpyImage(cfg.http_root)
+            dirpy_obj.meta_data["c"]["revalidate_stale"] = 1
+
+        # Coalesce identical concurrent requests, so that only one of them
+        # renders the result while the others wait for it to be cached.
+        # Lazy requests are cheap enough to just answer themselves
+        if flight_lock and not lazy:
+            flight = flight_lock.acquire(cache_key)
+            if flight.waited:
+                wait_time = time.time() - flight.start
+                cache_hit = cache_fetch(cache_key, dirpy_obj)
+                dirpy_obj.meta_data["c"]["coalesce_wait"] = 1
+                dirpy_obj.meta_data["ms"]["time_coalesce"] = wait_time
+                if cache_hit:
+                    flight_lock.release(flight)
+                    dirpy_obj.meta_data["c"]["coalesce_hit"] = 1
+                    if not_modified(dirpy_obj, cache_key, *cond):
+                        return dirpy_obj.result(304)
+                    return dirpy_obj.result(200, None)
+
+                # Fail along with the render that we waited for, rather
+                # than trying it again ourselves
+                failure = flight_lock.failure(flight)
+                if failure:
+                    flight_lock.release(flight)
+                    dirpy_obj.meta_data["c"]["coalesce_fail"] = 1
+                    dirpy_obj.retry_after = failure[2]
+                    return dirpy_obj.result(*failure[:2])
 
-                return dirpy_obj.result(200, None)
-            else:
-                logger.debug("Cache miss; serving file normally")
-        except Exception as e:
-            logger.debug("Failed to read from redis: %s" % e)
+    try:
+        dirpy_obj.lazy = lazy
+        if any(exact) and not req_post_data:
+            dirpy_obj.conditional = (cache_key,) + exact
+        dirpy_render(dirpy_obj, file_path, args, cmds, req_post_data)
+
+        # Write to our caching layers, if any
+        if use_cache and dirpy_obj.http_code == 200 and not lazy:
+            cache_store(cache_key, dirpy_obj)
+    finally:
+        if flight:
+            if dirpy_obj.http_code >= 400:
+                flight_lock.fail(flight, dirpy_obj.http_code,
+                    dirpy_obj.http_msg, dirpy_obj.retry_after)
+            flight_lock.release(flight)
+
+    if dirpy_obj.http_code == 200 and not req_post_data and \
+            not_modified(dirpy_obj, cache_key, *cond):
+        return dirpy_obj.result(304)
+
+    return dirpy_obj
+
+
+# Return whether a request can be answered lazily: from the dimensions and
+# format in its source image's header, with its commands only keeping track
+# of the image's dimensions, rather than decoding and encoding any pixels.
+# HEAD and noshow requests can be, unless they save to disk (which they'd
+# skip) or crop off borders (as finding them needs the image's pixels)
+def lazy_request(method, args, cmds): ########################################
+    if not cfg.lazy or "todisk" in args["save"]:
+        return False
+    if method != "HEAD" and "noshow" not in args["save"]:
+        return False
+
+    return not [ opts for cmd, opts in cmds
+        if cmd == "crop" and "border" in opts ]
+
+
+# Return the path of the local file that a request's load command would read
+# its source image from, or None if it would be proxied instead
+def local_source(load_opts, file_path): ######################################
+    local_file = os.path.normpath(cfg.http_root +
+        os.path.normpath("/" + file_path))
+
+    if "proxy" in load_opts and not ("fallback" in load_opts and
+            os.path.isfile(local_file)):
+        return None
+
+    return local_file
+
+
+# Return the validator of a local source image, as used by revalidation and
+# ETags: its mtime and size
+def file_validator(file_stat): ###############################################
+    return "%s:%s" % (file_stat.st_mtime, file_stat.st_size)
+
+
+# Set a result's ETag and Last-Modified time from its cache key and the
+# version of its source image, and return whether the client's conditional
+# request headers show that it already has this version of the result
+def not_modified(dirpy_obj, cache_key, if_none_match, if_modified_since): ####
+    if not dirpy_obj.src_validator:
+        return False
+
+    etag_str = "%s:%s:%s" % (__version__, cache_key, dirpy_obj.src_validator)
+    dirpy_obj.etag = '"%s"' % hashlib.sha1(
+        etag_str.encode("utf-8")).hexdigest()
+
+    kind, value = dirpy_obj.src_validator.split(":", 1)
+    if kind == "lm":
+        dirpy_obj.last_modified = http_date(value)
+    elif kind != "etag":
+        dirpy_obj.last_modified = int(float(kind))
+
+    # If-None-Match takes precedence over If-Modified-Since
+    if if_none_match:
+        etags = [ e.strip() for e in if_none_match.split(",") ]
+        match = "*" in etags or dirpy_obj.etag in etags or \
+            "W/" + dirpy_obj.etag in etags
+    elif if_modified_since and dirpy_obj.last_modified:
+        since = http_date(if_modified_since)
+        match = since is not None and dirpy_obj.last_modified <= since
+    else:
+        match = False
+
+    if match:
+        dirpy_obj.meta_data["c"]["not_modified"] = 1
+
+    return match
+
+
+# Convert an HTTP date into a UNIX timestamp, or None if it's malformed
+def http_date(date_str): #####################################################
+    date_tuple = email.utils.parsedate_tz(date_str)
+    if date_tuple is None:
+        return None
+
+    return email.utils.mktime_tz(date_tuple)
+
+
+# Load, modify and save an image using a list of parsed commands, and
+# return the dirpy object containing the result (or error)
+def dirpy_render(dirpy_obj, file_path, args, cmds, req_post_data): ##########
 
     # Catch dirpy-related errors
+    gated = False
     try:
-        # Load our image
+        # Load our image, unless we're too busy to render it anyway.  Lazy
+        # requests never render anything, so they're always admitted
+        if admission and admission.full() and not dirpy_obj.lazy:
+            raise DirpyOverloadError("Server over capacity", 503)
+        if not dirpy_obj.lazy:
+            dirpy_obj.admit_cmds = cmds
         dirpy_obj.load(args["load"], file_path, req_post_data)
 
+        # Now that we know the version of our source, answer conditional
+        # requests for results that the client already has without
+        # rendering them (proxied sources can't be checked any sooner)
+        if dirpy_obj.conditional and \
+                not_modified(dirpy_obj, *dirpy_obj.conditional):
+            return dirpy_obj.result(304)
+
+        if cpu_slots and not dirpy_obj.lazy:
+            gated = cpu_slots.acquire()
+
         # Now run our requested commands & options against the dirpy image
-        for cmd, opts in cmds:
-            dirpy_obj.run(cmd, opts)
+        for step in plan_cmds(cmds):
+            check_deadline(dirpy_obj)
+            dirpy_obj.run(*step)
 
         # Now save it to an output buffer
+        check_deadline(dirpy_obj)
         dirpy_obj.save(args["save"])
 
-    except DirpyFatalError as e:
-        logger.warning(str(e))
-        return dirpy_obj.result(e.err_code, "Fatal Dirpy Error")
-    except DirpyUserError as e:
-        logger.debug(str(e))
-        return dirpy_obj.result(e.err_code, e.err_str)
     except Exception as e:
-        logger.warning(traceback.format_exc())
-        return dirpy_obj.result(503, "Uncaught Dirpy Error")
+        return error_result(dirpy_obj, e)
+    finally:
+        if gated:
+            cpu_slots.release()
+        if dirpy_obj.reserved:
+            admission.release(*dirpy_obj.reserved)
 
     # Return 204/No CONTENT if the file is zero length.  This should
     # only happen using the "noshow" option for the save command
     if str(dirpy_obj.out_size) == "0":
         return dirpy_obj.result(204)
 
-    # Write to our redis client, if it exists
-    if redis_client and not req_post_data:
-        logger.debug("Writing result to redis")
-        cache_start = time.time()
-        try:
-            redis_client.hmset(cache_key, dirpy_obj.serialize())
-            dirpy_obj.meta_data["c"]["cache_write"] = 1
+    return dirpy_obj.result(200, None)
 
-        except Exception as e:
-            logger.debug("Failed to write to redis: %s" % e)
 
-        dirpy_obj.meta_data["ms"]["time_cache_write"] = (time.time()
-            - cache_start)
+# Return our metrics histograms, in the Prometheus text format
+def metrics_result(dirpy_obj): ###############################################
+    dirpy_obj.out_buf = io.BytesIO(stage_metrics.render().encode("utf-8"))
+    dirpy_obj.out_size = len(dirpy_obj.out_buf.getvalue())
+    dirpy_obj.content_type = "text/plain; version=0.0.4"
 
     return dirpy_obj.result(200, None)
 
 
+# Set the HTTP error result matching an exception raised while rendering.
+# This should be called from inside the except block handling it
+def error_result(dirpy_obj, e): ##############################################
+    if isinstance(e, DirpyFatalError):
+        logger.warning(str(e))
+        return dirpy_obj.result(e.err_code, "Fatal Dirpy Error")
+    elif isinstance(e, DirpyUserError):
+        logger.debug(str(e))
+        return dirpy_obj.result(e.err_code, e.err_str)
+    elif isinstance(e, DirpyOverloadError):
+        logger.debug(str(e))
+        dirpy_obj.meta_data["c"]["overload"] = 1
+        dirpy_obj.retry_after = cfg.retry_after
+        return dirpy_obj.result(e.err_code, e.err_str)
+    else:
+        logger.warning(traceback.format_exc())
+        return dirpy_obj.result(503, "Uncaught Dirpy Error")
+
+
+# Plan the execution of a list of parsed commands, returning a list of steps
+# for DirpyImage.run() which produces the same image more cheaply (up to
+# the rounding of its resampling).  Runs of transposes are merged into (at
+# most) two, flips and half turns are moved after the resizes following
+# them where possible and quarter turns folded into them (so that they run
+# on fewer pixels, and don't force a full-size decode ahead of the resize),
+# and dimension or coordinate-based crops are folded into the resizes next
+# to them, so that only the pixels that the crop keeps are decoded and
+# resampled
+def plan_cmds(cmds): #########################################################
+
+    # Merge runs of transposes into their combined transpose
+    merged = []
+    turns = None
+    for cmd, opts in cmds + [[None, None]]:
+        op = None
+        if cmd == "transpose" and len(opts) == 1:
+            op = TRANSPOSE_OPS.get(list(opts)[0])
+        if op is not None:
+            if turns is None:
+                turns = op
+            else:
+                turns = ((op[0] + (-1 if op[1] else 1) * turns[0]) % 4,
+                    op[1] ^ turns[1])
+            continue
+
+        if turns is not None:
+            merged += transpose_cmds(turns)
+            turns = None
+        if cmd is not None:
+            merged.append([cmd, opts])
+
+    # Move flips and half turns after the resizes that follow them, and
+    # fold quarter turns into them (turning the resize's dimensions to
+    # match), unless a later command might inherit the resize's (now turned)
+    # dimensions
+    for i in range(len(merged) - 1):
+        cmd, opts = merged[i][:2]
+        next_cmd, next_opts = merged[i+1][:2]
+        if cmd != "transpose" or next_cmd != "resize" or len(merged[i+1]) > 2:
+            continue
+        if list(opts) in (["flipvert"], ["fliphorz"], ["rotate180"]):
+            merged[i], merged[i+1] = merged[i+1], merged[i]
+        elif (list(opts) in (["rotate90"], ["rotate270"]) and
+                has_dims(next_opts) and
+                not [ c for c, o in merged[i+2:] if c in ("crop", "pad")
+                    or (c == "resize" and not has_dims(o)) ]):
+            merged[i], merged[i+1] = None, ["resize", turn_dims(next_opts),
+                None, False, list(opts)[0]]
+    merged = [ step for step in merged if step ]
+
+    # Fold crops into the resizes next to them
+    plan = []
+    while merged:
+        step = merged.pop(0)
+        cmd, opts = step[:2]
+        if RESIZE_BOX and merged:
+            next_cmd, next_opts = merged[0][:2]
+            if (cmd == "resize" and len(step) == 2 and next_cmd == "crop"
+                    and "border" not in next_opts):
+                plan.append([cmd, opts, merged.pop(0)[1], False])
+                continue
+            if (cmd == "crop" and "border" not in opts and
+                    next_cmd == "resize"):
+                plan.append([next_cmd, next_opts, opts, True] +
+                    merged.pop(0)[4:])
+                continue
+        plan.append(step)
+
+    if plan != cmds:
+        logger.debug("Planned commands %s as %s" % (cmds, plan))
+
+    return plan
+
+
+# Return the (at most two) transpose commands that apply the given number of
+# quarter turns and flips
+def transpose_cmds(turns): ###################################################
+    for name, op in TRANSPOSE_OPS.items():
+        if op == turns:
+            return [["transpose", {name: True}]]
+
+    cmds = []
+    if turns[1]:
+        cmds.append(["transpose", {"flipvert": True}])
+    if turns[0]:
+        cmds.append(["transpose", {"rotate%s" % (turns[0] * 90): True}])
+    return cmds
+
+
+# Whether a command's options set its own dimensions (or percentage), as
+# opposed to inheriting them from an earlier command
+def has_dims(opts): ##########################################################
+    return "pct" in opts or bool(
+        [ o for o in opts if re.match(r"^(\d+x\d*|\d*x\d+)$", o) ])
+
+
+# Return a copy of a resize's options, for running it before a quarter turn
+# rather than after it
+def turn_dims(opts): #########################################################
+    turned = {}
+    for opt, val in opts.items():
+        dims = re.match(r"^(\d*)x(\d*)$", opt)
+        if dims:
+            opt = "%sx%s" % (dims.group(2), dims.group(1))
+        elif opt in ("landscape", "portrait"):
+            opt = "portrait" if opt == "landscape" else "landscape"
+        turned[opt] = val
+
+    return turned
+
+
+# Whether a reduce gap is usable: either 0 (no reduction) or a finite
+# multiple of at least 1 (so not a negative, infinite or NaN one)
+def valid_reduce_gap(gap): ###################################################
+    return gap == 0 or 1 <= gap < float("inf")
+
+
+# Admit an image for running a list of commands against, as soon as its
+# dimensions are known from its header (so before a proxied image has been
+# downloaded in full, and before any image is decoded).  Its estimated cost
+# is reserved from our pixel budget, and heavy requests (those costing at
+# least heavy_cost) also take one of our heavy_slots lanes, so that cheap
+# requests never queue up behind them.  Heavy requests wait up to heavy_wait
+# for a lane, but nothing waits for our pixel budget.  Raises an overload
+# error if the request can't be admitted, or otherwise returns the (cost,
+# heavy) reservation to be given back with release()
+def admit(dirpy_obj, cmds): ##################################################
+    if not admission:
+        return None
+
+    cost = request_cost(dirpy_obj.in_x, dirpy_obj.in_y, dirpy_obj.in_fmt,
+        cmds)
+    heavy = bool(cfg.heavy_slots) and cost >= cfg.heavy_cost
+
+    if heavy:
+        dirpy_obj.meta_data["c"]["lane_heavy"] = 1
+        wait_start = time.time()
+        got_lane = admission.acquire_lane(cfg.heavy_slots,
+            cfg.heavy_wait / 1000.0)
+        dirpy_obj._add_time("time_lane_wait", wait_start)
+        if not got_lane:
+            raise DirpyOverloadError("Server over capacity", 503)
+
+    if not admission.acquire(cost):
+        if heavy:
+            admission.release(0, True)
+        raise DirpyOverloadError("Server over capacity", 503)
+
+    return cost, heavy
+
+
+# Estimate the cost (in pixels processed) of running a list of commands
+# against an image of the given size and format: decoding it (at a reduced
+# scale, if a JPEG is being shrunk), each command reading its input and
+# writing its output, and saving the final image
+def request_cost(in_x, in_y, in_fmt, cmds): ##################################
+    cur_x, cur_y = in_x, in_y
+    cost = 0
+
+    for i, (cmd, opts) in enumerate(cmds):
+        new_x, new_y = cur_x, cur_y
+        for opt, val in opts.items():
+            if opt == "pct" and cmd == "resize":
+                try:
+                    new_x = cur_x * float(val) / 100
+                    new_y = cur_y * float(val) / 100
+                except ValueError:
+                    pass
+                continue
+
+            dims = re.match(r"^(\d*)x(\d*)(?:x(\d+)x(\d+))?$", opt)
+            if not dims or not any(dims.groups()):
+                continue
+            x, y, right, bottom = [ int(d) if d else None
+                for d in dims.groups() ]
+            if right is not None:
+                x, y = right - (x or 0), bottom - (y or 0)
+            new_x = x or cur_x * y / float(max(cur_y, 1))
+            new_y = y or cur_y * x / float(max(cur_x, 1))
+
+        # JPEGs can be decoded at up to 1/8 scale when we start by shrinking
+        if i == 0:
+            scale = 1
+            if in_fmt == "jpeg" and cmd == "resize":
+                margin = DRAFT_MARGINS.get(opts.get("filter"),
+                    DRAFT_MARGINS["antialias"])
+                while scale < 8 and new_x * margin * scale * 2 <= in_x and \
+                        new_y * margin * scale * 2 <= in_y:
+                    scale *= 2
+            cur_x, cur_y = in_x / float(scale), in_y / float(scale)
+            cost += cur_x * cur_y
+
+        cost += cur_x * cur_y + new_x * new_y
+        cur_x, cur_y = new_x, new_y
+
+    if not cmds:
+        cost += in_x * in_y
+
+    return int(cost + cur_x * cur_y)
+
+
+# Abandon a request once it has run past our deadline, since whoever sent
+# it has most likely given up on it by now
+def check_deadline(dirpy_obj): ###############################################
+    if cfg.deadline and \
+            time.time() - dirpy_obj.init_time > cfg.deadline / 1000.0:
+        dirpy_obj.meta_data["c"]["deadline_exceeded"] = 1
+        raise DirpyOverloadError("Request deadline exceeded", 503)
+
+
+# Render several variants of a single source image in one request.  The
+# query string consists of an optional common prefix followed by one or
+# more variants, each one starting with a "variant" command, i.e.:
+#   /a.jpg?load=...&crop=border&variant&resize=200x&variant&resize=400x
+# The source image is loaded (and the prefix commands are run) once, after
+# which each variant's commands and save options are run against a copy of
+# the result.  Each variant is cached under the same key as the equivalent
+# single request (i.e. the prefix followed by the variant's own commands),
+# and all variants are returned together in a multipart/mixed response
+def dirpy_batch(req_uri_obj, req_post_data): #################################
+
+    file_path = req_uri_obj.path
+    batch_obj = DirpyImage(cfg.http_root)
+    use_cache = ((local_cache or shm_cache or disk_cache or redis_client)
+        and not req_post_data)
+
+    # Split our query string into the prefix and each of the variants
+    prefix = []
+    variants = []
+    for fv_pair in req_uri_obj.query.split("&"):
+        if fv_pair.split("=", 1)[0] == "variant":
+            variants.append((fv_pair, []))
+        elif variants:
+            variants[-1][1].append(fv_pair)
+        else:
+            prefix.append(fv_pair)
+
+    # Parse the prefix & variant commands, and serve any variants that
+    # we already have cached
+    prefix_args = { "load": {}, "save": {} }
+    prefix_cmds = get_cmds(req_uri_obj._replace(query="&".join(prefix)),
+        prefix_args)
+
+    results = []
+    for variant_pair, variant in variants:
+        args = { "load": {}, "save": {} }
+        variant_query = "&".join(prefix + variant)
+        cmds = get_cmds(req_uri_obj._replace(query=variant_query), args)
+        name = get_cmds(req_uri_obj._replace(query=variant_pair),
+            {})[0][1].get("name", str(len(results)))
+
+        result = None
+        cache_key = None
+        if use_cache:
+            cache_key = get_cache_key("%s/%s" % (file_path, variant_query))
+            result = DirpyImage(cfg.http_root)
+            if not (cache_fetch(cache_key, result) and
+                    cache_revalidate(cache_key, result)):
+                result = None
+
+        results.append([name, args, cmds[len(prefix_cmds):], cache_key,
+            result])
+
+    # Load our source image and run our prefix commands once, decoding it
+    # up front so that our variants all share a single decode
+    to_render = [ r for r in results if r[4] is None ]
+    gated = False
+    try:
+        if to_render:
+            try:
+                if admission and admission.full():
+                    raise DirpyOverloadError("Server over capacity", 503)
+                batch_obj.admit_cmds = prefix_cmds + [ cmd
+                    for r in to_render for cmd in r[2] ]
+                batch_obj.load(prefix_args["load"], file_path,
+                    req_post_data)
+                if cpu_slots:
+                    gated = cpu_slots.acquire()
+                for step in plan_cmds(prefix_cmds):
+                    check_deadline(batch_obj)
+                    batch_obj.run(*step)
+                if len(to_render) > 1:
+                    batch_obj._decode()
+            except Exception as e:
+                return error_result(batch_obj, e)
+
+        # Now render each uncached variant
+        for result in to_render:
+            name, args, cmds, cache_key, dirpy_obj = result
+            dirpy_obj = batch_obj.branch()
+            try:
+                for step in plan_cmds(cmds):
+                    check_deadline(dirpy_obj)
+                    dirpy_obj.run(*step)
+                check_deadline(dirpy_obj)
+                dirpy_obj.save(args["save"])
+            except Exception as e:
+                error_result(dirpy_obj, e)
+                batch_obj.retry_after = dirpy_obj.retry_after
+                return batch_obj.result(dirpy_obj.http_code,
+                    "Variant %s: %s" % (name, dirpy_obj.http_msg))
+
+            if use_cache and dirpy_obj.out_size:
+                cache_store(cache_key, dirpy_obj)
+            result[4] = dirpy_obj
+    finally:
+        if gated:
+            cpu_slots.release()
+        if batch_obj.reserved:
+            admission.release(*batch_obj.reserved)
+
+    # Bundle all of our variants into a single multipart response.  Each
+    # part's length is taken from the data we actually send, rather than
+    # out_size (which isn't the size of the body for noshow variants)
+    boundary = "dirpy-" + hashlib.sha1(os.urandom(16)).hexdigest()
+    for name, args, cmds, cache_key, dirpy_obj in results:
+        part_body = b"".join(output_chunks(dirpy_obj.out_buf))
+        part_head = "--%s\r\nContent-Type: %s\r\nContent-Length: %s\r\n" \
+            "Dirpy-Variant: %s\r\nDirpy-Data: %s\r\n\r\n" % (boundary,
+            dirpy_obj.get_content_type(), len(part_body), name,
+            dirpy_obj.yield_meta_data(False))
+        batch_obj.out_buf.write(part_head.encode("utf-8"))
+        batch_obj.out_buf.write(part_body)
+        batch_obj.out_buf.write(b"\r\n")
+    batch_obj.out_buf.write(("--%s--\r\n" % boundary).encode("utf-8"))
+
+    batch_obj.out_size = batch_obj.out_buf.tell()
+    batch_obj.out_buf.seek(0)
+    batch_obj.content_type = 'multipart/mixed; boundary="%s"' % boundary
+    batch_obj.meta_data["c"]["variants"] = len(results)
+    batch_obj.meta_data["c"]["variants_rendered"] = len(to_render)
+
+    return batch_obj.result(200, None)
+
+
+# Generate the cache key used to store the result of a given request
+def get_cache_key(query_path): ###############################################
+    key_str = cfg.redis_prefix + query_path
+    if not isinstance(key_str, bytes):
+        key_str = key_str.encode("utf-8")
+
+    return hashlib.sha1(key_str).hexdigest()
+
+
+# Return the names and get/put functions of our enabled caching layers that
+# store serialized records, from the fastest layer to the slowest
+def record_caches(): #########################################################
+    caches = []
+
+    if shm_cache:
+        caches.append(("shm", shm_cache.get, shm_cache.put))
+    if disk_cache:
+        caches.append(("disk", disk_cache.get, disk_cache.put))
+    if redis_client:
+        caches.append(("redis", redis_client.get, redis_client.set))
+
+    return caches
+
+
+# Try to serve a previously rendered result from our caching layers,
+# starting with the fastest one.  Returns True on a cache hit
+def cache_fetch(cache_key, dirpy_obj): #######################################
+
+    logger.debug("Looking for cache key %s" % cache_key)
+    cache_start = time.time()
+    local_evict = 0
+    cache_tier = None
+    missed = []
+
+    # Check our in-process cache first, since it is nearly free
+    if local_cache:
+        snapshot = local_cache.get(cache_key)
+        if snapshot:
+            logger.debug("Serving request via local cache")
+            dirpy_obj.restore(snapshot)
+            cache_tier = "local"
+        else:
+            missed.append(("local", None))
+
+    # Then work our way through the record-based caching layers, promoting
+    # any hit into the faster layers that missed
+    if not cache_tier:
+        for name, get, put in record_caches():
+            try:
+                record = get(cache_key)
+                if record:
+                    dirpy_obj.deserialize(record)
+                    cache_tier = name
+            except Exception as e:
+                logger.debug("Failed to read from %s cache: %s" % (name, e))
+
+            if not cache_tier:
+                missed.append((name, put))
+                continue
+
+            logger.debug("Serving request via %s cache" % name)
+            for miss_name, miss_put in missed:
+                try:
+                    if miss_put:
+                        miss_put(cache_key, record)
+                    else:
+                        local_evict = local_cache.put(cache_key,
+                            dirpy_obj.snapshot(), dirpy_obj.out_size)
+                except Exception as e:
+                    logger.debug("Failed to write to %s cache: %s" %
+                        (miss_name, e))
+            break
+
+    if not cache_tier:
+        logger.debug("Cache miss; serving file normally")
+        for miss_name, miss_put in missed:
+            dirpy_obj.meta_data["c"][miss_name + "_cache_miss"] = 1
+        return False
+
+    # Keep the original render's meta data, in case cache_revalidate()
+    # stores our result again
+    if cfg.revalidate_interval:
+        dirpy_obj.render_meta = copy.deepcopy(dirpy_obj.meta_data)
+
+    # Override the cache counters inherited from the original render
+    for name in list(dirpy_obj.meta_data["c"]):
+        if ("cache_" in name or name.startswith("coalesce_") or
+                name.startswith("proxy_pool_") or
+                name.startswith("revalidate_")):
+            del dirpy_obj.meta_data["c"][name]
+
+    dirpy_obj.meta_data["c"]["cache_hit"] = 1
+    dirpy_obj.meta_data["c"][cache_tier + "_cache_hit"] = 1
+    for miss_name, miss_put in missed:
+        dirpy_obj.meta_data["c"][miss_name + "_cache_miss"] = 1
+    if local_cache:
+        dirpy_obj.meta_data["c"]["local_cache_evict"] = local_evict
+
+    # Remove timing parameters to prevent cache
+    # hits from skewing timing graphs
+    dirpy_obj.meta_data.pop("ms", None)
+
+    # Now set the time taken to serve a cached request
+    dirpy_obj.meta_data["ms"]["time_cache_read"] = time.time() - cache_start
+
+    return True
+
+
+# Return the validator (ETag or Last-Modified header) of a proxied response,
+# if it has one
+def proxy_validator(proxy_res): ##############################################
+    etag = proxy_res.getheader("ETag")
+    if etag:
+        return "etag:" + etag
+    last_modified = proxy_res.getheader("Last-Modified")
+    if last_modified:
+        return "lm:" + last_modified
+    return None
+
+
+# Return the conditional GET headers that check a proxy_validator() value
+def validator_headers(validator): ############################################
+    kind, value = validator.split(":", 1)
+    header = "If-None-Match" if kind == "etag" else "If-Modified-Since"
+    return {header: value}
+
+
+# Check that a cached result is still fresh, i.e. that its source hasn't
+# changed since it was rendered.  Sources are only checked once every
+# revalidate_interval seconds; results that are still fresh are re-stored
+# with their new validation time, so that other workers don't recheck
+# them.  If we can't reach the source, we keep serving the cached result
+def cache_revalidate(cache_key, dirpy_obj): ##################################
+
+    if not cfg.revalidate_interval or not dirpy_obj.src_id:
+        return True
+    if time.time() - dirpy_obj.validated < cfg.revalidate_interval:
+        return True
+
+    logger.debug("Revalidating source %s" % dirpy_obj.src_id)
+    try:
+        if dirpy_obj.source_changed():
+            logger.debug("Source %s has changed" % dirpy_obj.src_id)
+            return False
+    except Exception as e:
+        logger.debug("Failed to revalidate %s: %s" % (dirpy_obj.src_id, e))
+        dirpy_obj.meta_data["c"]["revalidate_error"] = 1
+        return True
+
+    # Store the result again with its new validation time, but with the
+    # meta data of the original render rather than that of this cache hit
+    dirpy_obj.validated = time.time()
+    hit_meta = dirpy_obj.meta_data
+    dirpy_obj.meta_data = dirpy_obj.render_meta or hit_meta
+    try:
+        cache_store(cache_key, dirpy_obj)
+    finally:
+        dirpy_obj.meta_data = hit_meta
+    dirpy_obj.meta_data["c"]["revalidate_fresh"] = 1
+
+    return True
+
+
+# Write a freshly rendered result to all of our caching layers
+def cache_store(cache_key, dirpy_obj): #######################################
+
+    cache_start = time.time()
+
+    if local_cache:
+        dirpy_obj.meta_data["c"]["local_cache_evict"] = local_cache.put(
+            cache_key, dirpy_obj.snapshot(), dirpy_obj.out_size)
+
+    # Our record-based caching layers all store the same serialized record
+    caches = record_caches()
+    if caches:
+        record = dirpy_obj.serialize()
+
+    for name, get, put in caches:
+        logger.debug("Writing result to %s cache" % name)
+        try:
+            if put(cache_key, record) is not False:
+                dirpy_obj.meta_data["c"][name + "_cache_write"] = 1
+                dirpy_obj.meta_data["c"]["cache_write"] = 1
+        except Exception as e:
+            logger.debug("Failed to write to %s cache: %s" % (name, e))
+
+    dirpy_obj.meta_data["ms"]["time_cache_write"] = time.time() - cache_start
+
+
 # Read in the command line and file based configuration parameters
-def read_config(uwsgi_cfg=None): #############################################
+def read_config(uwsgi_cfg=None, argv=None, add_args=None): ##################
 
     # Build our config parser
     parser = argparse.ArgumentParser(
@@ -1205,9 +4083,13 @@ def read_config(uwsgi_cfg=None): #############################################
     parser.add_argument("-f", "--foreground", action="store_true",
         help="Don't daemonize; run program in the foreground")
 
+    # Let subcommands add their own command line arguments
+    if add_args:
+        add_args(parser)
+
     # Parse command line
     global cfg
-    cfg = parser.parse_args()
+    cfg = parser.parse_args(argv)
 
     # Config file precedence: 
     # uwsgi_cfg >> cfg.config_file >> "/etc/dirpy.conf" 
@@ -1244,10 +4126,36 @@ def read_config(uwsgi_cfg=None): #############################################
         "global", "def_quality", False,  95)
     cfg.min_recompress_pixels   = cfg_int(cfg_parser,
         "global", "min_recompress_pixels", False,  0)
+    cfg.reduce_gap              = cfg_float(cfg_parser,
+        "global", "reduce_gap", False,  0.0)
+    cfg.lazy                    = cfg_bool(cfg_parser,
+        "global", "lazy", False,  False)
     cfg.req_timeout             = cfg_int(cfg_parser,
         "global", "req_timeout", False, None)
+    cfg.server_mode             = cfg_str(cfg_parser,
+        "global", "server_mode", False, "fork")
+    cfg.async_threads           = cfg_int(cfg_parser,
+        "global", "async_threads", False, 8)
+    cfg.async_io_threads        = cfg_int(cfg_parser,
+        "global", "async_io_threads", False, 64)
+    cfg.worker_threads          = cfg_int(cfg_parser,
+        "global", "worker_threads", False, 1)
+    cfg.pixel_budget            = cfg_int(cfg_parser,
+        "global", "pixel_budget", False, 0)
+    cfg.retry_after             = cfg_int(cfg_parser,
+        "global", "retry_after", False, 1)
+    cfg.heavy_slots             = cfg_int(cfg_parser,
+        "global", "heavy_slots", False, 0)
+    cfg.heavy_cost              = cfg_int(cfg_parser,
+        "global", "heavy_cost", False, 20000000)
+    cfg.heavy_wait              = cfg_int(cfg_parser,
+        "global", "heavy_wait", False, 10000)
+    cfg.deadline                = cfg_int(cfg_parser,
+        "global", "deadline", False, 0)
     cfg.allow_post              = cfg_bool(cfg_parser,
         "global", "allow_post", False,  False)
+    cfg.max_post_bytes          = cfg_int(cfg_parser,
+        "global", "max_post_bytes", False, 67108864)
     cfg.allow_todisk            = cfg_bool(cfg_parser,
         "global", "allow_todisk", False, False)
     cfg.allow_mkdir             = cfg_bool(cfg_parser,
@@ -1256,21 +4164,72 @@ def read_config(uwsgi_cfg=None): #############################################
         "global", "allow_overwrite", False, False)
     cfg.todisk_root             = cfg_str(cfg_parser,
         "global", "todisk_root", False,  "/nonexistant")
+    cfg.proxy_max_bytes         = cfg_int(cfg_parser,
+        "global", "proxy_max_bytes", False, 0)
+    cfg.proxy_pool_size         = cfg_int(cfg_parser,
+        "global", "proxy_pool_size", False, 4)
+    cfg.proxy_idle_timeout      = cfg_int(cfg_parser,
+        "global", "proxy_idle_timeout", False, 30)
+    cfg.proxy_connect_timeout   = cfg_int(cfg_parser,
+        "global", "proxy_connect_timeout", False, 5)
+    cfg.proxy_read_timeout      = cfg_int(cfg_parser,
+        "global", "proxy_read_timeout", False, 30)
     cfg.statsd_server           = cfg_str(cfg_parser,
         "global", "statsd_server", False, None)
     cfg.statsd_port             = cfg_int(cfg_parser,
         "global", "statsd_port", False, 8125)
     cfg.statsd_prefix           = cfg_str(cfg_parser,
         "global", "statsd_prefix", False, "dirpy")
+    cfg.statsd_flush_ms         = cfg_int(cfg_parser,
+        "global", "statsd_flush_ms", False, 1000)
+    cfg.statsd_packet_bytes     = cfg_int(cfg_parser,
+        "global", "statsd_packet_bytes", False, 1432)
+    cfg.statsd_timer_samples    = cfg_int(cfg_parser,
+        "global", "statsd_timer_samples", False, 32)
     cfg.redis_hosts             = cfg_str(cfg_parser,
         "global", "redis_hosts", False, None)
     cfg.redis_cluster           = cfg_bool(cfg_parser,
         "global", "redis_cluster", False, False)
     cfg.redis_prefix            = cfg_str(cfg_parser,
         "global", "redis_prefix", False, "dirpy")
+    cfg.local_cache_bytes       = cfg_int(cfg_parser,
+        "global", "local_cache_bytes", False, 0)
+    cfg.shm_cache_file          = cfg_str(cfg_parser,
+        "global", "shm_cache_file", False, None)
+    cfg.shm_cache_slots         = cfg_int(cfg_parser,
+        "global", "shm_cache_slots", False, 1024)
+    cfg.shm_cache_slot_bytes    = cfg_int(cfg_parser,
+        "global", "shm_cache_slot_bytes", False, 131072)
+    cfg.decode_cache_bytes      = cfg_int(cfg_parser,
+        "global", "decode_cache_bytes", False, 0)
+    cfg.decode_cache_ttl        = cfg_int(cfg_parser,
+        "global", "decode_cache_ttl", False, 60)
+    cfg.disk_cache_root         = cfg_str(cfg_parser,
+        "global", "disk_cache_root", False, None)
+    cfg.disk_cache_max_bytes    = cfg_int(cfg_parser,
+        "global", "disk_cache_max_bytes", False, 1073741824)
+    cfg.disk_cache_fanout       = cfg_int(cfg_parser,
+        "global", "disk_cache_fanout", False, 2)
+    cfg.disk_cache_sweep_interval = cfg_int(cfg_parser,
+        "global", "disk_cache_sweep_interval", False, 300)
+    cfg.revalidate_interval     = cfg_int(cfg_parser,
+        "global", "revalidate_interval", False, 0)
+    cfg.cache_control           = cfg_str(cfg_parser,
+        "global", "cache_control", False, None)
+    cfg.coalesce                = cfg_str(cfg_parser,
+        "global", "coalesce", False, "none")
+    cfg.coalesce_lock_file      = cfg_str(cfg_parser,
+        "global", "coalesce_lock_file", False, "/tmp/dirpy.lock")
+    cfg.coalesce_timeout        = cfg_int(cfg_parser,
+        "global", "coalesce_timeout", False, 10000)
+    cfg.metrics                 = cfg_bool(cfg_parser,
+        "global", "metrics", False, False)
     cfg.debug                   = cfg_bool(cfg_parser,
         "global", "debug", False, cfg.debug)
 
+    if not valid_reduce_gap(cfg.reduce_gap):
+        fatal("Config parameter global:reduce_gap must be 0 or at least 1.")
+
 
 # Extract dirpy arguments and positional commands/options from the
 # parsed query string
@@ -1287,7 +4246,12 @@ def get_cmds(parsedPath, args): ##############################################
     cmds = []
 
     for fv_pair in parsedPath.query.split("&"):
-        fv_norm = urllib.unquote(fv_pair).decode("utf-8")
+        # Skip empty pairs (e.g. from an empty query string, or "&&")
+        if not fv_pair:
+            continue
+        fv_norm = unquote(fv_pair)
+        if isinstance(fv_norm, bytes):
+            fv_norm = fv_norm.decode("utf-8")
         oper = None
         opts = {}
         if "=" in fv_pair:
@@ -1333,6 +4297,18 @@ def cfg_int(cfg, section, name, required=True, default=None): ################
         fatal("Missing required config parameter %s:%s." % (section, name))
 
 
+# Grab a float from our config, complain if it isn't valid
+def cfg_float(cfg, section, name, required=True, default=None): ##############
+    try:
+        return cfg.getfloat(section, name)
+    except ValueError:
+        fatal("Config parameter %s:%s must be a number." % (section, name))
+    except configparser.Error:
+        if not required:
+            return default
+        fatal("Missing required config parameter %s:%s." % (section, name))
+
+
 # Grab an int from our config, complain if it isn't valid
 def cfg_bool(cfg, section, name, required=True, default=False): ##############
     try:
@@ -1467,6 +4443,175 @@ def redis_setup(): ###########################################################
             fatal("Error connecting to redis backend: %s" % e)
 
 
+# Set up our in-process result cache, if requested by user
+def local_cache_setup(): #####################################################
+
+    global local_cache
+    local_cache = None
+
+    if cfg.local_cache_bytes > 0:
+        logger.debug("Using a %s byte local cache" % cfg.local_cache_bytes)
+        local_cache = DirpyLruCache(cfg.local_cache_bytes)
+
+
+# Set up our in-process cache of decoded source images, if requested
+def decode_cache_setup(): ####################################################
+
+    global decode_cache
+    decode_cache = None
+
+    if cfg.decode_cache_bytes > 0:
+        logger.debug("Using a %s byte decode cache" % cfg.decode_cache_bytes)
+        decode_cache = DirpyLruCache(cfg.decode_cache_bytes)
+
+
+# Set up the result cache shared between worker processes, if requested.
+# This needs to happen before we fork our workers, or at least before we
+# start serving requests.  Our server empties the cache when it starts, so
+# that it never serves results left over from a previous run
+def shm_cache_setup(reset=False): ############################################
+
+    global shm_cache
+    shm_cache = None
+
+    if not cfg.shm_cache_file: return
+
+    logger.debug("Using shared memory cache file: %s" % cfg.shm_cache_file)
+
+    try:
+        shm_cache = DirpyShmCache(cfg.shm_cache_file, cfg.shm_cache_slots,
+            cfg.shm_cache_slot_bytes, reset)
+    except Exception as e:
+        fatal("Error setting up shared memory cache %s: %s" %
+            (cfg.shm_cache_file, e))
+
+
+# Set up our on-disk result cache, if requested
+def disk_cache_setup(): ######################################################
+
+    global disk_cache
+    disk_cache = None
+
+    if not cfg.disk_cache_root: return
+
+    if not 0 <= cfg.disk_cache_fanout <= 4:
+        fatal("disk_cache_fanout must be between 0 and 4")
+
+    logger.debug("Using disk cache root: %s" % cfg.disk_cache_root)
+
+    try:
+        disk_cache = DirpyDiskCache(cfg.disk_cache_root,
+            cfg.disk_cache_max_bytes, cfg.disk_cache_fanout)
+    except Exception as e:
+        fatal("Error setting up disk cache %s: %s" %
+            (cfg.disk_cache_root, e))
+
+
+# Sweep our on-disk result cache, logging (rather than raising) any errors
+def disk_cache_sweep(*args): #################################################
+    try:
+        disk_cache.sweep()
+    except Exception as e:
+        logger.warning("Disk cache sweep failed: %s" % e)
+
+
+# Our disk cache sweeper process, used in standalone mode so that sweeps
+# never hold up the watchdog (or a worker)
+def disk_sweeper(): ##########################################################
+    try:
+        while True:
+            time.sleep(cfg.disk_cache_sweep_interval)
+            disk_cache_sweep()
+    except KeyboardInterrupt:
+        pass
+
+
+# Set up request coalescing, if requested.  This relies on our caching
+# layers, so it should be called after they have been set up
+def flight_lock_setup(): #####################################################
+
+    global flight_lock
+    flight_lock = None
+
+    if cfg.coalesce == "none": return
+
+    if cfg.coalesce not in ("file", "redis"):
+        fatal("Unknown coalesce mode: %s" % cfg.coalesce)
+    if cfg.coalesce == "redis" and not redis_client:
+        fatal("Redis-based request coalescing requires redis_hosts")
+
+    logger.debug("Coalescing identical requests using %s locks" %
+        cfg.coalesce)
+
+    try:
+        flight_lock = DirpyFlightLock(cfg.coalesce, cfg.coalesce_lock_file,
+            cfg.coalesce_timeout)
+    except Exception as e:
+        fatal("Error setting up request coalescing: %s" % e)
+
+
+# Set up all of our caching layers, emptying the shared memory cache if
+# we're starting up a server
+def cache_setup(reset=False): ################################################
+    local_cache_setup()
+    decode_cache_setup()
+    shm_cache_setup(reset)
+    disk_cache_setup()
+    redis_setup()
+    flight_lock_setup()
+
+
+# Set up the pool of keep-alive connections to our proxy origins
+def proxy_pool_setup(): ######################################################
+
+    global proxy_pool
+    proxy_pool = DirpyConnPool(cfg.proxy_pool_size, cfg.proxy_idle_timeout,
+        cfg.proxy_connect_timeout, cfg.proxy_read_timeout)
+
+
+# Set up our statsd client, if a statsd server has been configured
+def statsd_setup(): ##########################################################
+
+    global statsd_client
+    statsd_client = None
+
+    if cfg.statsd_server is None: return
+
+    logger.debug("Sending metrics to statsd server %s:%s every %sms" %
+        (cfg.statsd_server, cfg.statsd_port, cfg.statsd_flush_ms))
+    statsd_client = DirpyStatsd(cfg.statsd_server, cfg.statsd_port,
+        cfg.statsd_prefix, cfg.statsd_flush_ms, cfg.statsd_packet_bytes,
+        cfg.statsd_timer_samples)
+
+
+# Set up our shared timing histograms, if requested, with enough regions for
+# num_regions worker processes (including any restarted ones)
+def metrics_setup(num_regions): ##############################################
+
+    global stage_metrics
+    stage_metrics = None
+
+    if not cfg.metrics: return
+
+    logger.debug("Keeping timing metrics for %s workers" % num_regions)
+    stage_metrics = DirpyMetrics(num_regions)
+
+
+# Set up admission control, if we have a pixel budget or heavy request
+# lanes.  Like our metrics, this needs to be shared with our (not yet
+# forked) workers
+def admission_setup(num_slots): ##############################################
+
+    global admission
+    admission = None
+
+    if not cfg.pixel_budget and not cfg.heavy_slots: return
+
+    logger.debug("Admitting up to %s pixels of work at once, with %s heavy "
+        "request lanes" % (cfg.pixel_budget, cfg.heavy_slots))
+    admission = DirpyAdmission(num_slots, cfg.pixel_budget)
+
+
 # Throw a fatal message and exit
 def fatal(msg): ##############################################################
 
@@ -1558,6 +4703,29 @@ def server_wrapper(server): ##################################################
             pass
 
 
+# The asyncio equivalent of server_wrapper: serve the connections accepted
+# on our (shared) listening socket from an event loop, using a pool of
+# async_io_threads threads to run the requests themselves.  Requests spend
+# much of their time blocked on proxy, cache and disk I/O, so only
+# async_threads of them at a time may work on pixels
+def async_server_wrapper(server): ############################################
+    global cpu_slots
+    cpu_slots = threading.BoundedSemaphore(cfg.async_threads)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max(cfg.async_io_threads, cfg.async_threads))
+
+    try:
+        loop.run_until_complete(loop.create_server(
+            lambda: DirpyAsyncProtocol(loop, executor),
+            sock=server.socket))
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
 # Our main loop, used in standalone mode
 def dirpy_main(): ############################################################
 
@@ -1571,6 +4739,16 @@ def dirpy_main(): ############################################################
     # Start our logger
     logger_setup()
 
+    # Pick how our workers serve requests
+    if cfg.server_mode == "fork":
+        wrapper = server_wrapper
+    elif cfg.server_mode != "async":
+        fatal("Unknown server mode: %s" % cfg.server_mode)
+    elif asyncio is None:
+        fatal("The async server mode requires Python 3")
+    else:
+        wrapper = async_server_wrapper
+
     # Catch SIGINTs
     signal.signal(signal.SIGINT, lambda s, f: os._exit(1))
 
@@ -1590,17 +4768,28 @@ def dirpy_main(): ############################################################
     # to be able to watchdog our server processes
     workers = []
     for i in range(cfg.num_workers):
-        workers.append(spawn_worker(server_wrapper, (http_server,)))
+        workers.append(spawn_worker(wrapper, (http_server,)))
+
+    # Keep our on-disk result cache under its size limit in its own process
+    sweeper = None
+    if disk_cache:
+        sweeper = spawn_worker(disk_sweeper, ())
 
     # We're up and running; let the world know about it
     logger.info("Dirpy daemon started! Herp da dirp!")
-    logger.info("Listing on %s:%s, using %s worker(s) " %
-        (cfg.bind_addr, cfg.bind_port, cfg.num_workers))
+    logger.info("Listing on %s:%s, using %s %s worker(s) " %
+        (cfg.bind_addr, cfg.bind_port, cfg.num_workers, cfg.server_mode))
 
     # Enter watchdog mode
     while True:
         time.sleep(1)
-        
+
+        # Restart our disk cache sweeper if it died
+        if sweeper and not sweeper[0].is_alive():
+            logger.error("Disk cache sweeper died; restarting it.")
+            sweeper[0].join()
+            sweeper = spawn_worker(disk_sweeper, ())
+
         # Check to see if any workers have died/exited unexpectedly
         for i in range(cfg.num_workers):
 
@@ -1608,12 +4797,361 @@ def dirpy_main(): ############################################################
             if not workers[i][0].is_alive():
                 logger.error("Worker %s died; restarting it." % (i+1,))
                 workers[i][0].join()
-                workers[i] = spawn_worker(server_wrapper, (http_server,))
+                workers[i] = spawn_worker(wrapper, (http_server,))
 
     # Shouldn't ever get this far, but just in case...
     sys.exit(1)
 
 
+# Pre-warm our caching layers by rendering a corpus of request URLs (one per
+# line, read from a file or stdin) in a pool of worker processes, without
+# going through HTTP.  Results are cached using the same cache keys as live
+# requests, so a primed cache can be shared with the running daemon
+def dirpy_warm(): ############################################################
+
+    # Read command line parameters and config file, skipping the subcommand
+    read_config(argv=sys.argv[2:], add_args=warm_args)
+
+    # We never daemonize while warming, so log to stdout
+    cfg.foreground = True
+    logger_setup()
+
+    # Set up our caching layers before forking, as the daemon does.  The
+    # local cache lives inside a single process, so it can't be warmed
+    cfg.metrics = False
+    cfg.pixel_budget = cfg.heavy_slots = cfg.deadline = 0
+    cache_setup()
+    metrics_setup(0)
+    admission_setup(0)
+    proxy_pool_setup()
+    if not (shm_cache or disk_cache or redis_client):
+        fatal("No shared cache (shm, disk or redis) is configured; "
+            "there is nothing to warm")
+
+    try:
+        url_fh = sys.stdin if cfg.url_file == "-" else open(cfg.url_file)
+    except IOError as e:
+        fatal("Unable to read URL file %s (%s)" % (cfg.url_file, e.strerror))
+
+    # Skip blank lines and comments
+    urls = (line.strip() for line in url_fh)
+    urls = (url for url in urls if url and not url.startswith("#"))
+
+    num_jobs = cfg.jobs or cfg.num_workers
+    logger.info("Warming caches using %s worker(s)" % num_jobs)
+
+    stats = collections.defaultdict(int)
+    codes = collections.defaultdict(int)
+    times = []
+    start = last_report = time.time()
+
+    pool = multiprocessing.Pool(num_jobs, warm_init)
+    try:
+        for url, http_code, http_msg, out_size, cached, elapsed in \
+                pool.imap_unordered(warm_worker, urls, 16):
+            stats["requests"] += 1
+            codes[http_code] += 1
+            times.append(elapsed)
+            if cached:
+                stats["cached"] += 1
+            elif http_code in (200, 204):
+                stats["rendered"] += 1
+                stats["bytes"] += out_size
+            else:
+                stats["errors"] += 1
+                logger.warning("%s: %s %s" % (url, http_code, http_msg))
+
+            # Periodically report our progress on long runs
+            if time.time() - last_report > 10:
+                last_report = time.time()
+                logger.info("Warmed %s URL(s) (%.1f/s)" % (stats["requests"],
+                    stats["requests"] / (last_report - start)))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        fatal("Interrupted after %s URL(s)" % stats["requests"])
+    pool.join()
+
+    # Keep the on-disk cache under its size limit after a bulk load
+    if disk_cache:
+        disk_cache_sweep()
+
+    # Print our summary
+    elapsed = max(time.time() - start, 0.001)
+    times.sort()
+    def percentile(pct):
+        if not times:
+            return 0
+        return int(times[min(len(times) - 1, len(times) * pct // 100)] * 1000)
+
+    print("requests:    %s" % stats["requests"])
+    print("rendered:    %s" % stats["rendered"])
+    print("cached:      %s" % stats["cached"])
+    print("errors:      %s" % stats["errors"])
+    print("bytes:       %s" % stats["bytes"])
+    print("elapsed:     %.2fs" % elapsed)
+    print("throughput:  %.1f req/s" % (stats["requests"] / elapsed))
+    print("latency:     p50=%sms p90=%sms p99=%sms max=%sms" % (
+        percentile(50), percentile(90), percentile(99), percentile(100)))
+    print("http_codes:  %s" % " ".join("%s=%s" % (code, codes[code])
+        for code in sorted(codes)))
+
+    sys.exit(1 if stats["errors"] else 0)
+
+
+# Command line arguments for the warm subcommand
+def warm_args(parser): #######################################################
+    parser.add_argument("url_file", nargs="?", default="-",
+        help="File of request URLs to render, one per line (default: stdin)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="Number of worker processes (default: num_workers)")
+
+
+# Warm pool worker initializer; leave interrupts to the parent process
+def warm_init(): #############################################################
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Render a single request URL for the warm pool, and return a summary of
+# the result (the image data itself has already been cached)
+def warm_worker(url): ########################################################
+    start = time.time()
+    try:
+        result = dirpy_worker(urlparse.urlparse(url), None)
+    except Exception as e:
+        return (url, 503, str(e), 0, False, time.time() - start)
+
+    # Batch requests are only a cache hit if none of their variants rendered
+    counters = result.meta_data["c"]
+    cached = bool(counters.get("cache_hit") or
+        (counters.get("variants") and not counters["variants_rendered"]))
+
+    return (url, result.http_code, result.http_msg, result.out_size, cached,
+        time.time() - start)
+
+
+# Benchmark our transform pipeline against a corpus of images, either by
+# calling dirpy_worker directly or over HTTP against a running dirpy server,
+# and print per-stage latency percentiles and throughput as JSON
+def dirpy_bench(): ###########################################################
+
+    # Read command line parameters and config file, skipping the subcommand
+    read_config(argv=sys.argv[2:], add_args=bench_args)
+    cfg.foreground = True
+    logger_setup()
+
+    # Load our corpus, generating a synthetic one if need be
+    tmp_dir = None
+    corpus_dir = cfg.corpus
+    if corpus_dir is None:
+        if cfg.http:
+            fatal("HTTP mode requires a --corpus inside the http_root")
+        tmp_dir = corpus_dir = tempfile.mkdtemp(prefix="dirpy-bench-")
+    if not os.path.isdir(corpus_dir) or not os.listdir(corpus_dir):
+        bench_corpus(corpus_dir, cfg.seed)
+    files = sorted(f for f in os.listdir(corpus_dir)
+        if os.path.splitext(f)[1].lower() in BENCH_EXTENSIONS)
+    if not files:
+        fatal("No images found in corpus %s" % corpus_dir)
+
+    # Request paths are relative to the http_root; in direct mode we serve
+    # the corpus itself, but in HTTP mode it must live under the server's
+    if cfg.http:
+        corpus_root = os.path.relpath(os.path.abspath(corpus_dir),
+            os.path.abspath(cfg.http_root))
+        if corpus_root.startswith(os.pardir):
+            fatal("Corpus %s is outside of the http_root %s" %
+                (corpus_dir, cfg.http_root))
+    else:
+        cfg.http_root = os.path.abspath(corpus_dir)
+        corpus_root = "."
+
+    ops = cfg.op or BENCH_OPS
+    urls = ["/%s?%s" % (os.path.normpath(os.path.join(corpus_root, f)), op)
+        for f in files for op in ops]
+
+    # Measure the transform pipeline rather than our caching layers
+    if not cfg.http:
+        cfg.local_cache_bytes = cfg.decode_cache_bytes = 0
+        cfg.shm_cache_file = cfg.disk_cache_root = cfg.redis_hosts = None
+        cfg.coalesce = "none"
+        cfg.metrics = False
+        cfg.pixel_budget = cfg.heavy_slots = cfg.deadline = 0
+        cache_setup()
+        metrics_setup(0)
+        admission_setup(0)
+        proxy_pool_setup()
+
+    run = bench_http if cfg.http else bench_direct
+    try:
+        run(urls * cfg.warmup)
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        timings, errors = run(urls * cfg.iterations)
+        elapsed = time.time() - start
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results = {
+        "mode": "http" if cfg.http else "direct",
+        "python": sys.version.split()[0],
+        "pillow": getattr(Image, "__version__", None) or Image.VERSION,
+        "images": len(files),
+        "ops": len(ops),
+        "requests": len(urls) * cfg.iterations,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "images_per_s": round(len(urls) * cfg.iterations / elapsed, 1),
+        "stages_ms": {},
+    }
+    for stage, times in timings.items():
+        times.sort()
+        results["stages_ms"][stage] = {
+            "count": len(times),
+            "mean": round(sum(times) * 1000 / len(times), 2),
+        }
+        for pct in (50, 90, 99, 100):
+            results["stages_ms"][stage]["p%s" % pct] = round(
+                times[min(len(times) - 1, len(times) * pct // 100)] * 1000, 2)
+
+    # CPU time and memory use are only meaningful when rendering in-process
+    if not cfg.http:
+        results["cpu_s"] = round(
+            usage_end.ru_utime + usage_end.ru_stime -
+            usage_start.ru_utime - usage_start.ru_stime, 3)
+        # ru_maxrss is in bytes on OS X, and kilobytes everywhere else
+        results["peak_rss_kb"] = (usage_end.ru_maxrss // 1024
+            if sys.platform == "darwin" else usage_end.ru_maxrss)
+
+    print(json.dumps(results, indent=2, sort_keys=True,
+        separators=(",", ": ")))
+
+
+# Command line arguments for the bench subcommand
+def bench_args(parser): ######################################################
+    parser.add_argument("--corpus",
+        help="Directory of source images; a synthetic corpus is generated "
+            "if it is empty or missing (default: temporary directory)")
+    parser.add_argument("--op", action="append",
+        help="Query string to run against every image (repeatable)")
+    parser.add_argument("-n", "--iterations", type=int, default=5,
+        help="Number of measured passes over the corpus")
+    parser.add_argument("--warmup", type=int, default=1,
+        help="Number of unmeasured passes over the corpus")
+    parser.add_argument("--seed", type=int, default=0,
+        help="Random seed used to generate the synthetic corpus")
+    parser.add_argument("--http",
+        help="Benchmark a running server at this base URL instead")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="Number of concurrent HTTP clients (HTTP mode only)")
+
+
+# Generate a reproducible synthetic corpus of images of various sizes and
+# formats, with a mixture of smooth gradients and hard edges
+def bench_corpus(corpus_dir, seed): ##########################################
+
+    logger.info("Generating synthetic corpus in %s" % corpus_dir)
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+
+    rand = random.Random(seed)
+    for width, height in ((640, 480), (1600, 1200), (4000, 3000)):
+        in_x, in_y = width * 9 // 10, height * 9 // 10
+        im_in = Image.new("RGB", (in_x, in_y))
+        draw = ImageDraw.Draw(im_in)
+        for x in range(0, in_x, 8):
+            shade = x * 255 // in_x
+            draw.rectangle((x, 0, x + 7, in_y), fill=(shade, 128, 255-shade))
+        for i in range(40):
+            x, y = rand.randrange(in_x), rand.randrange(in_y)
+            draw.ellipse((x, y, x + rand.randrange(in_x // 4),
+                y + rand.randrange(in_y // 4)),
+                fill=tuple(rand.randrange(256) for c in range(3)))
+
+        # Surround it with a solid border so border crops have work to do
+        im = Image.new("RGB", (width, height), "black")
+        im.paste(im_in, (width // 20, height // 20))
+
+        name = os.path.join(corpus_dir, "%sx%s" % (width, height))
+        im.save(name + ".jpg", "JPEG", quality=90)
+        im.save(name + ".png", "PNG")
+
+
+# Render a list of URLs in-process, returning our per-stage timings (in
+# seconds) and error count
+def bench_direct(urls): ######################################################
+    timings = collections.defaultdict(list)
+    errors = 0
+
+    for url in urls:
+        start = time.time()
+        try:
+            result = dirpy_worker(urlparse.urlparse(url), None)
+        except Exception as e:
+            logger.warning("%s: %s" % (url, e))
+            errors += 1
+            continue
+        total = time.time() - start
+
+        if result.http_code != 200:
+            logger.warning("%s: %s %s" %
+                (url, result.http_code, result.http_msg))
+            errors += 1
+            continue
+
+        timings["total"].append(total)
+        for name, val in result.meta_data["ms"].items():
+            timings[name.replace("time_", "").replace("_time", "")].append(val)
+
+    return timings, errors
+
+
+# Request a list of URLs from a running server using cfg.jobs concurrent
+# clients, returning our per-stage timings (from the Dirpy-Data header)
+# and error count
+def bench_http(urls): ########################################################
+    timings = collections.defaultdict(list)
+    errors = [0]
+    lock = threading.Lock()
+    todo = collections.deque(urls)
+
+    def client():
+        while True:
+            try:
+                url = todo.popleft()
+            except IndexError:
+                return
+
+            start = time.time()
+            try:
+                resp = urllib2.urlopen(cfg.http.rstrip("/") + url)
+                resp.read()
+                meta = json.loads(resp.info().get("Dirpy-Data") or "{}")
+            except Exception as e:
+                logger.warning("%s: %s" % (url, e))
+                with lock:
+                    errors[0] += 1
+                continue
+            total = time.time() - start
+
+            with lock:
+                timings["total"].append(total)
+                for name, val in meta.items():
+                    if name.startswith("time_") or name.endswith("_time"):
+                        stage = name.replace("time_", "").replace("_time", "")
+                        timings[stage].append(val / 1000.0)
+
+    threads = [threading.Thread(target=client) for i in range(cfg.jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return timings, errors[0]
+
+
 # Handle being launched via UWSGI
 def uwsgi_prep(): ###########################################################
 
@@ -1632,6 +5170,23 @@ def uwsgi_prep(): ###########################################################
     logger.info("Dirpy v%s uWSGI worker started! Herp da dirp!"
             % __version__)
 
-    # Set up our cache client (if any)
-    redis_setup()
+    # Set up our caching layers (if any) and metrics.  Only the master
+    # process (i.e. worker 0, unless lazy-apps is enabled) empties the
+    # shared memory cache, as the workers it forks share it from then on
+    cache_setup(uwsgi.worker_id() == 0)
+    metrics_setup(uwsgi.numproc * 2)
+    admission_setup(uwsgi.numproc * 2)
+    statsd_setup()
+    proxy_pool_setup()
+
+    # Have uWSGI periodically run our disk cache sweeper in a mule, so that
+    # it doesn't hold up requests.  Without any mules, fall back to a worker
+    if disk_cache:
+        target = "mule"
+        if "mules" not in uwsgi.opt and "mule" not in uwsgi.opt:
+            logger.warning("No uWSGI mules are configured; sweeping the "
+                "disk cache in a worker")
+            target = "worker"
+        uwsgi.register_signal(DISK_SWEEP_SIGNAL, target, disk_cache_sweep)
+        uwsgi.add_timer(DISK_SWEEP_SIGNAL, cfg.disk_cache_sweep_interval)
 
@@ -0,0 +1,135 @@
+# Helpers shared by our tests: a scratch http_root with a config file, and
+# requests run through dirpy_worker() in-process
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import dirpy
+from PIL import Image, ImageDraw
+
+
+# Create a scratch http_root, write a config file into it with the given
+# global options and set Dirpy up with it, returning the root's path
+def dirpy_setup(**opts): #####################################################
+    root = tempfile.mkdtemp()
+    opts.setdefault("http_root", root)
+
+    cfg_file = os.path.join(root, "dirpy.conf")
+    with open(cfg_file, "w") as fh:
+        fh.write("[global]\n")
+        for name, val in sorted(opts.items()):
+            fh.write("%s=%s\n" % (name, str(val).replace("%(root)s", root)))
+
+    dirpy.read_config(argv=["-c", cfg_file, "-f"])
+    dirpy.logger_setup()
+    dirpy.cache_setup(True)
+    dirpy.metrics_setup(1)
+    dirpy.admission_setup(1)
+    dirpy.statsd_setup()
+    dirpy.proxy_pool_setup()
+
+    return root
+
+
+# Remove a scratch http_root created by dirpy_setup()
+def dirpy_teardown(root): ####################################################
+    shutil.rmtree(root)
+
+
+# Write a photo-like test image, with both smooth gradients and edges, to
+# the given path under our http_root
+def write_image(root, path, size=(640, 480), fmt="JPEG"): ####################
+    im = Image.merge("RGB", (Image.linear_gradient("L"),
+        Image.radial_gradient("L"),
+        Image.linear_gradient("L").rotate(90))).resize(size)
+    draw = ImageDraw.Draw(im)
+    draw.ellipse([size[0] // 6, size[1] // 8, size[0] * 5 // 8,
+        size[1] * 5 // 8], fill=(240, 200, 40))
+    draw.rectangle([size[0] * 2 // 3, size[1] * 5 // 8, size[0] * 15 // 16,
+        size[1] * 15 // 16], fill=(20, 40, 160))
+    im.save(os.path.join(root, path.lstrip("/")), fmt)
+
+
+# Run a request through dirpy_worker(), returning its dirpy object and body
+def request(url, post=None, headers=None, method="GET"): #####################
+    dirpy_obj = dirpy.dirpy_worker(dirpy.urlparse.urlparse(url),
+        io.BytesIO(post) if post is not None else None, headers, method)
+    if dirpy_obj.out_buf is None:
+        return dirpy_obj, b""
+
+    return dirpy_obj, b"".join(dirpy.output_chunks(dirpy_obj.out_buf))
+
+
+# Open the image in a response body
+def open_image(body): ########################################################
+    return Image.open(io.BytesIO(body))
+
+
+# A local origin server for proxied source images.  Files are served with
+# their ETag or Last-Modified header (if they have one), and conditional
+# requests that match them are answered with a 304.  The path and headers
+# (with lowercased names) of each request are recorded, and responses can
+# be held up by a delay
+class Origin: ################################################################
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        self.delay = 0
+        self.added = 0
+
+        origin = self
+
+        class Handler(dirpy.http_server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                headers = dict((name.lower(), val)
+                    for name, val in self.headers.items())
+                origin.requests.append((self.path, headers))
+                time.sleep(origin.delay)
+                if self.path not in origin.files:
+                    self.send_error(404)
+                    return
+                body, validator = origin.files[self.path]
+                header = validator and (validator.startswith('"') and
+                    "ETag" or "Last-Modified")
+                if validator and validator in (
+                        self.headers.get("If-None-Match"),
+                        self.headers.get("If-Modified-Since")):
+                    self.send_response(304)
+                    self.send_header(header, validator)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                if validator:
+                    self.send_header(header, validator)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = dirpy.http_server.HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Serve a new image at the given path, with an optional ETag (a quoted
+    # string) or Last-Modified date as its validator
+    def add_image(self, path, size=(640, 480), validator=None):
+        self.added += 1
+        im = Image.new("RGB", size, (self.added * 40 % 256, 80, 160))
+        out = io.BytesIO()
+        im.save(out, "JPEG")
+        self.files[path] = (out.getvalue(), validator)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,185 @@
+# Test host-wide admission control: the pixel budget, heavy request lanes
+# and the reaping of reservations held by workers that have died
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image, request
+import dirpy
+
+
+# Take a lane (and some of our budget) in a new worker process, either
+# giving them back after hold seconds or dying with them still held
+def hold_in_worker(admission, hold, die=False): ##############################
+    def worker():
+        admission.acquire_lane(1, 0)
+        admission.acquire(500)
+        time.sleep(hold)
+        if die:
+            os._exit(0)
+        admission.release(500, True)
+
+    proc = multiprocessing.Process(target=worker)
+    proc.start()
+
+    # Wait for the worker to take its lane
+    while admission.in_flight() != (500, 1):
+        time.sleep(0.01)
+
+    return proc
+
+
+class AdmissionTest(unittest.TestCase): ######################################
+
+    def setUp(self):
+        self.root = dirpy_setup(pixel_budget=1000, heavy_slots=1,
+            heavy_cost=1000000, heavy_wait=200, retry_after=3, lazy=True)
+        write_image(self.root, "test.jpg", (1600, 1200))
+
+        # Leave enough slots for the workers we start
+        dirpy.admission_setup(4)
+        self.admission = dirpy.admission
+
+    def tearDown(self):
+        dirpy_teardown(self.root)
+
+    def test_budget(self): ###################################################
+        admission = self.admission
+        self.assertTrue(admission.acquire(600))
+        self.assertFalse(admission.full())
+        self.assertFalse(admission.acquire(600))
+        self.assertTrue(admission.acquire(400))
+        self.assertTrue(admission.full())
+        admission.release(1000)
+        self.assertEqual(admission.in_flight(), (0, 0))
+
+        # Requests costing more than the whole budget run on their own
+        self.assertTrue(admission.acquire(5000))
+        self.assertFalse(admission.acquire(1))
+        admission.release(5000)
+
+    def test_lane_wait(self): ################################################
+        admission = self.admission
+        self.assertTrue(admission.acquire_lane(1, 0))
+
+        # A heavy request waits for a lane, up to its timeout
+        start = time.time()
+        self.assertFalse(admission.acquire_lane(1, 0.2))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+        # And gets one as soon as it's given back, in this worker
+        timer = threading.Timer(0.1, admission.release, (0, True))
+        timer.start()
+        start = time.time()
+        self.assertTrue(admission.acquire_lane(1, 5))
+        self.assertLess(time.time() - start, 2)
+        timer.join()
+        admission.release(0, True)
+
+        # Or in another one
+        proc = hold_in_worker(admission, 0.2)
+        start = time.time()
+        self.assertTrue(admission.acquire_lane(1, 5))
+        self.assertLess(time.time() - start, 2)
+        admission.release(0, True)
+        proc.join()
+        self.assertEqual(admission.in_flight(), (0, 0))
+
+    def test_reap(self): #####################################################
+        admission = self.admission
+
+        # Workers that die (once their parent has reaped them) don't keep
+        # their lane or budget
+        proc = hold_in_worker(admission, 0.1, True)
+        reaper = threading.Thread(target=proc.join)
+        reaper.start()
+        self.assertTrue(admission.acquire_lane(1, 5))
+        reaper.join()
+        self.assertEqual(admission.in_flight(), (0, 1))
+        admission.release(0, True)
+
+        proc = hold_in_worker(admission, 0, True)
+        proc.join()
+        self.assertTrue(admission.acquire(1000))
+        self.assertEqual(admission.in_flight(), (1000, 0))
+        admission.release(1000)
+
+        proc = hold_in_worker(admission, 0, True)
+        self.admission.budget = 500
+        proc.join()
+        self.assertFalse(admission.full())
+
+    def test_requests(self): #################################################
+        # Cheap requests are admitted while the heavy lane is busy
+        self.admission.acquire_lane(1, 0)
+        dirpy_obj, body = request("/test.jpg?resize=10x")
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+
+        # Heavy requests wait for it, and are turned away if it stays busy
+        dirpy_obj, body = request("/test.jpg?resize=3000x")
+        self.assertEqual(dirpy_obj.http_code, 503)
+        self.assertEqual(dirpy_obj.retry_after, 3)
+        self.assertGreaterEqual(dirpy_obj.meta_data["ms"]["time_lane_wait"],
+            0.2)
+
+        timer = threading.Timer(0.1, self.admission.release, (0, True))
+        timer.start()
+        dirpy_obj, body = request("/test.jpg?resize=3000x")
+        timer.join()
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+        self.assertEqual(self.admission.in_flight(), (0, 0))
+
+    def test_reservations(self): #############################################
+        admission = self.admission
+
+        # Requests costing more than our whole budget run on their own, and
+        # give back what they reserved whether they succeed or fail
+        for url in ("/test.jpg?resize=10x", "/test.jpg?bogus",
+                "/test.jpg?variant&resize=10x&variant&resize=20x"):
+            dirpy_obj, body = request(url)
+            self.assertNotEqual(dirpy_obj.http_code, 503, url)
+            self.assertEqual(admission.in_flight(), (0, 0), url)
+
+        # But are turned away while anything else is in flight, once we know
+        # their cost
+        admission.acquire(1)
+        dirpy_obj, body = request("/test.jpg?resize=10x")
+        self.assertEqual(dirpy_obj.http_code, 503)
+        self.assertEqual(dirpy_obj.retry_after, 3)
+        self.assertEqual(dirpy_obj.meta_data["c"]["overload"], 1)
+        self.assertIn("in_width", dirpy_obj.meta_data["g"])
+        self.assertEqual(admission.in_flight(), (1, 0))
+        admission.release(1)
+
+        # Or before even loading them once we're full
+        admission.acquire(1000)
+        dirpy_obj, body = request("/test.jpg?resize=10x")
+        self.assertEqual(dirpy_obj.http_code, 503)
+        self.assertNotIn("in_width", dirpy_obj.meta_data["g"])
+
+        # Lazy requests don't render anything, so they're always admitted
+        dirpy_obj, body = request("/test.jpg?resize=10x", method="HEAD")
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+        admission.release(1000)
+        self.assertEqual(admission.in_flight(), (0, 0))
+
+    def test_cost(self): #####################################################
+        # Shrinking JPEGs is cheaper, as they're decoded at a reduced scale
+        cmds = [ ["resize", {"100x": True}] ]
+        jpeg_cost = dirpy.request_cost(1600, 1200, "jpeg", cmds)
+        png_cost = dirpy.request_cost(1600, 1200, "png", cmds)
+        self.assertLess(jpeg_cost, png_cost / 10)
+        self.assertGreater(png_cost, 2 * 1600 * 1200)
+
+        # Costs follow the dimensions through each command
+        self.assertGreater(dirpy.request_cost(100, 100, "png",
+            [ ["resize", {"pct": "1000"}] ]), 100 * 100 * 100)
+        self.assertEqual(dirpy.request_cost(100, 100, "png",
+            [ ["crop", {"10x10x60x60": True}] ]),
+            2 * 100 * 100 + 2 * 50 * 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+# Test the async mode server's HTTP handling, both over real connections
+# and against a stand-in transport
+import socket
+import threading
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image
+import dirpy
+
+if dirpy.asyncio is not None:
+    import concurrent.futures
+
+
+# A transport that records what our protocol does with it
+class FakeTransport: #########################################################
+
+    def __init__(self):
+        self.data       = b""
+        self.paused     = False
+        self.closed     = False
+
+    def write(self, data):
+        self.data += data
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        self.closed = True
+
+
+# An event loop that runs nothing, handing back the futures of the work
+# given to it instead
+class FakeLoop: ##############################################################
+
+    def __init__(self):
+        self.work = []
+
+    def call_later(self, delay, callback):
+        return threading.Timer(delay, callback)
+
+    def run_in_executor(self, executor, func, *args):
+        future = concurrent.futures.Future()
+        self.work.append((future, func, args))
+        return future
+
+
+@unittest.skipIf(dirpy.asyncio is None, "Async mode requires Python 3")
+class AsyncTest(unittest.TestCase): ##########################################
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = dirpy_setup(max_post_bytes=1000000)
+        write_image(cls.root, "test.jpg")
+
+        cls.loop = dirpy.asyncio.new_event_loop()
+        cls.executor = concurrent.futures.ThreadPoolExecutor(4)
+        cls.server = cls.loop.run_until_complete(cls.loop.create_server(
+            lambda: dirpy.DirpyAsyncProtocol(cls.loop, cls.executor),
+            "127.0.0.1", 0))
+        cls.port = cls.server.sockets[0].getsockname()[1]
+        cls.thread = threading.Thread(target=cls.loop.run_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.server.close()
+        cls.loop.close()
+        cls.executor.shutdown()
+        dirpy_teardown(cls.root)
+
+    # Send raw request data over a new connection, returning everything that
+    # the server sends back before it closes the connection
+    def send(self, data): ####################################################
+        conn = socket.create_connection(("127.0.0.1", self.port), 10)
+        conn.sendall(data)
+        resp = b""
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            resp += chunk
+        conn.close()
+
+        return resp
+
+    def test_pipelined(self): ################################################
+        req = b"GET /test.jpg?resize=100x HTTP/1.1\r\nHost: x\r\n\r\n"
+        resp = self.send(req + req + req.replace(b"Host: x",
+            b"Host: x\r\nConnection: close"))
+        self.assertEqual(resp.count(b"HTTP/1.1 200 OK\r\n"), 3)
+        self.assertTrue(resp.startswith(b"HTTP/1.1 200 OK\r\n"))
+
+    def test_bad_lengths(self): ##############################################
+        for length, status in ((b"99999999999", b"413"), (b"-5", b"400"),
+                (b"abc", b"400"), (b"10\r\nContent-Length: 20", b"400")):
+            resp = self.send(b"POST /test.jpg HTTP/1.1\r\nHost: x\r\n"
+                b"Content-Length: " + length + b"\r\n\r\n")
+            self.assertTrue(resp.startswith(b"HTTP/1.1 " + status), resp)
+
+    def test_chunked(self): ##################################################
+        resp = self.send(b"POST /test.jpg HTTP/1.1\r\nHost: x\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n0\r\n\r\n")
+        self.assertTrue(resp.startswith(b"HTTP/1.1 411 Length Required"))
+
+    def test_huge_head(self): ################################################
+        resp = self.send(b"GET /test.jpg HTTP/1.1\r\nX: " + b"x" * 100000)
+        self.assertTrue(resp.startswith(b"HTTP/1.1 431"), resp[:40])
+
+    def test_paused_while_busy(self): ########################################
+        loop = FakeLoop()
+        transport = FakeTransport()
+        protocol = dirpy.DirpyAsyncProtocol(loop, None)
+        protocol.connection_made(transport)
+
+        # Reading stops while our request is in flight
+        req = b"GET /test.jpg?resize=100x HTTP/1.1\r\nHost: x\r\n\r\n"
+        protocol.data_received(req + req[:10])
+        self.assertTrue(transport.paused)
+        self.assertEqual(len(loop.work), 1)
+
+        # And resumes once it's answered, with the next one in flight
+        protocol.data_received(req[10:])
+        self.assertEqual(len(loop.work), 1)
+        future, func, args = loop.work[0]
+        future.set_result(func(*args))
+        self.assertTrue(transport.data.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertEqual(len(loop.work), 2)
+        self.assertTrue(transport.paused)
+
+        future, func, args = loop.work[1]
+        future.set_result(func(*args))
+        self.assertEqual(transport.data.count(b"HTTP/1.1 200 OK\r\n"), 2)
+        self.assertFalse(transport.paused)
+        self.assertFalse(transport.closed)
+        protocol.connection_lost(None)
+
+        # Unless the client is slow to read our responses
+        transport = FakeTransport()
+        protocol = dirpy.DirpyAsyncProtocol(loop, None)
+        protocol.connection_made(transport)
+        protocol.data_received(req)
+        protocol.pause_writing()
+        future, func, args = loop.work[2]
+        future.set_result(func(*args))
+        self.assertTrue(transport.paused)
+        protocol.resume_writing()
+        self.assertFalse(transport.paused)
+        protocol.connection_lost(None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# Test batches of variants rendered from a single source image, and the
+# multipart responses that they're returned in
+import re
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image, request, \
+    open_image
+
+
+class BatchTest(unittest.TestCase): ##########################################
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = dirpy_setup()
+        write_image(cls.root, "test.jpg")
+
+    @classmethod
+    def tearDownClass(cls):
+        dirpy_teardown(cls.root)
+
+    # Split a multipart response into a list of (headers, body) parts,
+    # checking each part's Content-Length against its body
+    def parts(self, dirpy_obj, body): ########################################
+        boundary = re.search(r'boundary="([^"]+)"',
+            dirpy_obj.content_type).group(1).encode("utf-8")
+        self.assertTrue(body.endswith(b"--" + boundary + b"--\r\n"))
+
+        parts = []
+        for part in body.split(b"--" + boundary)[1:-1]:
+            head, part_body = part[2:].split(b"\r\n\r\n", 1)
+            self.assertTrue(part_body.endswith(b"\r\n"))
+            part_body = part_body[:-2]
+            headers = dict(line.decode("utf-8").split(": ", 1)
+                for line in head.split(b"\r\n"))
+            self.assertEqual(int(headers["Content-Length"]), len(part_body))
+            parts.append((headers, part_body))
+
+        return parts
+
+    def test_no_prefix(self): ################################################
+        for query in ("variant&resize=100x&variant&resize=200x",
+                "variant=name:s&resize=100x&variant=name:m&resize=200x"):
+            dirpy_obj, body = request("/test.jpg?" + query)
+            self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+
+            parts = self.parts(dirpy_obj, body)
+            self.assertEqual([ open_image(b).size for h, b in parts ],
+                [(100, 75), (200, 150)])
+
+        self.assertEqual([ h["Dirpy-Variant"] for h, b in parts ], ["s", "m"])
+
+    def test_prefix(self): ###################################################
+        dirpy_obj, body = request("/test.jpg?crop=320x240,gravity:nw&"
+            "variant&resize=100x&variant&save=fmt:png")
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+
+        parts = self.parts(dirpy_obj, body)
+        self.assertEqual([ h["Dirpy-Variant"] for h, b in parts ], ["0", "1"])
+        self.assertEqual([ h["Content-Type"] for h, b in parts ],
+            ["image/jpeg", "image/png"])
+        self.assertEqual([ open_image(b).size for h, b in parts ],
+            [(100, 75), (320, 240)])
+
+    def test_noshow(self): ###################################################
+        dirpy_obj, body = request("/test.jpg?"
+            "variant&resize=100x&variant&resize=50x&save=noshow")
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+
+        parts = self.parts(dirpy_obj, body)
+        self.assertEqual(open_image(parts[0][1]).size, (100, 75))
+        self.assertEqual(parts[1][1], b"")
+
+    def test_empty_pairs(self): ##############################################
+        dirpy_obj, body = request("/test.jpg?resize=200x&&")
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+        self.assertEqual(open_image(body).size, (200, 150))
+
+        dirpy_obj, body = request("/test.jpg")
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+        self.assertEqual(open_image(body).size, (640, 480))
+
+
+if __name__ == "__main__":
+    unittest.main()
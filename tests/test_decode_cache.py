@@ -0,0 +1,110 @@
+# Test the in-process cache of source images and their decodes
+import threading
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image, request, \
+    open_image
+import dirpy
+from PIL import Image
+
+
+class DecodeCacheTest(unittest.TestCase): ####################################
+
+    def setUp(self):
+        self.root = None
+
+    def tearDown(self):
+        if self.root:
+            dirpy_teardown(self.root)
+
+    # Set Dirpy up with a decode cache of the given size, and a test image
+    def setup_cache(self, max_bytes, **opts): ################################
+        self.root = dirpy_setup(decode_cache_bytes=max_bytes, **opts)
+        write_image(self.root, "test.jpg", (1600, 1200))
+
+    def test_reuse(self): ####################################################
+        self.setup_cache(50000000)
+        dirpy_obj, body = request("/test.jpg?crop=100x100")
+        self.assertEqual(dirpy_obj.meta_data["c"].get("decode_cache_miss"), 1)
+
+        dirpy_obj, body = request("/test.jpg?crop=200x100")
+        self.assertEqual(dirpy_obj.meta_data["c"].get("decode_cache_hit"), 1)
+        self.assertEqual(open_image(body).size, (200, 100))
+
+        cache = dirpy.decode_cache
+        entry = list(cache.entries.values())[0][0]
+        self.assertEqual(cache.cur_bytes, entry.nbytes)
+        self.assertEqual(entry.nbytes, len(entry.data) + 1600 * 1200 * 3)
+
+    def test_budget(self): ###################################################
+        # The source fits, but its full size decode doesn't
+        self.setup_cache(2000000)
+        for i in range(3):
+            dirpy_obj, body = request("/test.jpg?crop=100x100")
+            self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+
+        cache = dirpy.decode_cache
+        self.assertEqual(len(cache.entries), 1)
+        entry = list(cache.entries.values())[0][0]
+        self.assertEqual(entry.decodes, {})
+        self.assertEqual(cache.cur_bytes, entry.nbytes)
+        self.assertLessEqual(cache.cur_bytes, cache.max_bytes)
+
+        # A draft decode that does fit is still shared
+        dirpy_obj, body = request("/test.jpg?resize=100x")
+        self.assertEqual(list(entry.decodes), [(200, 150)])
+        self.assertEqual(cache.cur_bytes, entry.nbytes)
+
+    def test_oversized_put(self): ############################################
+        cache = dirpy.DirpyLruCache(1000)
+        cache.put("a", "small", 100)
+        cache.put("b", "big", 500)
+        cache.put("a", "grown", 2000)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b"), "big")
+        self.assertEqual(cache.cur_bytes, 500)
+
+    def test_shared_entry(self): #############################################
+        entry = dirpy.DirpySource(b"", None)
+        errors = []
+
+        # Add decodes of lots of sizes while other threads look them up
+        added = threading.Event()
+        def add():
+            try:
+                for i in range(1, 1000):
+                    entry.add(Image.new("L", (i, 1)), 1 << 30)
+            finally:
+                added.set()
+
+        def find():
+            try:
+                while not added.is_set():
+                    entry.find((500, 1))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [ threading.Thread(target=add) ] + [
+            threading.Thread(target=find) for i in range(3) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(entry.find((500, 1)).size, (500, 1))
+
+    def test_batch_keep(self): ###############################################
+        # Unmodified variants keep their JPEG settings, with or without a
+        # decode cache
+        for max_bytes in (0, 50000000):
+            self.setup_cache(max_bytes)
+            dirpy_obj, body = request("/test.jpg?variant&variant&resize=100x")
+            self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+            self.assertEqual(dirpy_obj.meta_data["c"]["variants"], 2)
+            dirpy_teardown(self.root)
+            self.root = None
+
+
+if __name__ == "__main__":
+    unittest.main()
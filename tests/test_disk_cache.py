@@ -0,0 +1,125 @@
+# Test the on-disk result cache: its file layout, its running total of the
+# bytes it uses, and sweeping it back under its size limit
+import fcntl
+import os
+import time
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image, request
+import dirpy
+
+
+# Return a cache key with the given prefix
+def cache_key(prefix): #######################################################
+    return prefix + "0" * (40 - len(prefix))
+
+
+class DiskCacheTest(unittest.TestCase): ######################################
+
+    def setUp(self):
+        self.root = dirpy_setup(disk_cache_root="%(root)s/cache",
+            disk_cache_max_bytes=1000)
+        write_image(self.root, "test.jpg")
+        self.cache = dirpy.disk_cache
+        self.cache_root = os.path.join(self.root, "cache")
+
+    def tearDown(self):
+        dirpy_teardown(self.root)
+
+    # Set a cached record's mtime to the given number of seconds ago
+    def age(self, key, secs):
+        path = self.cache._path(key)
+        os.utime(path, (time.time() - secs, time.time() - secs))
+
+    def test_get_put(self): ##################################################
+        cache = self.cache
+        key = cache_key("abcdef")
+        self.assertIsNone(cache.get(key))
+        self.assertTrue(cache.put(key, b"x" * 100))
+        self.assertEqual(cache.get(key), b"x" * 100)
+        self.assertTrue(os.path.isfile(os.path.join(self.cache_root, "ab",
+            "cd", key)))
+        self.assertEqual(cache.usage()[0], 100)
+
+        # Replacing a record only counts the difference
+        cache.put(key, b"y" * 40)
+        cache.put(cache_key("ab1234"), b"z" * 10)
+        self.assertEqual(cache.usage()[0], 50)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.cache_root,
+            "ab"))), ["12", "cd"])
+
+        # The total is shared with other workers
+        other = dirpy.DirpyDiskCache(self.cache_root, 1000, 2)
+        other.put(cache_key("ff"), b"w" * 5)
+        self.assertEqual(cache.usage()[0], 55)
+
+        # Reads mark records as recently used, but not every time
+        self.age(key, 10)
+        mtime = os.stat(cache._path(key)).st_mtime
+        cache.get(key)
+        self.assertEqual(os.stat(cache._path(key)).st_mtime, mtime)
+        self.age(key, cache.touch_interval + 10)
+        cache.get(key)
+        self.assertGreater(os.stat(cache._path(key)).st_mtime, mtime)
+
+    def test_sweep(self): ####################################################
+        cache = self.cache
+        keys = [ cache_key("%02x" % i) for i in range(12) ]
+        for i, key in enumerate(keys):
+            cache.put(key, b"x" * 100)
+            self.age(key, 1000 - i)
+
+        # Records read recently are kept, the rest go oldest first until
+        # we're down to our low water mark
+        cache.get(keys[0])
+        self.assertEqual(cache.sweep(), 3)
+        self.assertEqual(cache.usage()[0], 900)
+        for key in keys[1:4]:
+            self.assertIsNone(cache.get(key))
+        for key in keys[:1] + keys[4:]:
+            self.assertIsNotNone(cache.get(key))
+
+        # Under our limit, the cache is only walked to recount it
+        os.unlink(cache._path(keys[6]))
+        self.assertEqual(cache.sweep(), 0)
+        self.assertEqual(cache.usage()[0], 900)
+        cache._update_usage(0, time.time() - cache.recount_interval - 1)
+        self.assertEqual(cache.sweep(), 0)
+        self.assertEqual(cache.usage()[0], 800)
+
+        # Temp files left behind by crashed writers are cleaned up, once
+        # they're old enough not to belong to a write in progress
+        old_tmp = cache._path(keys[0]) + ".1.1.tmp"
+        new_tmp = cache._path(keys[0]) + ".2.2.tmp"
+        for path in (old_tmp, new_tmp):
+            with open(path, "wb") as fh:
+                fh.write(b"x" * 500)
+        os.utime(old_tmp, (0, 0))
+        cache._update_usage(0, 0)
+        cache.sweep()
+        self.assertFalse(os.path.exists(old_tmp))
+        self.assertTrue(os.path.exists(new_tmp))
+        self.assertEqual(cache.usage()[0], 800)
+
+        # Only one worker sweeps at a time
+        for key in keys:
+            cache.put(key, b"x" * 100)
+        lock_fd = os.open(os.path.join(self.cache_root, ".sweep.lock"),
+            os.O_RDWR)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            self.assertEqual(cache.sweep(), 0)
+        finally:
+            os.close(lock_fd)
+        self.assertEqual(cache.sweep(), 3)
+
+    def test_requests(self): #################################################
+        dirpy_obj, body = request("/test.jpg?resize=10x")
+        self.assertEqual(dirpy_obj.meta_data["c"].get("disk_cache_write"), 1)
+        dirpy_obj, cached_body = request("/test.jpg?resize=10x")
+        self.assertEqual(dirpy_obj.meta_data["c"].get("disk_cache_hit"), 1)
+        self.assertEqual(cached_body, body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+# Test request coalescing: the flight lock shared by threads and worker
+# processes, and waiters either using the result of the request they waited
+# on or failing along with it
+import multiprocessing
+import threading
+import time
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, request, Origin
+import dirpy
+
+KEY = "0123456789abcdef0123456789abcdef01234567"
+
+
+# Acquire a flight in a new thread, returning the thread and a list that
+# the flight is put in once it's been acquired
+def acquire_in_thread(flight_lock, key): #####################################
+    flights = []
+    thread = threading.Thread(target=lambda:
+        flights.append(flight_lock.acquire(key)))
+    thread.start()
+
+    return thread, flights
+
+
+# Run requests in threads, starting the first one (that should lead the
+# flight) a little before the others.  Returns their results, in order
+def concurrent_requests(url, num): ###########################################
+    results = [ None ] * num
+
+    def run(i):
+        results[i] = request(url)
+
+    threads = [ threading.Thread(target=run, args=(i,)) for i in range(num) ]
+    threads[0].start()
+    time.sleep(0.1)
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+class FlightTest(unittest.TestCase): #########################################
+
+    def setUp(self):
+        self.root = dirpy_setup(coalesce="file",
+            coalesce_lock_file="%(root)s/flight.lock",
+            local_cache_bytes=10000000)
+        self.flight_lock = dirpy.flight_lock
+        self.origin = Origin()
+
+    def tearDown(self):
+        self.origin.close()
+        dirpy_teardown(self.root)
+
+    def test_threads(self): ##################################################
+        flight_lock = self.flight_lock
+        flight = flight_lock.acquire(KEY)
+        self.assertFalse(flight.waited)
+        self.assertTrue(flight.local and flight.shared)
+
+        # Other threads wait for the flight to land
+        thread, flights = acquire_in_thread(flight_lock, KEY)
+        time.sleep(0.2)
+        self.assertEqual(flights, [])
+        flight_lock.release(flight)
+        thread.join()
+        self.assertTrue(flights[0].waited)
+        self.assertTrue(flights[0].local and flights[0].shared)
+        flight_lock.release(flights[0])
+        self.assertEqual(flight_lock.keys, {})
+
+        # But only up to our timeout
+        flight = flight_lock.acquire(KEY)
+        flight_lock.timeout = 0.2
+        start = time.time()
+        waiter = flight_lock.acquire(KEY)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertTrue(waiter.waited)
+        self.assertFalse(waiter.local or waiter.shared)
+        flight_lock.release(waiter)
+        flight_lock.release(flight)
+        self.assertEqual(flight_lock.keys, {})
+
+    def test_processes(self): ################################################
+        flight_lock = self.flight_lock
+        acquired = multiprocessing.Event()
+
+        def leader():
+            flight = flight_lock.acquire(KEY)
+            acquired.set()
+            time.sleep(0.3)
+            flight_lock.fail(flight, 503, "Too busy", 3)
+            flight_lock.release(flight)
+
+        proc = multiprocessing.Process(target=leader)
+        proc.start()
+        acquired.wait(5)
+
+        # We wait for the flight in the other process, and see its failure
+        start = time.time()
+        flight = flight_lock.acquire(KEY)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertTrue(flight.waited and flight.shared)
+        self.assertEqual(flight_lock.failure(flight), (503, "Too busy", 3))
+        flight_lock.release(flight)
+        proc.join()
+
+        # Failures from before a flight started don't count against it
+        flight = flight_lock.acquire(KEY)
+        self.assertFalse(flight.waited)
+        self.assertIsNone(flight_lock.failure(flight))
+        flight_lock.release(flight)
+
+        # Nor do those of other keys sharing its slot
+        other_key = KEY[:8] + "f" * 32
+        flight = flight_lock.acquire(other_key)
+        flight_lock.fail(flight, 500, "Oops", None)
+        flight_lock.release(flight)
+        flight = flight_lock.acquire(KEY)
+        flight.start -= 1
+        self.assertIsNone(flight_lock.failure(flight))
+        flight_lock.release(flight)
+
+    def test_requests(self): #################################################
+        self.origin.add_image("/a.jpg")
+        self.origin.delay = 0.5
+
+        # Only the first request renders the result, which the others use
+        results = concurrent_requests("/a.jpg?load=proxy:%s&resize=100x" %
+            self.origin.url, 3)
+        self.assertEqual(len(self.origin.requests), 1)
+        for dirpy_obj, body in results:
+            self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+            self.assertEqual(body, results[0][1])
+        self.assertNotIn("coalesce_wait", results[0][0].meta_data["c"])
+        for dirpy_obj, body in results[1:]:
+            self.assertEqual(dirpy_obj.meta_data["c"]["coalesce_hit"], 1)
+
+    def test_leader_failure(self): ###########################################
+        self.origin.delay = 0.5
+
+        # The others fail along with the first request, without retrying
+        results = concurrent_requests("/b.jpg?load=proxy:%s&resize=100x" %
+            self.origin.url, 3)
+        self.assertEqual(len(self.origin.requests), 1)
+        for dirpy_obj, body in results:
+            self.assertEqual(dirpy_obj.http_code, 404)
+        for dirpy_obj, body in results[1:]:
+            self.assertEqual(dirpy_obj.meta_data["c"]["coalesce_fail"], 1)
+            self.assertEqual(dirpy_obj.http_msg, results[0][0].http_msg)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# Test client-facing HTTP caching: ETags and Last-Modified dates derived
+# from the version of a result's source, conditional requests answered
+# with a 304 and wildcard If-None-Match headers
+import email.utils
+import os
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image, request, \
+    Origin
+import dirpy
+
+URL = "/test.jpg?resize=100x"
+
+
+class HttpCacheTest(unittest.TestCase): ######################################
+
+    def setUp(self):
+        self.root = dirpy_setup(local_cache_bytes=10000000,
+            cache_control="public, max-age=60")
+        write_image(self.root, "test.jpg")
+        self.mtime = int(os.stat(os.path.join(self.root,
+            "test.jpg")).st_mtime)
+        self.etag = request(URL)[0].etag
+
+    def tearDown(self):
+        dirpy_teardown(self.root)
+
+    # Run a conditional request, returning its HTTP code.  Its 304s should
+    # still tell the client what its copy's ETag is
+    def code(self, url=URL, **headers):
+        dirpy_obj, body = request(url, headers=dict(
+            (name.replace("_", "-"), val) for name, val in headers.items()))
+        if dirpy_obj.http_code == 304:
+            self.assertTrue(dirpy_obj.etag)
+        return dirpy_obj.http_code
+
+    def test_headers(self): ##################################################
+        dirpy_obj, body = request(URL)
+        self.assertTrue(self.etag.startswith('"'))
+        self.assertEqual(dirpy_obj.etag, self.etag)
+        self.assertEqual(dirpy.cache_headers(dirpy_obj), [
+            ("ETag", self.etag),
+            ("Last-Modified", email.utils.formatdate(self.mtime,
+                usegmt=True)),
+            ("Cache-Control", "public, max-age=60") ])
+
+        # Each result of a source has its own ETag
+        self.assertNotEqual(request("/test.jpg?resize=50x")[0].etag,
+            self.etag)
+
+        # Errors don't get any
+        dirpy_obj, body = request("/missing.jpg?resize=100x")
+        self.assertEqual(dirpy.cache_headers(dirpy_obj), [])
+
+    def test_if_none_match(self): ############################################
+        self.assertEqual(self.code(If_None_Match=self.etag), 304)
+        self.assertEqual(self.code(If_None_Match="W/" + self.etag), 304)
+        self.assertEqual(self.code(If_None_Match='"a", %s' % self.etag), 304)
+        self.assertEqual(self.code(If_None_Match='"a"'), 200)
+
+        # Unchanged local sources are answered before they're loaded
+        dirpy_obj, body = request(URL, headers={"If-None-Match": self.etag})
+        self.assertNotIn("in_width", dirpy_obj.meta_data["g"])
+        self.assertEqual(dirpy_obj.meta_data["c"]["not_modified"], 1)
+
+        # Changing the source changes the ETag (once our cached result of
+        # the old source is gone)
+        write_image(self.root, "test.jpg", (320, 240))
+        dirpy.local_cache_setup()
+        self.assertEqual(self.code(If_None_Match=self.etag), 200)
+
+        # And POSTed images are never answered with a 304
+        dirpy.cfg.allow_post = True
+        with open(os.path.join(self.root, "test.jpg"), "rb") as fh:
+            dirpy_obj, body = request("/test.jpg?load=post&resize=100x",
+                post=fh.read(), headers={"If-None-Match": "*"},
+                method="POST")
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+
+    def test_if_modified_since(self): ########################################
+        self.assertEqual(self.code(
+            If_Modified_Since=email.utils.formatdate(self.mtime)), 304)
+        self.assertEqual(self.code(
+            If_Modified_Since=email.utils.formatdate(self.mtime + 60)), 304)
+        self.assertEqual(self.code(
+            If_Modified_Since=email.utils.formatdate(self.mtime - 60)), 200)
+        self.assertEqual(self.code(If_Modified_Since="yesterday"), 200)
+
+        # If-None-Match takes precedence
+        self.assertEqual(self.code(If_None_Match='"a"',
+            If_Modified_Since=email.utils.formatdate(self.mtime)), 200)
+
+    def test_wildcard(self): #################################################
+        # A wildcard matches any result we have, rendered or cached...
+        self.assertEqual(self.code(If_None_Match="*"), 304)
+        self.assertEqual(self.code("/test.jpg?resize=60x",
+            If_None_Match="*"), 304)
+
+        # ...but never one that doesn't exist
+        self.assertNotIn(self.code("/missing.jpg?resize=100x",
+            If_None_Match="*"), (200, 304))
+
+    def test_proxy(self): ####################################################
+        origin = Origin()
+        try:
+            origin.add_image("/a.jpg", validator='"v1"')
+            url = "/a.jpg?load=proxy:%s&resize=100x" % origin.url
+            etag = request(url)[0].etag
+            self.assertTrue(etag)
+
+            # Cached results of proxied sources are answered from our
+            # cache, without asking the origin
+            self.assertEqual(self.code(url, If_None_Match=etag), 304)
+            self.assertEqual(self.code(url, If_None_Match='"v1"'), 200)
+            self.assertEqual(len(origin.requests), 1)
+
+            # As are renders of unchanged sources
+            dirpy.local_cache_setup()
+            self.assertEqual(self.code(url, If_None_Match=etag), 304)
+            self.assertEqual(len(origin.requests), 2)
+        finally:
+            origin.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
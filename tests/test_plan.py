@@ -0,0 +1,106 @@
+# Compare images rendered with plan_cmds() against the same commands run one
+# by one, in the order that they were requested
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image, open_image
+import dirpy
+from PIL import ImageChops
+
+
+class PlanTest(unittest.TestCase): ###########################################
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = dirpy_setup()
+        write_image(cls.root, "test.png", fmt="PNG")
+
+    @classmethod
+    def tearDownClass(cls):
+        dirpy_teardown(cls.root)
+
+    # Render the query against our test image, planned or not
+    def render(self, query, planned): ########################################
+        args = { "load": {}, "save": {} }
+        cmds = dirpy.get_cmds(
+            dirpy.urlparse.urlparse("/test.png?%s" % query), args)
+        dirpy_obj = dirpy.DirpyImage(dirpy.cfg.http_root)
+        dirpy_obj.load(args["load"], "/test.png", None)
+        for step in dirpy.plan_cmds(cmds) if planned else cmds:
+            dirpy_obj.run(*step)
+        dirpy_obj.save(args["save"])
+
+        return open_image(dirpy_obj.out_buf.getvalue())
+
+    # Return the largest per-pixel difference between planned and unplanned
+    # renders of the query, which must have the same size and mode
+    def max_diff(self, query): ###############################################
+        planned = self.render(query, True)
+        unplanned = self.render(query, False)
+        self.assertEqual(planned.size, unplanned.size, query)
+        self.assertEqual(planned.mode, unplanned.mode, query)
+
+        diff = ImageChops.difference(planned.convert("RGB"),
+            unplanned.convert("RGB"))
+        return max(hi for lo, hi in diff.getextrema())
+
+    # Check that the queries render the same planned as unplanned (up to the
+    # rounding in the resize's two resampling passes, which older versions
+    # of Pillow do less precisely), and that they were planned as expected
+    def check(self, queries, planned_cmds, max_diff=3): ######################
+        for query in queries:
+            cmds = dirpy.get_cmds(
+                dirpy.urlparse.urlparse("/test.png?%s" % query), {})
+            self.assertEqual([ step[0] for step in dirpy.plan_cmds(cmds) ],
+                planned_cmds, query)
+            self.assertLessEqual(self.max_diff(query), max_diff, query)
+
+    def test_merged_transposes(self): ########################################
+        self.check(["transpose=rotate90&transpose=rotate90",
+            "transpose=rotate90&transpose=flipvert&transpose=rotate90"],
+            ["transpose"], 0)
+        self.check(["transpose=fliphorz&transpose=rotate270",
+            "transpose=flipvert&transpose=rotate90&transpose=rotate90&"
+            "transpose=rotate90"], ["transpose", "transpose"], 0)
+
+    def test_folded_crops(self): #############################################
+        if not dirpy.RESIZE_BOX:
+            self.skipTest("Pillow can't resize a box of an image")
+
+        # Shrinking and enlarging resizes, with the crop before and after
+        self.check(["resize=320x240&crop=10x20x110x120",
+            "resize=200x200,fill&crop=gravity:se",
+            "resize=300x100,fill&crop=gravity:s",
+            "resize=1000x&crop=100x100",
+            "resize=2000x2000,fill&crop=gravity:ne",
+            "crop=100x50x400x300&resize=200x",
+            "crop=300x200,gravity:ne&resize=pct:50",
+            "crop=300x200&resize=150x",
+            "crop=100x100&resize=400x",
+            "crop=300x200&resize=600x",
+            "crop=100x100&resize=400x400,portrait",
+            "crop=200x50,gravity:se&resize=500x500,unlock"], ["resize"])
+
+    def test_moved_transposes(self): #########################################
+        self.check(["transpose=fliphorz&resize=200x",
+            "transpose=rotate180&resize=pct:25",
+            "transpose=flipvert&resize=1000x"], ["resize", "transpose"])
+
+        if dirpy.RESIZE_BOX:
+            self.check(["transpose=fliphorz&crop=200x50,gravity:se&"
+                "resize=500x500,unlock"], ["transpose", "resize"])
+
+    def test_turned_resizes(self): ###########################################
+        self.check(["transpose=rotate90&resize=300x200,landscape",
+            "transpose=rotate270&resize=x100",
+            "transpose=rotate90&resize=200x300,portrait",
+            "transpose=rotate90&resize=1000x",
+            "transpose=rotate270&resize=900x900,unlock",
+            "transpose=rotate90&resize=2000x,shrink"], ["resize"])
+
+        if dirpy.RESIZE_BOX:
+            self.check(["crop=300x200&transpose=rotate90&resize=100x",
+                "crop=100x100&transpose=rotate270&resize=400x"], ["resize"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+# Test conditional revalidation: cached results are rechecked against
+# their (local or proxied) source once they're old enough, and proxied
+# sources kept by the decode cache are rechecked with a conditional GET
+import os
+import time
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image, request, \
+    open_image, Origin
+import dirpy
+
+# How often (in seconds) results are revalidated.  The config file only
+# takes whole seconds, so we set this on our config directly
+INTERVAL = 0.2
+
+
+class RevalidateTest(unittest.TestCase): #####################################
+
+    def setUp(self):
+        self.root = dirpy_setup(disk_cache_root="%(root)s/cache",
+            revalidate_interval=1)
+        dirpy.cfg.revalidate_interval = INTERVAL
+        self.origin = Origin()
+
+    def tearDown(self):
+        self.origin.close()
+        dirpy_teardown(self.root)
+
+    # Run a request once its cached result is due to be revalidated,
+    # returning its dirpy object, image and counters
+    def revalidate(self, url):
+        time.sleep(INTERVAL * 1.5)
+        dirpy_obj, body = request(url)
+        self.assertEqual(dirpy_obj.http_code, 200, dirpy_obj.http_msg)
+        return dirpy_obj, open_image(body), dirpy_obj.meta_data["c"]
+
+    def test_local(self): ####################################################
+        url = "/test.jpg?resize=100x"
+        write_image(self.root, "test.jpg", (640, 480))
+        request(url)
+
+        # Changes aren't noticed until the result is due to be rechecked
+        write_image(self.root, "test.jpg", (640, 320))
+        dirpy_obj, body = request(url)
+        self.assertEqual(open_image(body).size, (100, 75))
+        dirpy_obj, im, counters = self.revalidate(url)
+        self.assertEqual(counters.get("revalidate_stale"), 1)
+        self.assertEqual(im.size, (100, 50))
+
+        # Results that are still fresh are stored with their new
+        # validation time, so they aren't rechecked again straight away
+        dirpy_obj, im, counters = self.revalidate(url)
+        self.assertEqual(counters.get("revalidate_fresh"), 1)
+        self.assertEqual(counters.get("disk_cache_hit"), 1)
+        validated = dirpy_obj.validated
+        dirpy_obj, body = request(url)
+        self.assertEqual(dirpy_obj.validated, validated)
+        self.assertNotIn("revalidate_fresh", dirpy_obj.meta_data["c"])
+
+        # Deleted sources count as changed
+        os.unlink(os.path.join(self.root, "test.jpg"))
+        time.sleep(INTERVAL * 1.5)
+        dirpy_obj, body = request(url)
+        self.assertEqual(dirpy_obj.meta_data["c"].get("revalidate_stale"), 1)
+        self.assertNotEqual(dirpy_obj.http_code, 200)
+
+    def test_proxy(self): ####################################################
+        origin = self.origin
+        url = "/a.jpg?load=proxy:%s&resize=100x" % origin.url
+        origin.add_image("/a.jpg", (640, 480), '"v1"')
+        request(url)
+
+        # Unchanged proxied sources are checked with a conditional GET
+        dirpy_obj, im, counters = self.revalidate(url)
+        self.assertEqual(counters.get("revalidate_fresh"), 1)
+        self.assertEqual(len(origin.requests), 2)
+        self.assertEqual(origin.requests[1][1].get("if-none-match"), '"v1"')
+
+        # While changed ones are fetched and rendered again
+        origin.add_image("/a.jpg", (640, 320), '"v2"')
+        dirpy_obj, im, counters = self.revalidate(url)
+        self.assertEqual(counters.get("revalidate_stale"), 1)
+        self.assertEqual(im.size, (100, 50))
+        self.assertEqual(len(origin.requests), 4)
+        self.assertNotIn("if-none-match", origin.requests[3][1])
+
+        # Sources with a Last-Modified date are checked by that instead
+        lm_url = "/b.jpg?load=proxy:%s&resize=100x" % origin.url
+        origin.add_image("/b.jpg", validator="Wed, 21 Oct 2015 07:28:00 GMT")
+        request(lm_url)
+        dirpy_obj, im, counters = self.revalidate(lm_url)
+        self.assertEqual(counters.get("revalidate_fresh"), 1)
+        self.assertEqual(origin.requests[-1][1].get("if-modified-since"),
+            "Wed, 21 Oct 2015 07:28:00 GMT")
+
+        # Sources without either can't be checked, so they're refetched
+        bare_url = "/c.jpg?load=proxy:%s&resize=100x" % origin.url
+        origin.add_image("/c.jpg")
+        request(bare_url)
+        dirpy_obj, im, counters = self.revalidate(bare_url)
+        self.assertEqual(counters.get("revalidate_stale"), 1)
+
+        # If the origin can't be reached, we keep serving our result
+        origin.close()
+        dirpy_obj, im, counters = self.revalidate(url)
+        self.assertEqual(counters.get("revalidate_error"), 1)
+        self.assertEqual(im.size, (100, 50))
+
+    def test_decoded_source(self): ###########################################
+        dirpy.cfg.decode_cache_bytes = 100000000
+        dirpy.cfg.decode_cache_ttl = 0
+        dirpy.decode_cache_setup()
+
+        # Expired copies of proxied sources are reused if they haven't
+        # changed, and refetched if they have
+        origin = self.origin
+        origin.add_image("/a.jpg", (640, 480), '"v1"')
+        url = "/a.jpg?load=proxy:%s&resize=%%sx" % origin.url
+        request(url % 100)
+        dirpy_obj, body = request(url % 200)
+        self.assertEqual(dirpy_obj.meta_data["c"].get(
+            "source_cache_revalidated"), 1)
+        self.assertEqual(origin.requests[1][1].get("if-none-match"), '"v1"')
+
+        origin.add_image("/a.jpg", (640, 320), '"v2"')
+        dirpy_obj, body = request(url % 300)
+        self.assertNotIn("source_cache_revalidated", dirpy_obj.meta_data["c"])
+        self.assertEqual(open_image(body).size, (300, 150))
+
+
+if __name__ == "__main__":
+    unittest.main()
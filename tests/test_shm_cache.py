@@ -0,0 +1,134 @@
+# Test the shared memory result cache: its slot table, CLOCK eviction and
+# the seqlock that lets readers skip slots being written by another worker
+import multiprocessing
+import os
+import struct
+import time
+import unittest
+
+from common import dirpy_setup, dirpy_teardown, write_image, request
+import dirpy
+
+SLOT_BYTES = 65536
+
+
+# Return a cache key that starts probing at the given slot
+def slot_key(slot, n): #######################################################
+    return "%08x%032x" % (slot, n)
+
+
+# Return a record that shows whether it was read whole: a run of a single
+# byte value whose length depends on that value
+def pattern_record(val): #####################################################
+    return struct.pack("=B", val) * (100 + val)
+
+
+class ShmCacheTest(unittest.TestCase): #######################################
+
+    def setUp(self):
+        self.root = dirpy_setup(shm_cache_file="%(root)s/shm",
+            shm_cache_slots=4, shm_cache_slot_bytes=SLOT_BYTES)
+        write_image(self.root, "test.jpg")
+        self.path = os.path.join(self.root, "shm")
+        self.cache = dirpy.shm_cache
+
+    def tearDown(self):
+        dirpy_teardown(self.root)
+
+    def test_get_put(self): ##################################################
+        cache = self.cache
+        key = slot_key(0, 1)
+        self.assertIsNone(cache.get(key))
+        self.assertTrue(cache.put(key, b"first"))
+        self.assertEqual(cache.get(key), b"first")
+
+        # Rewriting a key reuses its slot
+        self.assertTrue(cache.put(key, b"second"))
+        self.assertEqual(cache.get(key), b"second")
+        for n in range(2, 5):
+            cache.put(slot_key(0, n), b"%d" % n)
+        self.assertEqual(cache.get(key), b"second")
+
+        # Records that don't fit in a slot are skipped
+        self.assertFalse(cache.put(slot_key(1, 1),
+            b"x" * (cache.max_record + 1)))
+        self.assertIsNone(cache.get(slot_key(1, 1)))
+
+        # Other workers (and restarts that don't reset) see our records,
+        # while a different layout starts out empty
+        other = dirpy.DirpyShmCache(self.path, 4, SLOT_BYTES)
+        self.assertEqual(other.get(key), b"second")
+        self.assertIsNone(dirpy.DirpyShmCache(self.path, 4, SLOT_BYTES,
+            True).get(key))
+        cache.put(key, b"third")
+        self.assertIsNone(dirpy.DirpyShmCache(self.path, 8,
+            SLOT_BYTES).get(key))
+
+    def test_eviction(self): #################################################
+        cache = self.cache
+        keys = [ slot_key(0, n) for n in range(6) ]
+        for key in keys[:4]:
+            cache.put(key, key.encode("ascii"))
+
+        # With every slot referenced, the first one probed goes
+        cache.put(keys[4], b"4")
+        self.assertIsNone(cache.get(keys[0]))
+
+        # Slots that were read since get a second chance
+        cache.get(keys[2])
+        cache.put(keys[5], b"5")
+        self.assertIsNone(cache.get(keys[1]))
+        for key in keys[2:]:
+            self.assertIsNotNone(cache.get(key))
+
+    def test_seqlock(self): ##################################################
+        cache = self.cache
+        key = slot_key(0, 1)
+        cache.put(key, b"record")
+
+        # Slots that are being written to are skipped
+        off = cache.file_header.size
+        seq = struct.unpack_from("=Q", cache.mm, off)[0]
+        struct.pack_into("=Q", cache.mm, off, seq + 1)
+        self.assertIsNone(cache.get(key))
+        struct.pack_into("=Q", cache.mm, off, seq + 2)
+        self.assertEqual(cache.get(key), b"record")
+
+        # And reads never return a record torn by another worker's write
+        def writer():
+            writer_cache = dirpy.DirpyShmCache(self.path, 4, SLOT_BYTES)
+            val = 0
+            while True:
+                writer_cache.put(key, pattern_record(val))
+                val = (val + 1) % 256
+
+        proc = multiprocessing.Process(target=writer)
+        proc.daemon = True
+        proc.start()
+        try:
+            reads = set()
+            deadline = time.time() + 1
+            while time.time() < deadline or len(reads) < 10:
+                record = cache.get(key)
+                if record is None or record == b"record":
+                    continue
+                val = struct.unpack_from("=B", record)[0]
+                self.assertEqual(record, pattern_record(val))
+                reads.add(val)
+        finally:
+            proc.terminate()
+            proc.join()
+
+    def test_requests(self): #################################################
+        dirpy_obj, body = request("/test.jpg?resize=100x")
+        self.assertEqual(dirpy_obj.meta_data["c"].get("shm_cache_write"), 1)
+
+        # A fresh process-local cache is served from shared memory
+        dirpy.local_cache_setup()
+        dirpy_obj, cached_body = request("/test.jpg?resize=100x")
+        self.assertEqual(dirpy_obj.meta_data["c"].get("shm_cache_hit"), 1)
+        self.assertEqual(cached_body, body)
+
+
+if __name__ == "__main__":
+    unittest.main()